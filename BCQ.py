@@ -4,6 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from utils.ensemble import member_mean, member_mse_loss, member_randn, stack_modules, unstack_module
+
 
 class Actor(nn.Module):
 	def __init__(self, state_dim, action_dim, max_action, phi=0.05):
@@ -17,7 +19,7 @@ class Actor(nn.Module):
 
 
 	def forward(self, state, action):
-		a = F.relu(self.l1(torch.cat([state, action], 1)))
+		a = F.relu(self.l1(torch.cat([state, action], -1)))
 		a = F.relu(self.l2(a))
 		a = self.phi * self.max_action * torch.tanh(self.l3(a))
 		return (a + action).clamp(-self.max_action, self.max_action)
@@ -36,18 +38,18 @@ class Critic(nn.Module):
 
 
 	def forward(self, state, action):
-		q1 = F.relu(self.l1(torch.cat([state, action], 1)))
+		q1 = F.relu(self.l1(torch.cat([state, action], -1)))
 		q1 = F.relu(self.l2(q1))
 		q1 = self.l3(q1)
 
-		q2 = F.relu(self.l4(torch.cat([state, action], 1)))
+		q2 = F.relu(self.l4(torch.cat([state, action], -1)))
 		q2 = F.relu(self.l5(q2))
 		q2 = self.l6(q2)
 		return q1, q2
 
 
 	def q1(self, state, action):
-		q1 = F.relu(self.l1(torch.cat([state, action], 1)))
+		q1 = F.relu(self.l1(torch.cat([state, action], -1)))
 		q1 = F.relu(self.l2(q1))
 		q1 = self.l3(q1)
 		return q1
@@ -70,17 +72,26 @@ class VAE(nn.Module):
 		self.max_action = max_action
 		self.latent_dim = latent_dim
 		self.device = device
+		# one torch.Generator per member of an ensemble (see EnsembleBCQ) the noise of every member is drawn from,
+		# None for the global generator
+		self.generators = None
+
+	def noise(self, shape):
+		# Standard normal noise of the given shape
+		if self.generators is None:
+			return torch.randn(shape).to(self.device)
+		return member_randn(shape, self.generators).to(self.device)
 
 
 	def forward(self, state, action):
-		z = F.relu(self.e1(torch.cat([state, action], 1)))
+		z = F.relu(self.e1(torch.cat([state, action], -1)))
 		z = F.relu(self.e2(z))
 
 		mean = self.mean(z)
 		# Clamped for numerical stability 
 		log_std = self.log_std(z).clamp(-4, 15)
 		std = torch.exp(log_std)
-		z = mean + std * torch.randn_like(std)
+		z = mean + std * (torch.randn_like(std) if self.generators is None else self.noise(std.shape))
 		
 		u = self.decode(state, z)
 
@@ -90,9 +101,9 @@ class VAE(nn.Module):
 	def decode(self, state, z=None):
 		# When sampling from the VAE, the latent vector is clipped to [-0.5, 0.5]
 		if z is None:
-			z = torch.randn((state.shape[0], self.latent_dim)).to(self.device).clamp(-0.5,0.5)
+			z = self.noise(tuple(state.shape[:-1]) + (self.latent_dim,)).clamp(-0.5,0.5)
 
-		a = F.relu(self.d1(torch.cat([state, z], 1)))
+		a = F.relu(self.d1(torch.cat([state, z], -1)))
 		a = F.relu(self.d2(a))
 		return self.max_action * torch.tanh(self.d3(a))
 		
@@ -128,16 +139,31 @@ class BCQ(object):
 			ind = q1.argmax(0)
 		return action[ind].cpu().data.numpy().flatten()
 
+	def select_actions(self, states, generators=None):
+		# Batched select_action: the 100 candidate actions of every row of states are evaluated in a single pass.
+		# With generators (one torch.Generator per row), the latent samples of every row are drawn from its own
+		# generator, as select_action would draw them from the global generator.
+		with torch.no_grad():
+			batch_size = states.shape[0]
+			state = torch.FloatTensor(states).repeat_interleave(100, 0).to(self.device)
+			z = None
+			if generators is not None:
+				z = torch.cat([torch.randn((100, self.vae.latent_dim), generator=generator)
+							   for generator in generators]).to(self.device).clamp(-0.5, 0.5)
+			action = self.actor(state, self.vae.decode(state, z))
+			ind = self.critic.q1(state, action).reshape(batch_size, 100).argmax(1)
+			action = action.reshape(batch_size, 100, -1)[torch.arange(batch_size), ind]
+		return action.cpu().data.numpy()
+
 	def train(self, replay_buffer, iterations, batch_size=100):
 
-		for it in range(iterations):
-			# Sample replay buffer / batch
-			state, action, next_state, reward, not_done = replay_buffer.sample(batch_size)
+		# Sample replay buffer / batch
+		for state, action, next_state, reward, not_done in replay_buffer.sample_batches(iterations, batch_size):
 
 			# Variational Auto-Encoder Training
 			recon, mean, std = self.vae(state, action)
-			recon_loss = F.mse_loss(recon, action)
-			KL_loss	= -0.5 * (1 + torch.log(std.pow(2)) - mean.pow(2) - std.pow(2)).mean()
+			recon_loss = member_mse_loss(recon, action)
+			KL_loss	= -0.5 * member_mean(1 + torch.log(std.pow(2)) - mean.pow(2) - std.pow(2))
 			vae_loss = recon_loss + 0.5 * KL_loss
 
 			self.vae_optimizer.zero_grad()
@@ -148,7 +174,7 @@ class BCQ(object):
 			# Critic Training
 			with torch.no_grad():
 				# Duplicate next state 10 times
-				next_state = torch.repeat_interleave(next_state, 10, 0)
+				next_state = torch.repeat_interleave(next_state, 10, -2)
 
 				# Compute value of perturbed actions sampled from the VAE
 				target_Q1, target_Q2 = self.critic_target(next_state, self.actor_target(next_state, self.vae.decode(next_state)))
@@ -156,12 +182,12 @@ class BCQ(object):
 				# Soft Clipped Double Q-learning 
 				target_Q = self.lmbda * torch.min(target_Q1, target_Q2) + (1. - self.lmbda) * torch.max(target_Q1, target_Q2)
 				# Take max over each action sampled from the VAE
-				target_Q = target_Q.reshape(batch_size, -1).max(1)[0].reshape(-1, 1)
+				target_Q = target_Q.reshape(tuple(target_Q.shape[:-2]) + (batch_size, -1)).max(-1)[0].unsqueeze(-1)
 
 				target_Q = reward + not_done * self.discount * target_Q
 
 			current_Q1, current_Q2 = self.critic(state, action)
-			critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
+			critic_loss = member_mse_loss(current_Q1, target_Q) + member_mse_loss(current_Q2, target_Q)
 
 			self.critic_optimizer.zero_grad()
 			critic_loss.backward()
@@ -173,7 +199,7 @@ class BCQ(object):
 			perturbed_actions = self.actor(state, sampled_actions)
 
 			# Update through DPG
-			actor_loss = -self.critic.q1(state, perturbed_actions).mean()
+			actor_loss = -member_mean(self.critic.q1(state, perturbed_actions))
 		 	 
 			self.actor_optimizer.zero_grad()
 			actor_loss.backward()
@@ -187,6 +213,16 @@ class BCQ(object):
 			for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
 				target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
 
+	def state_dict(self):
+		# Full training state (networks, target networks and optimizers), for checkpoints
+		return {name: getattr(self, name).state_dict() for name in [
+			'actor', 'actor_target', 'actor_optimizer', 'critic', 'critic_target', 'critic_optimizer', 'vae',
+			'vae_optimizer']}
+
+	def load_state_dict(self, state_dict):
+		for name, state in state_dict.items():
+			getattr(self, name).load_state_dict(state)
+
 	def save(self, filename):
 		torch.save(self.critic.state_dict(), filename + "_critic")
 		torch.save(self.critic_optimizer.state_dict(), filename + "_critic_optimizer")
@@ -201,4 +237,25 @@ class BCQ(object):
 
 		self.actor.load_state_dict(torch.load(filename + "_actor"))
 		self.actor_optimizer.load_state_dict(torch.load(filename + "_actor_optimizer"))
-		self.actor_target = copy.deepcopy(self.actor)
\ No newline at end of file
+		self.actor_target = copy.deepcopy(self.actor)
+
+class EnsembleBCQ(BCQ):
+	# BCQ policies of several seeds trained in lockstep as one model (one member per seed): every network stacks the
+	# networks of the seeds into batched layers (see utils.ensemble.stack_modules), and train takes the batches of
+	# the replay buffers of all the seeds (utils.ensemble.StackedBuffers). With generators (one torch.Generator per
+	# member), the VAE noise of every member is drawn from its own generator.
+	def __init__(self, policies, generators=None):
+		for name in ['actor', 'actor_target', 'critic', 'critic_target', 'vae']:
+			setattr(self, name, stack_modules([getattr(policy, name) for policy in policies]))
+		self.vae.generators = generators
+		self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=1e-3)
+		self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=1e-3)
+		self.vae_optimizer = torch.optim.Adam(self.vae.parameters())
+
+		for name in ['max_action', 'action_dim', 'discount', 'tau', 'lmbda', 'device']:
+			setattr(self, name, getattr(policies[0], name))
+
+	def unstack(self, k, policy):
+		# Copies the networks of member k into the BCQ policy of its seed (e.g. to evaluate or save it)
+		for name in ['actor', 'actor_target', 'critic', 'critic_target', 'vae']:
+			unstack_module(getattr(self, name), getattr(policy, name), k)
@@ -1,25 +1,87 @@
+import os
+import queue
+import threading
+
 import numpy as np
 import torch
 
 
+def sample_batches(sample, num_batches, batch_size, prefetch=0):
+    """
+    Yields num_batches minibatches of sample(batch_size). With prefetch > 0, they are sampled in a background thread
+    up to prefetch minibatches ahead. Exactly num_batches are sampled in both cases, in the same order, so the batches
+    (and the numpy random state after them) do not depend on prefetch.
+    """
+    if not prefetch:
+        for _ in range(num_batches):
+            yield sample(batch_size)
+        return
+
+    batches = queue.Queue(maxsize=prefetch)
+
+    def prefetch_batches():
+        try:
+            for _ in range(num_batches):
+                batches.put(sample(batch_size))
+        except Exception as e:
+            batches.put(e)
+
+    thread = threading.Thread(target=prefetch_batches, daemon=True)
+    thread.start()
+    for _ in range(num_batches):
+        batch = batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+    thread.join()
+
+
 class ReplayBuffer(object):
-    def __init__(self, state_dim, action_dim, device, max_size=int(1e6)):
+    def __init__(self, state_dim, action_dim, device, max_size=int(1e6), lazy=False):
         self.max_size = max_size
         self.ptr = 0
         self.size = 0
         self.num_trajectories = 0
+        self.state_dim = state_dim
+        self.action_dim = action_dim
 
-        self.state = np.zeros((max_size, state_dim))
-        self.action = np.zeros((max_size, action_dim))
-        self.next_state = np.zeros((max_size, state_dim))
-        self.reward = np.zeros((max_size, 1))
-        self.not_done = np.zeros((max_size, 1))
+        # With lazy=True the storage is only allocated on the first write (or on a non memory-mapped load)
+        self.state = None
+        self.action = None
+        self.next_state = None
+        self.reward = None
+        self.not_done = None
+        self.memory_mapped = False
+        # float32 copy of the transitions on the device (one row per transition), sampled instead of the arrays
+        # (see to_device)
+        self.tensors = None
+        # number of minibatches sample_batches prepares ahead in a background thread (0 for none)
+        self.prefetch = 0
+        if not lazy:
+            self.allocate()
         self.initial_state = []
+        # random state every initial state was reset from (see utils.rollout.get_reset_state), when recorded
+        self.reset_state = []
         self.trajectory_end_index = []
 
         self.device = device
 
+    def allocate(self):
+        """Allocates max_size rows of storage, keeping the transitions already held (e.g. memory-mapped ones)"""
+        storage = []
+        for crt, dim in [(self.state, self.state_dim), (self.action, self.action_dim),
+                         (self.next_state, self.state_dim), (self.reward, 1), (self.not_done, 1)]:
+            array = np.zeros((self.max_size, dim))
+            if crt is not None:
+                array[:self.size] = crt[:self.size]
+            storage.append(array)
+        self.state, self.action, self.next_state, self.reward, self.not_done = storage
+        self.memory_mapped = False
+
     def add(self, state, action, next_state, reward, done):
+        self.tensors = None
+        if self.state is None or self.memory_mapped:
+            self.allocate()
         self.state[self.ptr] = state
         self.action[self.ptr] = action
         self.next_state[self.ptr] = next_state
@@ -31,8 +93,43 @@ class ReplayBuffer(object):
         self.ptr = (self.ptr + 1) % self.max_size
         self.size = min(self.size + 1, self.max_size)
 
-    def sample(self, batch_size):
-        ind = np.random.randint(0, self.size, size=batch_size)
+    def add_batch(self, state, action, next_state, reward, done):
+        """Adds consecutive transitions (one per row), as one add call per row would"""
+        self.tensors = None
+        if self.state is None or self.memory_mapped:
+            self.allocate()
+        done = np.asarray(done, dtype=float).reshape(-1, 1)
+        ind = (self.ptr + np.arange(done.shape[0])) % self.max_size
+        self.state[ind] = state
+        self.action[ind] = action
+        self.next_state[ind] = next_state
+        self.reward[ind] = np.reshape(reward, (-1, 1))
+        self.not_done[ind] = 1. - done
+        ends = ind[done[:, 0] != 0].tolist()
+        self.trajectory_end_index.extend(ends)
+        self.num_trajectories += len(ends)
+        self.ptr = (self.ptr + done.shape[0]) % self.max_size
+        self.size = min(self.size + done.shape[0], self.max_size)
+
+    def to_device(self):
+        """
+        Copies the transitions once to a float32 tensor on the device, so that sample only indexes its rows. The
+        batches are the same as when sampling the arrays. Adding transitions drops the copy.
+        """
+        self.tensors = torch.cat([torch.as_tensor(np.asarray(array[:self.size]), dtype=torch.float32)
+                                  for array in [self.state, self.action, self.next_state, self.reward, self.not_done]],
+                                 dim=1).to(self.device)
+
+    def sample(self, batch_size, rng=None):
+        """Samples batch_size transitions, with the indexes drawn from rng (a np.random.RandomState) if given"""
+        if self.size == 0:
+            # e.g. a lazy buffer that was neither loaded nor added to yet
+            raise ValueError("Cannot sample an empty replay buffer: load or add transitions first")
+        ind = (np.random if rng is None else rng).randint(0, self.size, size=batch_size)
+
+        if self.tensors is not None:
+            batch = self.tensors[torch.as_tensor(ind).to(self.device)]
+            return batch.split([self.state_dim, self.action_dim, self.state_dim, 1, 1], dim=1)
 
         return (
             torch.FloatTensor(self.state[ind]).to(self.device),
@@ -42,6 +139,41 @@ class ReplayBuffer(object):
             torch.FloatTensor(self.not_done[ind]).to(self.device)
         )
 
+    def sample_batches(self, num_batches, batch_size):
+        return sample_batches(self.sample, num_batches, batch_size, self.prefetch)
+
+    def state_dict(self, transitions=True):
+        """
+        Transitions, reset states and trajectory bookkeeping of the buffer. With transitions False, the transitions
+        and reset states are left out (see self.transitions and self.reset_state_rows).
+        """
+        state_dict = {'ptr': self.ptr, 'size': self.size, 'num_trajectories': self.num_trajectories,
+                      'initial_state': list(self.initial_state), 'trajectory_end_index': list(self.trajectory_end_index)}
+        if transitions:
+            state_dict['transitions'] = self.transitions()
+            state_dict['reset_state'] = list(self.reset_state)
+        return state_dict
+
+    def transitions(self, start=0):
+        """(state, action, next_state, reward, not_done) rows of the buffer from start, for checkpoints"""
+        return [array[start:self.size] for array in
+                [self.state, self.action, self.next_state, self.reward, self.not_done]]
+
+    def reset_state_rows(self, start=0):
+        """Reset states of the episodes from start, as a (episodes, reset state length) array for checkpoints"""
+        width = len(self.reset_state[0]) if self.reset_state else 0
+        return np.array(self.reset_state[start:], dtype=np.float64).reshape(len(self.reset_state) - start, width)
+
+    def load_state_dict(self, state_dict):
+        self.tensors = None
+        self.size = 0
+        self.allocate()
+        for array, saved in zip([self.state, self.action, self.next_state, self.reward, self.not_done],
+                                state_dict['transitions']):
+            array[:len(saved)] = saved
+        for name in ['ptr', 'size', 'num_trajectories', 'initial_state', 'reset_state', 'trajectory_end_index']:
+            setattr(self, name, state_dict[name])
+
     def save(self, save_folder):
         np.save(f"{save_folder}_state.npy", self.state[:self.size])
         np.save(f"{save_folder}_action.npy", self.action[:self.size])
@@ -50,22 +182,54 @@ class ReplayBuffer(object):
         np.save(f"{save_folder}_not_done.npy", self.not_done[:self.size])
         np.save(f"{save_folder}_ptr.npy", self.ptr)
         np.save(f"{save_folder}_initial_state.npy", self.initial_state)
+        if self.reset_state:
+            np.save(f"{save_folder}_reset_state.npy", self.reset_state)
         np.save(f"{save_folder}_trajectory_end_index.npy", self.trajectory_end_index)
         np.save(f"{save_folder}_number_of_trajectories.npy", self.num_trajectories)
 
-    def load(self, save_folder, size=-1):
-        reward_buffer = np.load(f"{save_folder}_reward.npy")
+    def load(self, save_folder, size=-1, mmap=False):
+        """
+        Loads a saved buffer. With mmap=True the transitions are memory-mapped (read only) from the saved .npy
+        files instead of being copied in memory; storage is then only allocated if the buffer is written to.
+        """
+        reward_buffer = np.load(f"{save_folder}_reward.npy", mmap_mode='r')
 
         # Adjust crt_size if we're using a custom size
         size = min(int(size), self.max_size) if size > 0 else self.max_size
         self.size = min(reward_buffer.shape[0], size)
 
-        self.state[:self.size] = np.load(f"{save_folder}_state.npy")[:self.size]
-        self.action[:self.size] = np.load(f"{save_folder}_action.npy")[:self.size]
-        self.next_state[:self.size] = np.load(f"{save_folder}_next_state.npy")[:self.size]
-        self.reward[:self.size] = reward_buffer[:self.size]
-        self.not_done[:self.size] = np.load(f"{save_folder}_not_done.npy")[:self.size]
+        if mmap:
+            self.state = np.load(f"{save_folder}_state.npy", mmap_mode='r')[:self.size]
+            self.action = np.load(f"{save_folder}_action.npy", mmap_mode='r')[:self.size]
+            self.next_state = np.load(f"{save_folder}_next_state.npy", mmap_mode='r')[:self.size]
+            self.reward = reward_buffer[:self.size]
+            self.not_done = np.load(f"{save_folder}_not_done.npy", mmap_mode='r')[:self.size]
+            self.memory_mapped = True
+        else:
+            if self.memory_mapped:
+                self.state = self.action = self.next_state = self.reward = self.not_done = None
+            if self.state is None:
+                self.allocate()
+            # Reading through a memory map copies each array once, straight into the storage
+            self.state[:self.size] = np.load(f"{save_folder}_state.npy", mmap_mode='r')[:self.size]
+            self.action[:self.size] = np.load(f"{save_folder}_action.npy", mmap_mode='r')[:self.size]
+            self.next_state[:self.size] = np.load(f"{save_folder}_next_state.npy", mmap_mode='r')[:self.size]
+            self.reward[:self.size] = reward_buffer[:self.size]
+            self.not_done[:self.size] = np.load(f"{save_folder}_not_done.npy", mmap_mode='r')[:self.size]
+        self.tensors = None
         self.num_trajectories = int(np.load(f"{save_folder}_number_of_trajectories.npy"))
         self.trajectory_end_index[:self.num_trajectories] = np.load(f"{save_folder}_trajectory_end_index.npy")
         self.initial_state[:self.num_trajectories] = np.load(f"{save_folder}_initial_state.npy")
+        if os.path.exists(f"{save_folder}_reset_state.npy"):
+            self.reset_state[:self.num_trajectories] = np.load(f"{save_folder}_reset_state.npy")
+
 
+def load_buffer_index(save_folder):
+    """
+    Loads only the trajectory bookkeeping of a saved buffer, i.e. its number of trajectories, initial states
+    and trajectory end indexes, without reading (or allocating) any of the transitions.
+    """
+    num_trajectories = int(np.load(f"{save_folder}_number_of_trajectories.npy"))
+    initial_state = np.load(f"{save_folder}_initial_state.npy")
+    trajectory_end_index = np.load(f"{save_folder}_trajectory_end_index.npy")
+    return num_trajectories, initial_state, trajectory_end_index
@@ -4,6 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from utils.ensemble import member_mean, member_mse_loss, stack_modules, unstack_module
+
 
 # Implementation of Deep Deterministic Policy Gradients (DDPG)
 # Paper: https://arxiv.org/abs/1509.02971
@@ -34,7 +36,7 @@ class Critic(nn.Module):
 		self.l3 = nn.Linear(300, 1)
 
 	def forward(self, state, action):
-		q = F.relu(self.l1(torch.cat([state, action], 1)))
+		q = F.relu(self.l1(torch.cat([state, action], -1)))
 		q = F.relu(self.l2(q))
 		return self.l3(q)
 
@@ -57,6 +59,11 @@ class DDPG(object):
 		state = torch.FloatTensor(state.reshape(1, -1)).to(self.device)
 		return self.actor(state).cpu().data.numpy().flatten()
 
+	def select_actions(self, states):
+		# One action per row of states, with a single forward pass
+		states = torch.FloatTensor(states).to(self.device)
+		return self.actor(states).cpu().data.numpy()
+
 	def train(self, replay_buffer, batch_size=100):
 		# Sample replay buffer 
 		state, action, next_state, reward, not_done = replay_buffer.sample(batch_size)
@@ -69,7 +76,7 @@ class DDPG(object):
 		current_Q = self.critic(state, action)
 
 		# Compute critic loss
-		critic_loss = F.mse_loss(current_Q, target_Q)
+		critic_loss = member_mse_loss(current_Q, target_Q)
 
 		# Optimize the critic
 		self.critic_optimizer.zero_grad()
@@ -77,7 +84,7 @@ class DDPG(object):
 		self.critic_optimizer.step()
 
 		# Compute actor loss
-		actor_loss = -self.critic(state, self.actor(state)).mean()
+		actor_loss = -member_mean(self.critic(state, self.actor(state)))
 		
 		# Optimize the actor 
 		self.actor_optimizer.zero_grad()
@@ -91,6 +98,15 @@ class DDPG(object):
 		for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
 			target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
 
+	def state_dict(self):
+		# Full training state (networks, target networks and optimizers), for checkpoints
+		return {name: getattr(self, name).state_dict() for name in [
+			'actor', 'actor_target', 'actor_optimizer', 'critic', 'critic_target', 'critic_optimizer']}
+
+	def load_state_dict(self, state_dict):
+		for name, state in state_dict.items():
+			getattr(self, name).load_state_dict(state)
+
 	def save(self, filename):
 		torch.save(self.critic.state_dict(), filename + "_critic")
 		torch.save(self.critic_optimizer.state_dict(), filename + "_critic_optimizer")
@@ -105,4 +121,25 @@ class DDPG(object):
 
 		self.actor.load_state_dict(torch.load(filename + "_actor"))
 		self.actor_optimizer.load_state_dict(torch.load(filename + "_actor_optimizer"))
-		self.actor_target = copy.deepcopy(self.actor)
\ No newline at end of file
+		self.actor_target = copy.deepcopy(self.actor)
+
+class EnsembleDDPG(DDPG):
+	# DDPG policies of several seeds trained in lockstep as one model (see BCQ.EnsembleBCQ)
+	def __init__(self, policies):
+		for name in ['actor', 'actor_target', 'critic', 'critic_target']:
+			setattr(self, name, stack_modules([getattr(policy, name) for policy in policies]))
+		self.actor_optimizer = torch.optim.Adam(self.actor.parameters())
+		self.critic_optimizer = torch.optim.Adam(self.critic.parameters())
+
+		for name in ['discount', 'tau', 'device']:
+			setattr(self, name, getattr(policies[0], name))
+
+	def select_member_actions(self, states):
+		# One action per member, for the (ensemble_size, state_dim) states of the members
+		states = torch.FloatTensor(states[:, None]).to(self.device)
+		return self.actor(states).cpu().data.numpy()[:, 0]
+
+	def unstack(self, k, policy):
+		# Copies the networks of member k into the DDPG policy of its seed (e.g. to evaluate or save it)
+		for name in ['actor', 'actor_target', 'critic', 'critic_target']:
+			unstack_module(getattr(self, name), getattr(policy, name), k)
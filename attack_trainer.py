@@ -16,10 +16,11 @@ import DDPG
 from workers import attack, experiment
 from utils.configs import *
 from utils.helpers import str2bool
+from utils import synthetic_env  # registers SyntheticControl-v0 (no MuJoCo needed) with gym
 logger = logging.getLogger(__name__)
 
-if __name__ == "__main__":
 
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--attack_final_results', default=os.path.expanduser('~') + '/attack_output',
                         help='output path for files produced by the attack agent')
@@ -49,6 +50,16 @@ if __name__ == "__main__":
     parser.add_argument("--lmbda", default=0.75)  # Weighting for clipped double Q-learning in BCQ
     parser.add_argument("--phi", default=0.05)  # Max perturbation hyper-parameter for BCQ
     parser.add_argument("--create_pairs", action="store_true")  # If true, creates positive and negative pairs
+    parser.add_argument("--fused", action="store_true")  # If true, creates the pairs and trains the classifier in one run
+    parser.add_argument("--save_pairs", action="store_true")  # If true (with --fused), also saves the pairs in the background
+    parser.add_argument("--stream_pairs", action="store_true")  # If true, streams the pairs to disk chunk by chunk and trains on memory-mapped views
+    parser.add_argument('--pair_workers', default=0, type=int,
+                        help="number of worker processes creating the pairs (0: create them in this process). "
+                             "Workers use one seeded numpy generator per (model, label) job.")
+    parser.add_argument("--score_pairs", action="store_true")  # If true, scores the target pairs with a saved attack classifier
+    parser.add_argument("--classifier_path", default=None,
+                        help="directory of the saved attack classifier used by --score_pairs "
+                             "(default: the pairs directory of this configuration)")
     parser.add_argument("--train_policy", action="store_true")  # If true, train policy (BCQ)
     parser.add_argument("--generate_buffer", action="store_true")  # If true, generate buffer
     parser.add_argument("--attack_thresholds", nargs='+', type=float)  # Threshold for attack training
@@ -91,6 +102,14 @@ if __name__ == "__main__":
 
     # xgboost hyper parameter tuning (Leave any parameter that doesn't need to be tuned empty)
     parser.add_argument("--cv_tune_xgb", action="store_true")  # If true, it tunes the xgb hyper parameters
+    parser.add_argument('--tune_workers', default=0, type=int,
+                        help="number of worker processes running the cross validation fits of --cv_tune_xgb "
+                             "(0: run them in this process)")
+    parser.add_argument("--successive_halving", action="store_true")  # If true, weak candidates are dropped after fewer boosting rounds when tuning
+    parser.add_argument("--xgb_external_memory", action="store_true",
+                        help="train (and tune) the attack classifier from external memory: the pairs are streamed from "
+                             "the pair files with the hist tree method instead of being stacked in memory. "
+                             "Requires xgboost >= 1.5")
 
     parser.add_argument('--max_depth_vector', nargs='+', type=int, help="Typically between 3 and 10, but could be "
                                                                         "higher.  e.g.: 2 4 6 8 10")
@@ -106,8 +125,33 @@ if __name__ == "__main__":
                                                                           "e.g.: 0.6 0.7 0.75 0.8 0.9")
 
     parser.add_argument("--reg_alpha_vector", nargs='+', type=float, help="e.g: 1e-5 1e-3 0.005 1e-2 0.1 1 10 100")
+    return parser
+
+
+def get_result_paths(args):
+    """(attack_path, file_path_results, pair_path_results): where the buffers are read and the results written"""
+    attack_path = os.path.expanduser('~') + f"/projects/rrg-dprecup/samin/learning_output/{args.env}/{args.max_timesteps}/" \
+                                            f"{args.generatebuffer_max_timesteps}"
+
+    file_path_results = args.attack_final_results + f"/{args.env}/MaxT_{args.max_timesteps}/" \
+                                                    f"genT_{args.generatebuffer_max_timesteps}/" \
+                                                    f"bcqMaxT_{args.bcq_max_timesteps}/MaxTraj_{args.max_traj_len}/" \
+                                                    f"{CORRELATION_MAP.get(args.correlation)}"
 
-    args = parser.parse_args()
+    if not args.truncate_traj:
+        pair_path_results = file_path_results + f"/pairs/{args.pairing_mode}/train_NumModel_{args.num_models}_" \
+                                            f"ShSeed_{args.shadow_seeds}_TaSeed_{args.target_seeds}_" \
+                                            f"EnvSeed_{args.env_seeds}"
+    else:
+        pair_path_results = file_path_results + f"/pairs/{args.pairing_mode}/train_NumModel_{args.num_models}_" \
+                                                f"ShSeed_{args.shadow_seeds}_TaSeed_{args.target_seeds}_" \
+                                                f"EnvSeed_{args.env_seeds}_padding_{args.padding_size}"
+    return attack_path, file_path_results, pair_path_results
+
+
+if __name__ == "__main__":
+
+    args = get_parser().parse_args()
 
     # reading the parameter from a yaml file instead of the command line arguments!
     # This is to automate the entire process!
@@ -125,27 +169,12 @@ if __name__ == "__main__":
     print(f"Setting: Training Attack, Env: {args.env}, Shadow Seeds: {args.shadow_seeds}, "
           f"Target Seeds: {args.target_seeds}Max Trajectory Length: {args.max_traj_len}")
 
-    attack_path = os.path.expanduser('~') + f"/projects/rrg-dprecup/samin/learning_output/{args.env}/{args.max_timesteps}/" \
-                                            f"{args.generatebuffer_max_timesteps}"
-
     # *********************************** Logging Config ********************************************
-    file_path_results = args.attack_final_results + f"/{args.env}/MaxT_{args.max_timesteps}/" \
-                                                    f"genT_{args.generatebuffer_max_timesteps}/" \
-                                                    f"bcqMaxT_{args.bcq_max_timesteps}/MaxTraj_{args.max_traj_len}/" \
-                                                    f"{CORRELATION_MAP.get(args.correlation)}"
+    attack_path, file_path_results, pair_path_results = get_result_paths(args)
 
     if not os.path.exists(file_path_results):
         os.makedirs(file_path_results)
 
-    if not args.truncate_traj:
-        pair_path_results = file_path_results + f"/pairs/{args.pairing_mode}/train_NumModel_{args.num_models}_" \
-                                            f"ShSeed_{args.shadow_seeds}_TaSeed_{args.target_seeds}_" \
-                                            f"EnvSeed_{args.env_seeds}"
-    else:
-        pair_path_results = file_path_results + f"/pairs/{args.pairing_mode}/train_NumModel_{args.num_models}_" \
-                                                f"ShSeed_{args.shadow_seeds}_TaSeed_{args.target_seeds}_" \
-                                                f"EnvSeed_{args.env_seeds}_padding_{args.padding_size}"
-
     if not os.path.exists(pair_path_results):
         os.makedirs(pair_path_results)
 
@@ -186,7 +215,12 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    if args.create_pairs:
+    if args.fused:
+        experiment.run_fused_experiment(attack_path, file_path_results, pair_path_results, state_dim, action_dim,
+                                        device, args)
+    elif args.score_pairs:
+        experiment.run_scoring(attack_path, file_path_results, pair_path_results, state_dim, action_dim, device, args)
+    elif args.create_pairs:
         experiment.run_experiments_v2(attack_path, file_path_results, pair_path_results, state_dim, action_dim, device, args)
     else:
         experiment.run_classifier(attack_path, file_path_results, pair_path_results, state_dim, action_dim, device, args)
\ No newline at end of file
@@ -0,0 +1,202 @@
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import gym
+import numpy as np
+import torch
+
+import attack_trainer
+import BCQ
+import BCQutils
+import DDPG
+import runner_v2
+from utils.synthetic_env import SYNTHETIC_ENV, register_synthetic_env
+from workers import experiment
+from workers.attack import TEST_PAIRS, TRAIN_EVAL_PAIRS
+
+logger = logging.getLogger(__name__)
+
+# stages of the benchmark, in order
+STAGES = ['generate_buffer', 'train_bcq', 'target_buffer', 'create_pairs', 'train_classifier']
+
+
+def runner_args(config, env_seed, seed, *flags):
+    return runner_v2.get_parser().parse_args([
+        '--env', SYNTHETIC_ENV, '--env_seed', str(env_seed), '--seed', str(seed),
+        '--max_traj_len', str(config.max_traj_len), '--max_timesteps', str(config.buffer_timesteps),
+        '--generatebuffer_max_timesteps', str(config.buffer_timesteps), '--bcq_max_timesteps', str(config.bcq_iterations),
+        '--num_envs', str(config.num_envs)] + list(flags))
+
+
+def attack_args(config):
+    return attack_trainer.get_parser().parse_args([
+        '--env', SYNTHETIC_ENV, '--max_traj_len', str(config.max_traj_len),
+        '--max_timesteps', str(config.buffer_timesteps), '--generatebuffer_max_timesteps', str(config.buffer_timesteps),
+        '--bcq_max_timesteps', str(config.bcq_iterations), '--num_models', str(config.num_models),
+        '--shadow_seeds'] + [str(seed) for seed in config.shadow_seeds] + ['--target_seeds'] +
+        [str(seed) for seed in config.target_seeds] + ['--env_seeds'] + [str(seed) for seed in config.env_seeds] +
+        ['--attack_thresholds', '0.5'])
+
+
+def make_envs(config, env_seed):
+    """(env, eval_env) seeded as in runner_v2"""
+    env = gym.make(SYNTHETIC_ENV)
+    env.seed(env_seed)
+    env._max_episode_steps = config.max_traj_len
+    eval_env = gym.make(SYNTHETIC_ENV)
+    eval_env.seed(env_seed + 100)
+    return env, eval_env
+
+
+def pair_rows(pair_path_results, names):
+    return sum(len(np.load(f"{pair_path_results}/{name}.npy", mmap_mode='r')) for name in names)
+
+
+def run_stage(stage, config, env_seed=None, seed=None):
+    """
+    Runs one stage of the benchmark (for seed, for the runner_v2 stages), in a fresh process. Returns the number of
+    steps it made (environment steps, BCQ iterations or pairs), its wall time and the peak RSS (in MB) of the process
+    and of its worker processes.
+    """
+    register_synthetic_env(SYNTHETIC_ENV, config.state_dim, config.action_dim, config.max_traj_len)
+    logging.basicConfig(level=logging.WARNING)
+    torch.manual_seed(0 if seed is None else seed)
+    np.random.seed(0 if seed is None else seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    state_dim, action_dim, max_action = config.state_dim, config.action_dim, 1.
+    attack_path = f"{config.work_dir}/{env_seed}/{seed}/{config.max_traj_len}"
+    setting = f"{SYNTHETIC_ENV}_{env_seed}_{seed}"
+
+    start = time.time()
+    if stage == 'generate_buffer':
+        for folder in ['results', 'models', 'buffers']:
+            os.makedirs(f"{attack_path}/{folder}", exist_ok=True)
+        # buffer generation does not depend on how good the behavioral policy is
+        DDPG.DDPG(state_dim, action_dim, max_action, device).save(f"{attack_path}/models/behavioral_{setting}")
+        start = time.time()
+        env, eval_env = make_envs(config, env_seed)
+        runner_v2.interact_with_environment(attack_path, env, eval_env, state_dim, action_dim, max_action, device,
+                                            runner_args(config, env_seed, seed, '--generate_buffer'))
+        steps = config.buffer_timesteps
+    elif stage == 'train_bcq':
+        replay_buffer = BCQutils.ReplayBuffer(state_dim, action_dim, device, max_size=config.buffer_timesteps, lazy=True)
+        replay_buffer.load(f"{attack_path}/buffers/Robust_{setting}", mmap=True)
+        policy = BCQ.BCQ(state_dim, action_dim, max_action, device)
+        start = time.time()
+        policy.train(replay_buffer, iterations=config.bcq_iterations)
+        steps = config.bcq_iterations
+        wall_time = time.time() - start
+        torch.save(policy.state_dict(), f"{attack_path}/models/benchmark_BCQ_{setting}")
+    elif stage == 'target_buffer':
+        policy = BCQ.BCQ(state_dim, action_dim, max_action, device)
+        policy.load_state_dict(torch.load(f"{attack_path}/models/benchmark_BCQ_{setting}"))
+        start = time.time()
+        _, eval_env = make_envs(config, env_seed)
+        runner_v2.policy_interact_with_environment(attack_path, policy, state_dim, action_dim, max_action, eval_env,
+                                                   device, runner_args(config, env_seed, seed, '--train_policy'))
+        steps = len(np.load(f"{attack_path}/buffers/target_Robust_{setting}_{config.bcq_iterations}_compatible_"
+                            f"reward.npy", mmap_mode='r'))
+    else:
+        args = attack_args(config)
+        _, file_path_results, pair_path_results = attack_trainer.get_result_paths(args)
+        file_path_results = config.work_dir + file_path_results[len(args.attack_final_results):]
+        pair_path_results = config.work_dir + pair_path_results[len(args.attack_final_results):]
+        os.makedirs(pair_path_results, exist_ok=True)
+        if stage == 'create_pairs':
+            experiment.run_experiments_v2(config.work_dir, file_path_results, pair_path_results, state_dim, action_dim,
+                                          device, args)
+            steps = pair_rows(pair_path_results, [name for name in TRAIN_EVAL_PAIRS + TEST_PAIRS if name.endswith('x')])
+        else:
+            experiment.run_classifier(config.work_dir, file_path_results, pair_path_results, state_dim, action_dim,
+                                      device, args)
+            steps = pair_rows(pair_path_results, ['train_positive_x', 'train_negative_x'])
+    if stage != 'train_bcq':
+        wall_time = time.time() - start
+
+    # ru_maxrss is in KB on Linux
+    return steps, wall_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def run_benchmark(config):
+    """
+    Runs every stage of the pipeline on the synthetic environment (for every seed, for the runner_v2 stages), each in
+    a fresh process so that its peak RSS is its own. Returns {stage: {steps, wall_time, steps_per_sec, peak_rss_mb,
+    workers_peak_rss_mb}}, summed (or maxed, for the RSS) over the seeds.
+    """
+    seeds = [(config.env_seeds[0], seed) for seed in config.shadow_seeds] + \
+            [(config.env_seeds[-1], seed) for seed in config.target_seeds]
+    results = {}
+    for stage in STAGES:
+        runs = seeds if stage in ['generate_buffer', 'train_bcq', 'target_buffer'] else [(None, None)]
+        steps, wall_time, peak_rss, workers_peak_rss = 0, 0., 0., 0.
+        for env_seed, seed in runs:
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+                run = executor.submit(run_stage, stage, config, env_seed, seed).result()
+            steps += run[0]
+            wall_time += run[1]
+            peak_rss = max(peak_rss, run[2])
+            workers_peak_rss = max(workers_peak_rss, run[3])
+        results[stage] = {'steps': steps, 'wall_time': wall_time, 'steps_per_sec': steps / wall_time,
+                          'peak_rss_mb': peak_rss, 'workers_peak_rss_mb': workers_peak_rss}
+        logger.info(f"{stage}: {steps} steps in {wall_time:.2f}s ({steps / wall_time:.1f} steps/s), "
+                    f"peak RSS {peak_rss:.0f} MB")
+    return results
+
+
+def benchmark_report(results, baseline=None):
+    """Table of the benchmark results, with the speedup over the results of a baseline run when given"""
+    lines = [f"{'stage':<18} {'steps':>10} {'wall time (s)':>14} {'steps/s':>12} {'peak RSS (MB)':>14}"
+             + (f" {'speedup':>8}" if baseline else "")]
+    for stage, result in results.items():
+        line = f"{stage:<18} {result['steps']:>10} {result['wall_time']:>14.2f} {result['steps_per_sec']:>12.1f} " \
+               f"{result['peak_rss_mb']:>14.0f}"
+        if baseline and stage in baseline:
+            line += f" {result['steps_per_sec'] / baseline[stage]['steps_per_sec']:>7.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmarks buffer generation, BCQ training, target buffer generation, pair creation and the "
+                    "attack classifier on the MuJoCo-free synthetic environment (utils/synthetic_env.py)")
+    parser.add_argument("--state_dim", default=11, type=int)
+    parser.add_argument("--action_dim", default=3, type=int)
+    parser.add_argument("--max_traj_len", default=1000, type=int)  # Episode length of the synthetic environment
+    parser.add_argument("--buffer_timesteps", default=20000, type=int)  # Size of every generated buffer
+    parser.add_argument("--bcq_iterations", default=500, type=int)  # BCQ training iterations of every seed
+    parser.add_argument("--num_envs", default=1, type=int)  # Environment copies of the buffer generation
+    parser.add_argument("--shadow_seeds", default=[1, 2, 3], nargs='+', type=int)
+    parser.add_argument("--target_seeds", default=[11, 12], nargs=2, type=int)
+    parser.add_argument("--env_seeds", default=[0, 1], nargs='+', type=int)
+    parser.add_argument("--num_models", default=3, type=int)  # number of shadow models of the attack
+    parser.add_argument("--work_dir", default=None, help="where the buffers and pairs are written "
+                                                         "(default: a temporary directory)")
+    parser.add_argument("--output", default=None, help="json file the results are written to")
+    parser.add_argument("--baseline", default=None, help="json results of a previous run to compare to")
+    config = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if config.work_dir is None:
+            config.work_dir = tmp_dir
+        results = run_benchmark(config)
+
+    baseline = None
+    if config.baseline is not None:
+        with open(config.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+    logger.info("\n" + benchmark_report(results, baseline))
+    if config.output is not None:
+        with open(config.output, 'w') as f:
+            json.dump({'config': vars(config), 'results': results}, f, indent=4)
@@ -7,6 +7,7 @@ from torch.optim import Adam
 
 from ddpg import ddpg_core as core
 from utils.logx import EpochLogger
+from utils.trajectory_recorder import TrajectoryRecorder
 
 
 class ReplayBuffer:
@@ -21,6 +22,12 @@ class ReplayBuffer:
         self.rew_buf = np.zeros(size, dtype=np.float32)
         self.done_buf = np.zeros(size, dtype=np.float32)
         self.ptr, self.size, self.max_size = 0, 0, size
+        # tensors sharing the memory of the buffers, so sampled batches need no numpy -> torch conversion
+        self.tensors = dict(obs=torch.from_numpy(self.obs_buf),
+                            obs2=torch.from_numpy(self.obs2_buf),
+                            act=torch.from_numpy(self.act_buf),
+                            rew=torch.from_numpy(self.rew_buf),
+                            done=torch.from_numpy(self.done_buf))
 
     def store(self, obs, act, rew, next_obs, done):
         self.obs_buf[self.ptr] = obs
@@ -40,12 +47,24 @@ class ReplayBuffer:
                      done=self.done_buf[idxs])
         return {k: torch.as_tensor(v, dtype=torch.float32) for k, v in batch.items()}
 
+    def sample_batches(self, batch_size, num_batches):
+        """
+        The batches of num_batches consecutive sample_batch calls, with all
+        their indices drawn at once and gathered into one block per buffer;
+        the batches are views of the blocks.
+        """
+        idxs = torch.from_numpy(np.random.randint(0, self.size, size=num_batches * batch_size))
+        blocks = {k: v[idxs].view(num_batches, batch_size, *v.shape[1:]) for k, v in self.tensors.items()}
+        for j in range(num_batches):
+            yield {k: v[j] for k, v in blocks.items()}
+
 
 def ddpg(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
          steps_per_epoch=4000, epochs=100, replay_size=int(1e6), gamma=0.99,
          polyak=0.995, pi_lr=1e-3, q_lr=1e-3, batch_size=100, start_steps=10000,
          update_after=1000, update_every=50, act_noise=0.1, num_test_episodes=10,
-         max_ep_len=1000, logger_kwargs=dict(), save_freq=1):
+         max_ep_len=1000, logger_kwargs=dict(), save_freq=1,
+         trajectory_chunk_size=None):
     """
     Deep Deterministic Policy Gradient (DDPG)
     trajectory_output_path: The path to output the trajectory results
@@ -102,12 +121,17 @@ def ddpg(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kw
         num_test_episodes (int): Number of episodes to test the deterministic
             policy at the end of each epoch.
         max_ep_len (int): Maximum length of trajectory / episode / rollout.
-        logger_kwargs (dict): Keyword args for EpochLogger.
+        logger_kwargs (dict): Keyword args for EpochLogger (which keeps
+            streaming statistics of the stored values).
         save_freq (int): How often (in terms of gap between epochs) to save
             the current policy and value function.
+
+        trajectory_chunk_size (int): Number of steps the trajectory recorder
+            holds in memory before appending them to the trajectory files
+            (by default, all of them are written at the end of training).
     """
 
-    logger = EpochLogger(**logger_kwargs)
+    logger = EpochLogger(streaming=True, **logger_kwargs)
     logger.save_config(locals())
 
     torch.manual_seed(seed)
@@ -221,7 +245,8 @@ def ddpg(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kw
     o, ep_ret, ep_len, r, d = env.reset(), 0, 0, 0, False
 
     # init trajectory saving (obs,action, reward, done)
-    trajectories = []
+    trajectories = TrajectoryRecorder(str(trajectory_output_path), obs_dim[0], act_dim, total_steps,
+                                      chunk_size=trajectory_chunk_size)
 
     # Main loop: collect experience in env and update/log each epoch
     for t in range(total_steps):
@@ -235,7 +260,7 @@ def ddpg(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kw
             a = env.action_space.sample()
 
         # save step to trajectory
-        trajectories.append((o, a, r, d))
+        trajectories.record(o, a, r, d)
         # Step the env
         o2, r, d, _ = env.step(a)
         ep_ret += r
@@ -260,8 +285,7 @@ def ddpg(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kw
 
         # Update handling
         if t >= update_after and t % update_every == 0:
-            for _ in range(update_every):
-                batch = replay_buffer.sample_batch(batch_size)
+            for batch in replay_buffer.sample_batches(batch_size, update_every):
                 update(data=batch)
 
         # End of epoch handling
@@ -288,4 +312,4 @@ def ddpg(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kw
             # logger.log_tabular('Time', time.time() - start_time)
             # logger.dump_tabular()
 
-    np.save(str(trajectory_output_path) + '.npy', np.asarray(trajectories))
+    trajectories.close()
@@ -0,0 +1,168 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+
+import yaml
+
+import attack_trainer
+import runner_v2
+from utils.cache import StageCache
+from utils.scheduler import Stage, run_stages, timing_report
+from workers.attack import CLASSIFIER_FILE, TEST_PAIRS, TRAIN_EVAL_PAIRS
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# runner_v2 stages of every (env, max_traj_len, env_seed, seed), in order
+RUNNER_STAGES = ['train_behavioral', 'generate_buffer', 'train_policy']
+
+# files of a saved buffer (see BCQutils.ReplayBuffer.save)
+BUFFER_FILES = ['state', 'action', 'next_state', 'reward', 'not_done', 'ptr', 'initial_state', 'trajectory_end_index',
+                'number_of_trajectories']
+
+# flags that do not change the outputs of a stage, left out of its cache key
+RUNNER_PERFORMANCE_FLAGS = ['async_eval', 'device_buffer', 'prefetch_batches', 'checkpoint_freq', 'resume']
+ATTACK_PERFORMANCE_FLAGS = ['tune_workers', 'attack_final_results']
+# attack_trainer arguments read when creating the pairs, the only ones in the key of create_pairs: the classifier
+# arguments (thresholds, xgboost parameters, ...) are only in the key of train_classifier, which reuses the pairs
+PAIR_FLAGS = ['env', 'max_timesteps', 'generatebuffer_max_timesteps', 'buffer_name', 'shadow_seeds', 'target_seeds',
+              'env_seeds', 'bcq_max_timesteps', 'max_traj_len', 'num_models', 'correlation', 'pairing_mode',
+              'train_size', 'attack_size', 'in_traj_size', 'out_traj_size', 'ratio_size_prediction', 'truncate_traj',
+              'padding_size', 'pair_workers', 'stream_pairs']
+
+
+def to_argv(options):
+    """Command line arguments of a {flag: value} dict (True for a store_true flag, a list for a nargs flag)"""
+    argv = []
+    for name, value in options.items():
+        if value is None or value is False:
+            continue
+        argv.append(f"--{name}")
+        if isinstance(value, (list, tuple)):
+            argv.extend(str(item) for item in value)
+        elif value is not True:
+            argv.append(str(value))
+    return argv
+
+
+def runner_outputs(stage, args):
+    """Files written by the runner_v2 stage run with args"""
+    attack_path = runner_v2.get_attack_path(args, args.seed)
+    setting = f"{args.env}_{args.env_seed}_{args.seed}"
+    if stage == 'train_behavioral':
+        return [f"{attack_path}/models/behavioral_{setting}_{network}"
+                for network in ['critic', 'critic_optimizer', 'actor', 'actor_optimizer']]
+    if stage == 'generate_buffer':
+        buffer_name = f"{args.buffer_name}_{setting}"
+    else:
+        buffer_name = f"target_{args.buffer_name}_{setting}_{args.bcq_max_timesteps}_compatible"
+    return [f"{attack_path}/buffers/{buffer_name}_{name}.npy" for name in BUFFER_FILES]
+
+
+def runner_marker(stage, args):
+    """
+    Completion marker of the runner_v2 stage run with args (see utils.scheduler.Stage): the behavioral models are
+    saved at every evaluation, so they exist before train_behavioral completes
+    """
+    attack_path = runner_v2.get_attack_path(args, args.seed)
+    setting = f"{args.env}_{args.env_seed}_{args.seed}"
+    if stage == 'train_policy':
+        setting = f"{setting}_{args.bcq_max_timesteps}"
+    return f"{attack_path}/{stage}_{setting}.complete"
+
+
+def cache_args(args, performance_flags):
+    """Arguments of a stage that affect its outputs"""
+    return {name: value for name, value in sorted(vars(args).items()) if name not in performance_flags}
+
+
+def pair_args(args):
+    """Arguments of attack_trainer that affect the pairs it creates"""
+    return {name: getattr(args, name) for name in sorted(PAIR_FLAGS)}
+
+
+def build_stages(config):
+    """
+    Stages of a study: for every env and max_traj_len, the runner_v2 stages of every shadow seed (with the first env
+    seed) and target seed (with the last env seed), then the attack_trainer pair creation, once all the buffers
+    exist, and the classifier training. The pair sets are kept in the stage cache (see utils.cache.StageCache).
+    """
+    stage_cpus = config.get('stage_cpus', {})
+    stages = []
+    for env in config['envs']:
+        for max_traj_len in config['max_traj_len']:
+            common = dict(config.get('common', {}), env=env, max_traj_len=max_traj_len)
+            model_stages = []
+            for env_seed, seeds in [(config['env_seeds'][0], config['shadow_seeds']),
+                                    (config['env_seeds'][-1], config['target_seeds'])]:
+                for seed in seeds:
+                    depends_on = []
+                    for stage in RUNNER_STAGES:
+                        name = f"{stage}/{env}/{max_traj_len}/{env_seed}/{seed}"
+                        argv = to_argv(dict(dict(common, **config.get('runner_v2', {})),
+                                            env_seed=env_seed, seed=seed, **{stage: True}))
+                        if name not in model_stages:
+                            args = runner_v2.get_parser().parse_args(argv)
+                            stages.append(Stage(
+                                name, [sys.executable, f"{SOURCE_DIR}/runner_v2.py"] + argv,
+                                runner_outputs(stage, args), depends_on, stage_cpus.get(stage, 1),
+                                args=cache_args(args, RUNNER_PERFORMANCE_FLAGS), marker=runner_marker(stage, args)))
+                            model_stages.append(name)
+                        depends_on = [name]
+
+            argv = to_argv(dict(dict(common, **config.get('attack_trainer', {})),
+                                shadow_seeds=config['shadow_seeds'], target_seeds=config['target_seeds'],
+                                env_seeds=config['env_seeds']))
+            args = attack_trainer.get_parser().parse_args(argv)
+            _, _, pair_path_results = attack_trainer.get_result_paths(args)
+            command = [sys.executable, f"{SOURCE_DIR}/attack_trainer.py"] + argv
+            # the pairs are made from the buffers and target buffers. They are appended to their files as they are
+            # made, so the files exist before the stage completes
+            stages.append(Stage(f"create_pairs/{env}/{max_traj_len}", command + ['--create_pairs'],
+                                [f"{pair_path_results}/{name}.npy" for name in TRAIN_EVAL_PAIRS + TEST_PAIRS],
+                                [name for name in model_stages if not name.startswith('train_behavioral/')],
+                                stage_cpus.get('create_pairs', 1),
+                                args=pair_args(args), store=True,
+                                marker=f"{pair_path_results}/create_pairs.complete"))
+            stages.append(Stage(f"train_classifier/{env}/{max_traj_len}", command,
+                                [f"{pair_path_results}/{CLASSIFIER_FILE}"], [f"create_pairs/{env}/{max_traj_len}"],
+                                stage_cpus.get('train_classifier', 1), args=cache_args(args, ATTACK_PERFORMANCE_FLAGS)))
+    return stages
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Runs every runner_v2 and attack_trainer stage of the study described by a yaml config (see "
+                    "pipeline_config.yaml), skipping the stages whose outputs are up to date")
+    parser.add_argument("--config", default="pipeline_config.yaml")
+    parser.add_argument("--cpus", default=os.cpu_count(), type=int)  # CPU budget shared by the concurrent stages
+    parser.add_argument("--log_dir", default=os.path.expanduser('~') + '/pipeline_output',
+                        help="the output of every stage and the stage timings are written under this directory")
+    parser.add_argument("--dry_run", action="store_true")  # If true, only logs the stages that would run
+    parser.add_argument("--cache_dir", default=os.path.expanduser('~') + '/pipeline_output/cache',
+                        help="stage cache: keys of the outputs in place and stored pair sets (see utils/cache.py)")
+    parser.add_argument("--cache_max_gb", default=50, type=float)  # Size above which the oldest stored pair sets are evicted
+    parser.add_argument("--no_cache", action="store_true")  # If true, stages are skipped whenever their outputs exist
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as yaml_f:
+        config = yaml.safe_load(yaml_f)
+
+    log_dir = f"{args.log_dir}/{str(datetime.datetime.now()).replace(' ', '_')}"
+    os.makedirs(log_dir)
+    logging.basicConfig(level=logging.INFO, filename=f"{log_dir}/pipeline_log.txt")
+    logging.getLogger().addHandler(logging.StreamHandler())
+
+    cache = None if args.no_cache else StageCache(args.cache_dir, int(args.cache_max_gb * 2 ** 30))
+    stages = run_stages(build_stages(config), args.cpus, log_dir=log_dir, dry_run=args.dry_run, cache=cache)
+    logger.info("\n" + timing_report(stages))
+    with open(f"{log_dir}/stage_timings.json", 'w') as f:
+        json.dump([{'stage': stage.name, 'status': stage.status, 'wall_time': stage.wall_time} for stage in stages],
+                  f, indent=4)
+    if any(stage.status in ['failed', 'blocked'] for stage in stages):
+        exit(1)
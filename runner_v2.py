@@ -11,10 +11,73 @@ import BCQ
 import DDPG
 import BCQutils
 import datetime
+import functools
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from utils.ensemble import StackedBuffers
+from utils.checkpoint import CheckpointWriter, load_checkpoint, rng_state, set_rng_state
+from utils.rollout import collect_buffer, get_reset_state, policy_rollouts, restore_reset_state, run_episodes, \
+    spawn_seeds
+from utils import synthetic_env  # registers SyntheticControl-v0 (no MuJoCo needed) with gym
 
 logger = logging.getLogger(__name__)
 
+
+def make_env(env_name, max_traj_len):
+    env = gym.make(env_name)
+    # Bounding the maximum allowed trajectory length in the environment
+    env._max_episode_steps = max_traj_len
+    return env
+
+
+def bcq_state_dicts(policy):
+    """CPU copies of the actor, critic and vae state dicts of a BCQ policy"""
+    return [{name: tensor.detach().cpu().clone() for name, tensor in network.state_dict().items()}
+            for network in [policy.actor, policy.critic, policy.vae]]
+
+
+def load_bcq_state_dicts(policy, state_dicts):
+    for network, state_dict in zip([policy.actor, policy.critic, policy.vae], state_dicts):
+        network.load_state_dict(state_dict)
+
+
+def make_bcq(state_dim, action_dim, max_action, phi, state_dicts):
+    """CPU copy of a BCQ policy with the given actor, critic and vae state dicts"""
+    policy = BCQ.BCQ(state_dim, action_dim, max_action, torch.device("cpu"), phi=phi)
+    load_bcq_state_dicts(policy, state_dicts)
+    return policy
+
+
+# eval environment and policy of the background evaluation process of train_BCQ, built by init_eval_worker
+_eval_worker = None
+
+
+def init_eval_worker(make_eval_env, env_seed, make_policy, reset_state):
+    global _eval_worker
+    torch.set_num_threads(1)
+    eval_env = make_eval_env()
+    eval_env.seed(env_seed + 100)
+    restore_reset_state(eval_env, reset_state)
+    eval_envs = [make_eval_env() for _ in range(10)]
+    for env in eval_envs:
+        env.seed(env_seed + 100)
+    _eval_worker = (eval_env, eval_envs, make_policy())
+
+
+def worker_eval_policy(state_dicts, env_name, seed, env_seed, max_traj_len, eval_seeds):
+    """
+    eval_policy of the given weights on the eval environment of the worker process, which goes through the same resets
+    as the eval environment of train_BCQ. Also returns the reset state of the eval environment after the evaluation,
+    i.e. after the resets its episodes were drawn from.
+    """
+    eval_env, eval_envs, policy = _eval_worker
+    load_bcq_state_dicts(policy, state_dicts)
+    avg_reward = eval_policy(policy, env_name, seed, env_seed, eval_env, max_episode_step=max_traj_len,
+                             generators=[torch.Generator().manual_seed(eval_seed) for eval_seed in eval_seeds],
+                             envs=eval_envs)
+    return avg_reward, get_reset_state(eval_env)
+
+
 # Handles interactions with the environment, i.e. train behavioral or generate buffer
 def interact_with_environment(attack_path, env, eval_env, state_dim, action_dim, max_action, device, args):
     # For saving files
@@ -32,76 +95,124 @@ def interact_with_environment(attack_path, env, eval_env, state_dim, action_dim,
         replay_buffer = BCQutils.ReplayBuffer(state_dim, action_dim, device, max_size=args.generatebuffer_max_timesteps)
 
     evaluations = []
+    eval_envs = make_eval_envs(args.env)
 
-    state, done = env.reset(), False
-    replay_buffer.initial_state.append(state)
-    episode_reward = 0
-    episode_timesteps = 0
-    episode_num = 0
-    if args.train_behavioral:
-        max_timesteps = args.max_timesteps
+    if args.generate_buffer and args.num_envs > 1:
+        # Steps num_envs copies of the environment in worker processes
+        collect_buffer(policy, replay_buffer, functools.partial(make_env, args.env, args.max_traj_len), args.env_seed,
+                       args.seed, args.num_envs, args.generatebuffer_max_timesteps, max_action, args.rand_action_p,
+                       args.gaussian_std)
     else:
-        max_timesteps = args.generatebuffer_max_timesteps
-
-    # Interact with the environment for max_timesteps
-    for t in range(int(max_timesteps)):
-
-        episode_timesteps += 1
-
-        # Select action with noise
-        if (
-                (args.generate_buffer and np.random.uniform(0, 1) < args.rand_action_p) or
-                (args.train_behavioral and t < args.start_timesteps)
-        ):
-            action = env.action_space.sample()
+        # Checkpoints of the behavioral training are taken at the start of an episode, which can be restored from its
+        # reset state. The buffer never wraps (its size is max_timesteps), so every checkpoint only writes the
+        # transitions and reset states added since the previous one.
+        checkpoint_file = f"{attack_path}/models/checkpoint_behavioral_{setting}"
+        checkpoint_writer = CheckpointWriter(checkpoint_file)
+        checkpoint = checkpoint_writer.load() if args.train_behavioral and args.resume else None
+        if checkpoint is None:
+            start_t = 0
+            replay_buffer.reset_state.append(get_reset_state(env))
+            state, done = env.reset(), False
+            replay_buffer.initial_state.append(state)
+            episode_num = 0
         else:
-            action = (
-                    policy.select_action(np.array(state))
-                    + np.random.normal(0, max_action * args.gaussian_std, size=action_dim)
-            ).clip(-max_action, max_action)
-
-        # Perform action
-        next_state, reward, done, _ = env.step(action)
-        # TODO: check if we need this line. This is because, we set max_episode step when we instantiate the env. Susan: I don't think we need it. I checked it and it works with different max_traj_length
-        # Then, env should know it has reached the absorbing state and return done=True.
-        # In fact the code in gym, seems to be doing that.
-        # done_bool = float(done) if episode_timesteps < env._max_episode_steps else 0
-
-        if args.generate_buffer and t == args.generatebuffer_max_timesteps - 1:
-            replay_buffer.add(state, action, next_state, reward, float(1))
-            done = False
-            # replay_buffer.num_trajectories += 1
-            # replay_buffer.trajectory_end_index.append(t)
+            start_t = checkpoint['t']
+            episode_num = checkpoint['episode_num']
+            evaluations = checkpoint['evaluations']
+            policy.load_state_dict(checkpoint['policy'])
+            replay_buffer.load_state_dict(dict(checkpoint['replay_buffer'], transitions=checkpoint['rows'][:5],
+                                               reset_state=list(checkpoint['rows'][5])))
+            set_rng_state(checkpoint['rng'])
+            env.action_space.np_random.set_state(checkpoint['action_space_rng'])
+            restore_reset_state(eval_env, checkpoint['eval_reset_state'])
+            restore_reset_state(env, replay_buffer.reset_state[-1])
+            state, done = env.reset(), False
+            logger.info(f"Resuming the behavioral training from time step {start_t}")
+        last_checkpoint_t = start_t
+        checkpointed_rows = replay_buffer.size
+        checkpointed_episodes = len(replay_buffer.reset_state)
+        episode_reward = 0
+        episode_timesteps = 0
+        if args.train_behavioral:
+            max_timesteps = args.max_timesteps
         else:
-            # Store data in replay buffer
-            replay_buffer.add(state, action, next_state, reward, float(done))
+            max_timesteps = args.generatebuffer_max_timesteps
 
-        if args.generate_buffer and t == args.generatebuffer_max_timesteps - 1:
-            done = False
+        # Interact with the environment for max_timesteps
+        for t in range(start_t, int(max_timesteps)):
 
-        state = next_state
-        episode_reward += reward
+            episode_timesteps += 1
 
-        # Train agent after collecting sufficient data
-        if args.train_behavioral and t >= args.start_timesteps:
-            policy.train(replay_buffer, args.batch_size)
+            # Select action with noise
+            if (
+                    (args.generate_buffer and np.random.uniform(0, 1) < args.rand_action_p) or
+                    (args.train_behavioral and t < args.start_timesteps)
+            ):
+                action = env.action_space.sample()
+            else:
+                action = (
+                        policy.select_action(np.array(state))
+                        + np.random.normal(0, max_action * args.gaussian_std, size=action_dim)
+                ).clip(-max_action, max_action)
+
+            # Perform action
+            next_state, reward, done, _ = env.step(action)
+            # TODO: check if we need this line. This is because, we set max_episode step when we instantiate the env. Susan: I don't think we need it. I checked it and it works with different max_traj_length
+            # Then, env should know it has reached the absorbing state and return done=True.
+            # In fact the code in gym, seems to be doing that.
+            # done_bool = float(done) if episode_timesteps < env._max_episode_steps else 0
+
+            if args.generate_buffer and t == args.generatebuffer_max_timesteps - 1:
+                replay_buffer.add(state, action, next_state, reward, float(1))
+                done = False
+                # replay_buffer.num_trajectories += 1
+                # replay_buffer.trajectory_end_index.append(t)
+            else:
+                # Store data in replay buffer
+                replay_buffer.add(state, action, next_state, reward, float(done))
+
+            if args.generate_buffer and t == args.generatebuffer_max_timesteps - 1:
+                done = False
 
-        if done:
-            # +1 to account for 0 indexing. +0 on ep_timesteps since it will increment +1 even if done=True
-            logger.info(
-                f"Total T: {t + 1} Episode Num: {episode_num + 1} Episode T: {episode_timesteps} Reward: {episode_reward:.3f}")
-            # Reset environment
-            state, done = env.reset(), False
-            replay_buffer.initial_state.append(state)
-            episode_reward = 0
-            episode_timesteps = 0
-            episode_num += 1
+            state = next_state
+            episode_reward += reward
 
-        # Evaluate episode
-        if args.train_behavioral and (t + 1) % args.eval_freq == 0:
-            evaluations.append(eval_policy(policy, args.env, args.seed, args.env_seed, eval_env, max_episode_step=args.max_traj_len))
-            np.save(f"{attack_path}/results/behavioral_{setting}", evaluations)
-            policy.save(f"{attack_path}/models/behavioral_{setting}")
+            # Train agent after collecting sufficient data
+            if args.train_behavioral and t >= args.start_timesteps:
+                policy.train(replay_buffer, args.batch_size)
+
+            if done:
+                # +1 to account for 0 indexing. +0 on ep_timesteps since it will increment +1 even if done=True
+                logger.info(
+                    f"Total T: {t + 1} Episode Num: {episode_num + 1} Episode T: {episode_timesteps} Reward: {episode_reward:.3f}")
+                # Reset environment
+                replay_buffer.reset_state.append(get_reset_state(env))
+                state, done = env.reset(), False
+                replay_buffer.initial_state.append(state)
+                episode_reward = 0
+                episode_timesteps = 0
+                episode_num += 1
+
+            # Evaluate episode
+            if args.train_behavioral and (t + 1) % args.eval_freq == 0:
+                evaluations.append(eval_policy(policy, args.env, args.seed, args.env_seed, eval_env,
+                                               max_episode_step=args.max_traj_len, envs=eval_envs))
+                np.save(f"{attack_path}/results/behavioral_{setting}", evaluations)
+                policy.save(f"{attack_path}/models/behavioral_{setting}")
+
+            if (args.train_behavioral and args.checkpoint_freq and episode_timesteps == 0 and
+                    t + 1 - last_checkpoint_t >= args.checkpoint_freq):
+                checkpoint_writer.save({
+                    't': t + 1, 'episode_num': episode_num, 'evaluations': evaluations,
+                    'policy': policy.state_dict(), 'replay_buffer': replay_buffer.state_dict(transitions=False),
+                    'rng': rng_state(), 'action_space_rng': env.action_space.np_random.get_state(),
+                    'eval_reset_state': get_reset_state(eval_env)},
+                    new_rows=replay_buffer.transitions(checkpointed_rows) +
+                    [replay_buffer.reset_state_rows(checkpointed_episodes)])
+                last_checkpoint_t = t + 1
+                checkpointed_rows = replay_buffer.size
+                checkpointed_episodes = len(replay_buffer.reset_state)
+        checkpoint_writer.wait()
 
     # Save final policy
     if args.train_behavioral:
@@ -109,9 +220,12 @@ def interact_with_environment(attack_path, env, eval_env, state_dim, action_dim,
 
     # Save final buffer and performance
     else:
-        evaluations.append(eval_policy(policy, args.env, args.seed, args.env_seed, eval_env, max_episode_step=args.max_traj_len))
+        evaluations.append(eval_policy(policy, args.env, args.seed, args.env_seed, eval_env,
+                                       max_episode_step=args.max_traj_len, envs=eval_envs))
         np.save(f"{attack_path}/results/buffer_performance_{setting}", evaluations)
         replay_buffer.save(f"{attack_path}/buffers/{buffer_name}")
+    for env in eval_envs:
+        env.close()
 
 
 # Trains BCQ offline
@@ -123,30 +237,237 @@ def train_BCQ(attack_path, state_dim, action_dim, max_action, eval_env, device,
     # Initialize policy
     policy = BCQ.BCQ(state_dim, action_dim, max_action, device, args.discount, args.tau, args.lmbda, args.phi)
 
-    # Load buffer
-    replay_buffer = BCQutils.ReplayBuffer(state_dim, action_dim, device, max_size=args.max_timesteps)
-    replay_buffer.load(f"{attack_path}/buffers/{buffer_name}")
+    # Load buffer (BCQ only samples from it, so it is memory-mapped instead of copied in memory)
+    replay_buffer = BCQutils.ReplayBuffer(state_dim, action_dim, device, max_size=args.max_timesteps, lazy=True)
+    replay_buffer.load(f"{attack_path}/buffers/{buffer_name}", mmap=True)
+    if args.device_buffer:
+        replay_buffer.to_device()
+    replay_buffer.prefetch = args.prefetch_batches
 
     evaluations = []
     episode_num = 0
     done = True
     training_iters = 0
+    # weights of the evaluations not finished yet (with async_eval)
+    pending_weights = []
+
+    checkpoint_file = f"{attack_path}/models/checkpoint_BCQ_{setting}"
+    checkpoint_writer = CheckpointWriter(checkpoint_file)
+    checkpoint = load_checkpoint(checkpoint_file) if args.resume else None
+    if checkpoint is not None:
+        training_iters = checkpoint['training_iters']
+        evaluations = checkpoint['evaluations']
+        pending_weights = checkpoint['pending_weights']
+        policy.load_state_dict(checkpoint['policy'])
+        set_rng_state(checkpoint['rng'])
+        restore_reset_state(eval_env, checkpoint['eval_reset_state'])
+        logger.info(f"Resuming the BCQ training from iteration {training_iters}")
+
+    # With async_eval, the weights are evaluated in a background process while the training goes on
+    evaluator = None
+    if args.async_eval:
+        evaluator = ProcessPoolExecutor(max_workers=1, initializer=init_eval_worker, initargs=(
+            functools.partial(make_env, args.env, args.max_traj_len), args.env_seed,
+            functools.partial(make_bcq, state_dim, action_dim, max_action, args.phi, bcq_state_dicts(policy)),
+            get_reset_state(eval_env)))
+        eval_envs = []
+    else:
+        eval_envs = make_eval_envs(args.env)
+    pending = []
+
+    def evaluate(weights):
+        # The policy randomness of the evaluations has its own seeds, so that evaluating does not change the
+        # training (and the learning curve is the same with or without async_eval)
+        eval_num = len(evaluations) + len(pending)
+        eval_seeds = spawn_seeds(args.seed, [(eval_num, episode) for episode in range(10)])
+        if evaluator is None:
+            evaluated = policy if weights is None else make_bcq(state_dim, action_dim, max_action, args.phi, weights)
+            evaluations.append(eval_policy(
+                evaluated, args.env, args.seed, args.env_seed, eval_env, max_episode_step=args.max_traj_len,
+                generators=[torch.Generator().manual_seed(eval_seed) for eval_seed in eval_seeds], envs=eval_envs))
+            np.save(f"{attack_path}/results/BCQ_{setting}", evaluations)
+        else:
+            pending.append((evaluator.submit(worker_eval_policy, weights, args.env, args.seed, args.env_seed,
+                                             args.max_traj_len, eval_seeds), weights))
+            save_evaluations(wait=False)
+
+    def save_evaluations(wait):
+        # Saves the finished evaluations, in order
+        while pending and (wait or pending[0][0].done()):
+            avg_reward, eval_reset_state = pending.pop(0)[0].result()
+            evaluations.append(avg_reward)
+            np.save(f"{attack_path}/results/BCQ_{setting}", evaluations)
+            # eval_env goes on from where the eval environment of the background process is
+            restore_reset_state(eval_env, eval_reset_state)
+
+    try:
+        for weights in pending_weights:
+            evaluate(weights)
+
+        while training_iters < args.bcq_max_timesteps:
+            policy.train(replay_buffer, iterations=int(args.eval_freq), batch_size=args.batch_size)
+            evaluate(bcq_state_dicts(policy) if evaluator is not None else None)
+
+            training_iters += args.eval_freq
+            logger.info(f"Training iterations: {training_iters}")
+
+            if args.checkpoint_freq and training_iters // args.checkpoint_freq > \
+                    (training_iters - args.eval_freq) // args.checkpoint_freq:
+                checkpoint_writer.save({
+                    'training_iters': training_iters, 'evaluations': evaluations,
+                    'pending_weights': [weights for _, weights in pending], 'policy': policy.state_dict(),
+                    'rng': rng_state(), 'eval_reset_state': get_reset_state(eval_env)})
+        save_evaluations(wait=True)
+        checkpoint_writer.wait()
+    finally:
+        if evaluator is not None:
+            evaluator.shutdown()
+        for env in eval_envs:
+            env.close()
+    # policy.save(f"{attack_path}/models/target_{setting}")
+    policy_interact_with_environment(attack_path, policy, state_dim, action_dim, max_action, eval_env, device, args)
+
+
+def get_attack_path(args, seed):
+    return f"{os.path.expanduser('~')}/projects/rrg-dprecup/samin/learning_output/{args.env}/{args.max_timesteps}/" \
+           f"{args.generatebuffer_max_timesteps}/" \
+           f"{args.env_seed}/{seed}/{args.max_traj_len}"
+
+
+def seed_args(args, seed):
+    """args of the run of one seed of an ensemble"""
+    return argparse.Namespace(**dict(vars(args), seed=seed))
+
+
+# Trains behavioral (DDPG) policies of all the seeds of args.ensemble_seeds in lockstep, as one batched model.
+# Every policy starts from the weights of the run of its seed, and its exploration noise and minibatches are drawn from
+# random states of its own seed, so that its training does not depend on the other seeds of the ensemble.
+def train_behavioral_ensemble(state_dim, action_dim, max_action, device, args):
+    members = [seed_args(args, seed) for seed in args.ensemble_seeds]
+    policies, envs, eval_envs, replay_buffers = [], [], [], []
+    rngs = [np.random.RandomState(member.seed) for member in members]
+    for member in members:
+        # Every policy starts from the weights of the run of its seed
+        torch.manual_seed(member.seed)
+        policies.append(DDPG.DDPG(state_dim, action_dim, max_action, device))
+        envs.append(make_env(args.env, args.max_traj_len))
+        envs[-1].seed(args.env_seed)
+        envs[-1].action_space.seed(member.seed)
+        eval_envs.append(gym.make(args.env))
+        eval_envs[-1].seed(args.env_seed + 100)
+        replay_buffers.append(BCQutils.ReplayBuffer(state_dim, action_dim, device, max_size=args.max_timesteps))
+    ensemble = DDPG.EnsembleDDPG(policies)
+    stacked_buffers = StackedBuffers(replay_buffers, rngs=rngs)
+
+    evaluations = [[] for _ in members]
+    # the members are evaluated one after the other, on the same copies of the eval environment
+    eval_copies = make_eval_envs(args.env)
+    states = np.array([env.reset() for env in envs])
+    episode_rewards = np.zeros(len(members))
+    episode_timesteps = np.zeros(len(members), dtype=int)
+    episode_nums = np.zeros(len(members), dtype=int)
+
+    for t in range(int(args.max_timesteps)):
+        episode_timesteps += 1
 
+        # Select action with noise
+        if t < args.start_timesteps:
+            actions = [env.action_space.sample() for env in envs]
+        else:
+            actions = (
+                    ensemble.select_member_actions(states)
+                    + np.array([rng.normal(0, max_action * args.gaussian_std, size=action_dim) for rng in rngs])
+            ).clip(-max_action, max_action)
+
+        for k, (env, replay_buffer, action) in enumerate(zip(envs, replay_buffers, actions)):
+            next_state, reward, done, _ = env.step(action)
+            replay_buffer.add(states[k], action, next_state, reward, float(done))
+            episode_rewards[k] += reward
+            if done:
+                logger.info(f"Seed: {members[k].seed} Total T: {t + 1} Episode Num: {episode_nums[k] + 1} "
+                            f"Episode T: {episode_timesteps[k]} Reward: {episode_rewards[k]:.3f}")
+                next_state = env.reset()
+                episode_rewards[k] = 0
+                episode_timesteps[k] = 0
+                episode_nums[k] += 1
+            states[k] = next_state
+
+        # Train agents after collecting sufficient data
+        if t >= args.start_timesteps:
+            ensemble.train(stacked_buffers, args.batch_size)
+
+        # Evaluate episode
+        if (t + 1) % args.eval_freq == 0 or t + 1 == int(args.max_timesteps):
+            for k, member in enumerate(members):
+                setting = f"{args.env}_{args.env_seed}_{member.seed}"
+                ensemble.unstack(k, policies[k])
+                if (t + 1) % args.eval_freq == 0:
+                    evaluations[k].append(eval_policy(policies[k], args.env, member.seed, args.env_seed, eval_envs[k],
+                                                      max_episode_step=args.max_traj_len, envs=eval_copies))
+                    np.save(f"{get_attack_path(args, member.seed)}/results/behavioral_{setting}", evaluations[k])
+                policies[k].save(f"{get_attack_path(args, member.seed)}/models/behavioral_{setting}")
+    for env in eval_copies:
+        env.close()
+
+
+# Trains BCQ on the buffers of all the seeds of args.ensemble_seeds in lockstep, as one batched model, then generates
+# the target buffer of every seed. As for train_behavioral_ensemble, every member starts from the weights of the run of
+# its seed, and draws its minibatches and BCQ noise from random states of its own seed.
+def train_BCQ_ensemble(state_dim, action_dim, max_action, device, args):
+    members = [seed_args(args, seed) for seed in args.ensemble_seeds]
+    policies, eval_envs, replay_buffers = [], [], []
+    for member in members:
+        # Every policy starts from the weights of the run of its seed
+        torch.manual_seed(member.seed)
+        policies.append(BCQ.BCQ(state_dim, action_dim, max_action, device, args.discount, args.tau, args.lmbda,
+                                args.phi))
+        eval_envs.append(gym.make(args.env))
+        eval_envs[-1].seed(args.env_seed + 100)
+        replay_buffer = BCQutils.ReplayBuffer(state_dim, action_dim, device, max_size=args.max_timesteps, lazy=True)
+        replay_buffer.load(f"{get_attack_path(args, member.seed)}/buffers/"
+                           f"{args.buffer_name}_{args.env}_{args.env_seed}_{member.seed}", mmap=True)
+        if args.device_buffer:
+            replay_buffer.to_device()
+        replay_buffers.append(replay_buffer)
+    ensemble = BCQ.EnsembleBCQ(policies, [torch.Generator().manual_seed(member.seed) for member in members])
+    stacked_buffers = StackedBuffers(replay_buffers, args.prefetch_batches,
+                                     [np.random.RandomState(member.seed) for member in members])
+
+    evaluations = [[] for _ in members]
+    # the members are evaluated one after the other, on the same copies of the eval environment
+    eval_copies = make_eval_envs(args.env)
+    training_iters = 0
     while training_iters < args.bcq_max_timesteps:
-        policy.train(replay_buffer, iterations=int(args.eval_freq), batch_size=args.batch_size)
+        ensemble.train(stacked_buffers, iterations=int(args.eval_freq), batch_size=args.batch_size)
 
-        evaluations.append(eval_policy(policy, args.env, args.seed, args.env_seed, eval_env, max_episode_step=args.max_traj_len))
-        np.save(f"{attack_path}/results/BCQ_{setting}", evaluations)
+        for k, member in enumerate(members):
+            setting = f"{args.env}_{args.env_seed}_{member.seed}_{args.bcq_max_timesteps}"
+            ensemble.unstack(k, policies[k])
+            eval_seeds = spawn_seeds(member.seed, [(len(evaluations[k]), episode) for episode in range(10)])
+            evaluations[k].append(eval_policy(
+                policies[k], args.env, member.seed, args.env_seed, eval_envs[k], max_episode_step=args.max_traj_len,
+                generators=[torch.Generator().manual_seed(eval_seed) for eval_seed in eval_seeds], envs=eval_copies))
+            np.save(f"{get_attack_path(args, member.seed)}/results/BCQ_{setting}", evaluations[k])
 
         training_iters += args.eval_freq
         logger.info(f"Training iterations: {training_iters}")
-    # policy.save(f"{attack_path}/models/target_{setting}")
-    policy_interact_with_environment(attack_path, policy, state_dim, action_dim, max_action, eval_env, device, args)
+    for env in eval_copies:
+        env.close()
+
+    for member, policy, eval_env in zip(members, policies, eval_envs):
+        policy_interact_with_environment(get_attack_path(args, member.seed), policy, state_dim, action_dim,
+                                         max_action, eval_env, device, member)
+
+
+def make_eval_envs(env_name, eval_episodes=10):
+    """Copies of the eval environment the eval episodes are run on (see eval_policy)"""
+    return [gym.make(env_name) for _ in range(eval_episodes)]
 
 
 # Runs policy for X episodes and returns average reward
 # A fixed seed is used for the eval environment
-def eval_policy(policy, env_name, seed, env_seed, eval_env, eval_episodes=10, max_episode_step=None):
+def eval_policy(policy, env_name, seed, env_seed, eval_env, eval_episodes=10, max_episode_step=None, generators=None,
+                envs=None):
     # eval_env = gym.make(env_name)
     # # eval_env.seed(seed + 100)
     # eval_env.seed(env_seed)
@@ -154,13 +475,25 @@ def eval_policy(policy, env_name, seed, env_seed, eval_env, eval_episodes=10, ma
     if max_episode_step:
         eval_env._max_episode_steps = max_episode_step
 
-    avg_reward = 0.
+    # The episodes start from the next eval_episodes resets of eval_env, as when they are run one after the other,
+    # but they are run in lockstep on copies of eval_env (envs, or copies made for this evaluation), with batched
+    # action selection. eval_env itself only goes through the resets.
+    reset_states = []
     for _ in range(eval_episodes):
-        state, done = eval_env.reset(), False
-        while not done:
-            action = policy.select_action(np.array(state))
-            state, reward, done, _ = eval_env.step(action)
-            avg_reward += reward
+        reset_states.append(get_reset_state(eval_env))
+        eval_env.reset()
+    copies = make_eval_envs(env_name, eval_episodes) if envs is None else envs[:eval_episodes]
+    for env in copies:
+        env._max_episode_steps = eval_env._max_episode_steps
+
+    avg_reward = 0.
+    try:
+        for _, _, _, reward, _ in run_episodes(copies, policy, reset_states, generators=generators):
+            avg_reward += np.sum(reward)
+    finally:
+        if envs is None:
+            for env in copies:
+                env.close()
 
     avg_reward /= eval_episodes
 
@@ -188,50 +521,64 @@ def policy_interact_with_environment(file_path, policy, dim_state, dim_action, a
                                           max_size=arg.max_traj_len * len(train_initial_states))
     evaluations = []
 
-    # Env initialization
-    environment = gym.make(arg.env)
-    # eval_env = gym.make(arg.env)
-    #
-    environment.seed(arg.env_seed)
-    # eval_env.seed(arg.env_seed + 100)
-    # Bounding the maximum allowed trajectory length in the environment
-    environment._max_episode_steps = arg.max_traj_len
-    torch.manual_seed(arg.seed)
-    np.random.seed(arg.seed)
-    # state = env.reset()
-
-    episode_num = 0
-    total_t = 0
-    # Interact with the environment for max_timesteps
-    for i in range(len(train_initial_states)):
-        state, done = environment.reset(), False
-        if not np.array_equal(state, train_initial_states[i].ravel()):
-            raise ValueError('The initial state is not the same as that in the training data')
-        replay_buffer.initial_state.append(state)
-        episode_reward = 0
-        episode_timesteps = 0
-        episode_num += 1
-        # Select action using the target policy
-        while not done:
-            episode_timesteps += 1
-            total_t += 1
-            action = policy.select_action(np.array(state)).clip(-action_max, action_max)
-
-        # Perform action
-            next_state, reward, done, _ = environment.step(action)
-        # TODO: check if we need this line. This is because, we set max_episode step when we instantiate the env. Susan: No need to double check "done". The max_episode step is taking care of it.
-        # Then, env should know we have reached that state and return done=True. In fact the code in gym, seems to be doing that.
-        # done_bool = float(done) if episode_timesteps < env._max_episode_steps else 0
+    train_reset_states = f"{file_path}/buffers/{arg.buffer_name}_{arg.env}_{arg.env_seed}_{arg.seed}_reset_state.npy"
+    if arg.num_envs > 1 and os.path.exists(train_reset_states):
+        # Every episode is restored from its saved reset state, so the episodes are split across worker processes
+        make_policy = functools.partial(make_bcq, dim_state, dim_action, action_max, arg.phi, bcq_state_dicts(policy))
+        episodes = policy_rollouts(functools.partial(make_env, arg.env, arg.max_traj_len), arg.env_seed, make_policy,
+                                   arg.seed, action_max, np.load(train_reset_states), train_initial_states,
+                                   arg.num_envs)
+        for episode_num, (state, action, next_state, reward, done) in enumerate(episodes, 1):
+            replay_buffer.initial_state.append(state[0])
+            replay_buffer.add_batch(state, action, next_state, reward, done)
+            logger.info(
+                f"Total T: {replay_buffer.size + 1}, Episode Num: {episode_num}, Episode T: {len(reward)}, "
+                f"Reward: {np.sum(reward):.3f}")
+    else:
+        # Env initialization
+        environment = gym.make(arg.env)
+        # eval_env = gym.make(arg.env)
+        #
+        environment.seed(arg.env_seed)
+        # eval_env.seed(arg.env_seed + 100)
+        # Bounding the maximum allowed trajectory length in the environment
+        environment._max_episode_steps = arg.max_traj_len
+        torch.manual_seed(arg.seed)
+        np.random.seed(arg.seed)
+        # state = env.reset()
+
+        episode_num = 0
+        total_t = 0
+        # Interact with the environment for max_timesteps
+        for i in range(len(train_initial_states)):
+            state, done = environment.reset(), False
+            if not np.array_equal(state, train_initial_states[i].ravel()):
+                raise ValueError('The initial state is not the same as that in the training data')
+            replay_buffer.initial_state.append(state)
+            episode_reward = 0
+            episode_timesteps = 0
+            episode_num += 1
+            # Select action using the target policy
+            while not done:
+                episode_timesteps += 1
+                total_t += 1
+                action = policy.select_action(np.array(state)).clip(-action_max, action_max)
+
+            # Perform action
+                next_state, reward, done, _ = environment.step(action)
+            # TODO: check if we need this line. This is because, we set max_episode step when we instantiate the env. Susan: No need to double check "done". The max_episode step is taking care of it.
+            # Then, env should know we have reached that state and return done=True. In fact the code in gym, seems to be doing that.
+            # done_bool = float(done) if episode_timesteps < env._max_episode_steps else 0
 
-        # Store data in replay buffer
-            replay_buffer.add(state, action, next_state, reward, float(done))
+            # Store data in replay buffer
+                replay_buffer.add(state, action, next_state, reward, float(done))
 
-            state = next_state
-            episode_reward += reward
-            # +1 to account for 0 indexing. +0 on ep_timesteps since it will increment +1 even if done=True
-        logger.info(
-             f"Total T: {total_t + 1}, Episode Num: {episode_num}, Episode T: {episode_timesteps}, "
-             f"Reward: {episode_reward:.3f}")
+                state = next_state
+                episode_reward += reward
+                # +1 to account for 0 indexing. +0 on ep_timesteps since it will increment +1 even if done=True
+            logger.info(
+                 f"Total T: {total_t + 1}, Episode Num: {episode_num}, Episode T: {episode_timesteps}, "
+                 f"Reward: {episode_reward:.3f}")
 
 
     # Save final buffer and performance
@@ -241,8 +588,7 @@ def policy_interact_with_environment(file_path, policy, dim_state, dim_action, a
     replay_buffer.save(f"{file_path}/buffers/{buffer_name}_compatible")
 
 
-if __name__ == "__main__":
-
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--env" , help="the environment you are in", default="Hopper-v3")           # OpenAI gym environment name
     parser.add_argument("--env_seed", type=int)# Sets Gym seed
@@ -287,8 +633,20 @@ if __name__ == "__main__":
     parser.add_argument('--max_traj_len', default=1000, type=int)
     parser.add_argument('--bcq_max_timesteps', default=int(1e6), type=int)
     parser.add_argument('--generatebuffer_max_timesteps', default=int(1e6), type=int)
+    parser.add_argument("--ensemble_seeds", nargs='*', type=int)  # Seeds trained in lockstep as one batched model (instead of --seed), each with the initial weights of its own run and its own random states
+    parser.add_argument("--device_buffer", action="store_true")  # If true, BCQ samples from a float32 copy of the buffer on the device
+    parser.add_argument("--prefetch_batches", default=0, type=int)  # Number of BCQ minibatches sampled ahead in a background thread
+    parser.add_argument("--checkpoint_freq", default=0, type=int)  # How often (time steps / BCQ iterations) the full training state is checkpointed, 0 for never
+    parser.add_argument("--resume", action="store_true")  # If true, resume the training from its last checkpoint
+    parser.add_argument("--async_eval", action="store_true")  # If true, evaluate BCQ in a background process while training
+    parser.add_argument('--num_envs', default=1, type=int,
+                        help="number of environment copies stepped in parallel when generating the (target) buffer")
+    return parser
 
-    args = parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = get_parser().parse_args()
 
     ######BCQ Implementation Starts Here#########
 
@@ -305,21 +663,19 @@ if __name__ == "__main__":
         logger.info("Train_behavioral and generate_buffer cannot both be true.")
         exit()
 
-    attack_path = f"{os.path.expanduser('~')}/projects/rrg-dprecup/samin/learning_output/{args.env}/{args.max_timesteps}/" \
-                  f"{args.generatebuffer_max_timesteps}/" \
-                  f"{args.env_seed}/{args.seed}/{args.max_traj_len}"
-
-    if not os.path.exists(f"{attack_path}/results"):
-        os.makedirs(f"{attack_path}/results")
-
-    if not os.path.exists(f"{attack_path}/models"):
-        os.makedirs(f"{attack_path}/models")
+    if args.ensemble_seeds and args.generate_buffer:
+        logger.info("ensemble_seeds only applies to train_behavioral and train_policy.")
+        exit()
 
-    if not os.path.exists(f"{attack_path}/buffers"):
-        os.makedirs(f"{attack_path}/buffers")
+    if args.ensemble_seeds and (args.checkpoint_freq or args.resume or args.async_eval):
+        logger.error("checkpoint_freq, resume and async_eval are not supported with ensemble_seeds.")
+        exit(1)
 
-    if not os.path.exists(f"{attack_path}/log"):
-        os.makedirs(f"{attack_path}/log")
+    for seed in args.ensemble_seeds or [args.seed]:
+        for folder in ["results", "models", "buffers", "log"]:
+            if not os.path.exists(f"{get_attack_path(args, seed)}/{folder}"):
+                os.makedirs(f"{get_attack_path(args, seed)}/{folder}")
+    attack_path = get_attack_path(args, args.ensemble_seeds[0] if args.ensemble_seeds else args.seed)
 
     logging.basicConfig(
         level=logging.DEBUG,
@@ -343,8 +699,9 @@ if __name__ == "__main__":
     eval_env.seed(args.env_seed + 100)
     # Bounding the maximum allowed trajectory length in the environment
     env._max_episode_steps = args.max_traj_len
-    torch.manual_seed(args.seed)
-    np.random.seed(args.seed)
+    # (the members of an ensemble seed their own random states)
+    torch.manual_seed(args.ensemble_seeds[0] if args.ensemble_seeds else args.seed)
+    np.random.seed(args.ensemble_seeds[0] if args.ensemble_seeds else args.seed)
 
     state_dim = env.observation_space.shape[0]  # for Hopper-v3, state_dim == 11
     action_dim = env.action_space.shape[0]  # for Hopper-v3, action_dim == 3
@@ -352,7 +709,11 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    if args.train_behavioral or args.generate_buffer:
+    if args.ensemble_seeds and args.train_behavioral:
+        train_behavioral_ensemble(state_dim, action_dim, max_action, device, args)
+    elif args.ensemble_seeds:
+        train_BCQ_ensemble(state_dim, action_dim, max_action, device, args)
+    elif args.train_behavioral or args.generate_buffer:
         interact_with_environment(attack_path, env, eval_env,  state_dim, action_dim, max_action, device, args)
     elif args.train_policy:
         train_BCQ(attack_path, state_dim, action_dim, max_action, eval_env, device, args)
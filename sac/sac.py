@@ -6,6 +6,7 @@ import numpy as np
 from sac import sac_core as core
 import torch
 from utils.logx import EpochLogger
+from utils.trajectory_recorder import TrajectoryRecorder
 from torch.optim import Adam
 
 
@@ -21,6 +22,12 @@ class ReplayBuffer:
         self.rew_buf = np.zeros(size, dtype=np.float32)
         self.done_buf = np.zeros(size, dtype=np.float32)
         self.ptr, self.size, self.max_size = 0, 0, size
+        # tensors sharing the memory of the buffers, so sampled batches need no numpy -> torch conversion
+        self.tensors = dict(obs=torch.from_numpy(self.obs_buf),
+                            obs2=torch.from_numpy(self.obs2_buf),
+                            act=torch.from_numpy(self.act_buf),
+                            rew=torch.from_numpy(self.rew_buf),
+                            done=torch.from_numpy(self.done_buf))
 
     def store(self, obs, act, rew, next_obs, done):
         self.obs_buf[self.ptr] = obs
@@ -40,12 +47,24 @@ class ReplayBuffer:
                      done=self.done_buf[idxs])
         return {k: torch.as_tensor(v, dtype=torch.float32) for k, v in batch.items()}
 
+    def sample_batches(self, batch_size, num_batches):
+        """
+        The batches of num_batches consecutive sample_batch calls, with all
+        their indices drawn at once and gathered into one block per buffer;
+        the batches are views of the blocks.
+        """
+        idxs = torch.from_numpy(np.random.randint(0, self.size, size=num_batches * batch_size))
+        blocks = {k: v[idxs].view(num_batches, batch_size, *v.shape[1:]) for k, v in self.tensors.items()}
+        for j in range(num_batches):
+            yield {k: v[j] for k, v in blocks.items()}
+
 
 def sac(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
         steps_per_epoch=4000, epochs=100, replay_size=int(1e6), gamma=0.99,
         polyak=0.995, lr=1e-3, alpha=0.2, batch_size=100, start_steps=10000,
         update_after=1000, update_every=50, num_test_episodes=10, max_ep_len=1000,
-        logger_kwargs=dict(), save_freq=1):
+        logger_kwargs=dict(), save_freq=1,
+        trajectory_chunk_size=None):
     """
     Soft Actor-Critic (SAC)
 
@@ -138,14 +157,19 @@ def sac(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kwa
 
         max_ep_len (int): Maximum length of trajectory / episode / rollout.
 
-        logger_kwargs (dict): Keyword args for EpochLogger.
+        logger_kwargs (dict): Keyword args for EpochLogger (which keeps
+            streaming statistics of the stored values).
 
         save_freq (int): How often (in terms of gap between epochs) to save
             the current policy and value function.
 
+        trajectory_chunk_size (int): Number of steps the trajectory recorder
+            holds in memory before appending them to the trajectory files
+            (by default, all of them are written at the end of training).
+
     """
 
-    logger = EpochLogger(**logger_kwargs)
+    logger = EpochLogger(streaming=True, **logger_kwargs)
     logger.save_config(locals())
 
     torch.manual_seed(seed)
@@ -284,7 +308,8 @@ def sac(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kwa
     o, ep_ret, ep_len, r, d = env.reset(), 0, 0, 0, False
 
     # init trajectory saving (obs,action, reward, done)
-    trajectories = []
+    trajectories = TrajectoryRecorder(str(trajectory_output_path), obs_dim[0], act_dim, total_steps,
+                                      chunk_size=trajectory_chunk_size)
     # Main loop: collect experience in env and update/log each epoch
     for t in range(total_steps):
 
@@ -297,7 +322,7 @@ def sac(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kwa
             a = env.action_space.sample()
 
         # save step to trajectory
-        trajectories.append((o, a, r, d))
+        trajectories.record(o, a, r, d)
 
         # Step the env
         o2, r, d, _ = env.step(a)
@@ -325,8 +350,7 @@ def sac(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kwa
 
         # Update handling
         if t >= update_after and t % update_every == 0:
-            for j in range(update_every):
-                batch = replay_buffer.sample_batch(batch_size)
+            for batch in replay_buffer.sample_batches(batch_size, update_every):
                 update(data=batch)
 
         #End of epoch handling
@@ -355,4 +379,4 @@ def sac(trajectory_output_path, env_fn, actor_critic=core.MLPActorCritic, ac_kwa
             # logger.log_tabular('Time', time.time() - start_time)
             # logger.dump_tabular()
 
-    np.save(str(trajectory_output_path) + '.npy', np.asarray(trajectories))
+    trajectories.close()
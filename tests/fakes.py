@@ -0,0 +1,76 @@
+"""Fake environments, policies and buffers shared by the test modules"""
+import os
+import numpy as np
+import torch
+from BCQutils import ReplayBuffer
+from utils.rollout import collect_buffer
+
+
+class FakeEnv(object):
+    """Episodes of random length (drawn at reset, as the initial state) with deterministic steps"""
+
+    @property
+    def unwrapped(self):
+        return self
+
+    def seed(self, seed):
+        self.np_random = np.random.RandomState(seed)
+
+    def reset(self):
+        self.steps_left = self.np_random.randint(1, 8)
+        self.state = self.np_random.uniform(-1, 1, size=3)
+        return self.state
+
+    def step(self, action):
+        self.steps_left -= 1
+        self.state = self.state + action.sum()
+        return self.state, float(self.state.sum()), self.steps_left == 0, {}
+
+    def close(self):
+        pass
+
+
+class FakePolicy(object):
+    def select_actions(self, states, generators=None):
+        actions = np.tanh(states[:, :2])
+        if generators is not None:
+            # random as the BCQ actions
+            actions += 0.1 * np.array([torch.randn(2, generator=generator).numpy() for generator in generators])
+        return actions
+
+
+class FixedBatches(object):
+    """Replay buffer returning the given batches, in order"""
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def sample(self, batch_size):
+        return self.batches.pop(0)
+
+
+def collect(num_envs, max_timesteps=50):
+    """Behavioral buffer of FakePolicy on FakeEnv, collected with num_envs environment copies"""
+    replay_buffer = ReplayBuffer(3, 2, 'cpu', max_size=max_timesteps)
+    collect_buffer(FakePolicy(), replay_buffer, FakeEnv, 0, 1, num_envs, max_timesteps, 1., 0.3, 0.3)
+    return replay_buffer
+
+
+def write_buffers(attack_path, args, action_dim=2, num_trajectories=20):
+    """
+    Random (behavioral and target) buffer indexes and actions of the shadow and target seeds of the attack_trainer
+    args, laid out under attack_path as the attack reads them
+    """
+    rng = np.random.RandomState(0)
+    initial_states = rng.normal(size=(num_trajectories, 3))
+    for env_seed, seeds in [(args.env_seeds[0], args.shadow_seeds), (args.env_seeds[-1], args.target_seeds)]:
+        for seed in seeds:
+            folder = f"{attack_path}/{env_seed}/{seed}/{args.max_traj_len}/buffers"
+            os.makedirs(folder, exist_ok=True)
+            for name in [f"{args.buffer_name}_{args.env}_{env_seed}_{seed}",
+                         f"target_{args.buffer_name}_{args.env}_{env_seed}_{seed}_{args.bcq_max_timesteps}_compatible"]:
+                lengths = rng.randint(1, args.max_traj_len + 1, size=num_trajectories)
+                np.save(f"{folder}/{name}_action.npy", rng.uniform(-1, 1, size=(lengths.sum(), action_dim)))
+                np.save(f"{folder}/{name}_number_of_trajectories.npy", num_trajectories)
+                np.save(f"{folder}/{name}_initial_state.npy", initial_states)
+                np.save(f"{folder}/{name}_trajectory_end_index.npy", np.cumsum(lengths) - 1)
@@ -0,0 +1,155 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from utils.npy_appender import NpyAppender
+from workers.attack import generate_correlated_decorrelated_pairs, pad_traj, confusion_counts, roc_pr_curves, \
+    shuffle_xgboost_params, shuffled_index, gather_rows
+from workers.tuning import CVSearch, kfold_dmatrices
+from xgboost.sklearn import XGBClassifier
+
+
+class PairsTestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        # three trajectories of length 2, 4 and 3 with a 2-dimensional action space
+        self.train_end_index = [1, 5, 8]
+        self.test_end_index = [2, 3, 8]
+        self.train_buffer = np.arange(18, dtype=np.float64).reshape(9, 2)
+        self.test_buffer = -np.arange(18, dtype=np.float64).reshape(9, 2)
+        self.padding_len = 6
+
+    def expected_pairs(self, axis):
+        starts_train = [0] + [i + 1 for i in self.train_end_index[:-1]]
+        starts_test = [0] + [i + 1 for i in self.test_end_index[:-1]]
+        rows = []
+        for j in range(3):
+            in_seq = pad_traj(self.train_buffer[starts_train[j]: self.train_end_index[j] + 1], self.padding_len, 25)
+            out_seq = pad_traj(self.test_buffer[starts_test[j]: self.test_end_index[j] + 1], self.padding_len, 25)
+            rows.append(np.ravel(np.concatenate((in_seq, out_seq), axis=axis)))
+        return np.vstack(rows)
+
+    def generate(self, pairing_mode, correlation='c', do_train=False, train_size=3, pair_writers=None):
+        return generate_correlated_decorrelated_pairs(
+            self.test_buffer, self.train_buffer, self.test_end_index, self.train_end_index, train_size, 3, None, 1,
+            do_train, correlation=correlation, test_padding_len=self.padding_len,
+            train_padding_len=self.padding_len, padding_len=self.padding_len, pairing_mode=pairing_mode,
+            pair_writers=pair_writers)
+
+    def test_horizontal_pairs(self):
+        (pairs, labels), (eval_pairs, eval_labels) = self.generate('horizontal')
+        np.testing.assert_array_equal(pairs, self.expected_pairs(axis=0))
+        np.testing.assert_array_equal(labels, np.ones((3, 1)))
+        self.assertIsNone(eval_pairs)
+        self.assertIsNone(eval_labels)
+
+    def test_vertical_pairs(self):
+        (pairs, _), _ = self.generate('vertical')
+        np.testing.assert_array_equal(pairs, self.expected_pairs(axis=1))
+
+    def test_train_eval_split(self):
+        (pairs, labels), (eval_pairs, eval_labels) = self.generate('horizontal', do_train=True, train_size=1)
+        expected = self.expected_pairs(axis=0)
+        # a single pair is returned flat
+        np.testing.assert_array_equal(pairs, expected[0])
+        np.testing.assert_array_equal(labels, [1])
+        np.testing.assert_array_equal(eval_pairs, expected[1:])
+        self.assertEqual(eval_labels.shape, (2, 1))
+
+    def test_semi_correlated_pairs_are_reproducible(self):
+        np.random.seed(0)
+        (first, _), _ = self.generate('horizontal', correlation='s', do_train=True)
+        np.random.seed(0)
+        (second, _), _ = self.generate('horizontal', correlation='s', do_train=True)
+        np.testing.assert_array_equal(first, second)
+        # only the order of the "in" actions changes
+        expected = self.expected_pairs(axis=0)
+        width = self.padding_len * 2
+        np.testing.assert_array_equal(first[:, width:], expected[:, width:])
+        np.testing.assert_array_equal(np.sort(first[:, :width], axis=1), np.sort(expected[:, :width], axis=1))
+
+    def test_streamed_pairs(self):
+        with tempfile.TemporaryDirectory() as path:
+            names = ['pairs', 'labels']
+            writers = [NpyAppender(os.path.join(path, f'{name}.npy')) for name in names]
+            self.assertEqual(self.generate('horizontal', pair_writers=(writers, None)), ((None, None), (None, None)))
+            for writer in writers:
+                writer.close()
+            pairs, labels = [np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names]
+            np.testing.assert_array_equal(pairs, self.expected_pairs(axis=0))
+            np.testing.assert_array_equal(labels, np.ones((3, 1)))
+            del pairs, labels
+
+    def test_shuffled_index_matches_shuffled_pairs(self):
+        sources_x = [self.train_buffer, self.test_buffer[:5]]
+        sources_y = [np.ones((9, 1)), np.zeros((5, 1))]
+        np.random.seed(3)
+        x, y = shuffle_xgboost_params(np.vstack(sources_x), np.vstack(sources_y))
+        x, y = shuffle_xgboost_params(x, y)
+        np.random.seed(3)
+        index = shuffled_index(14)
+        np.testing.assert_array_equal(gather_rows(sources_x, index), x)
+        np.testing.assert_array_equal(gather_rows(sources_y, index), y)
+
+
+class MetricsTestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.predictions = np.array([0.1, 0.4, 0.35, 0.8, 0.5, 0.5, 0.9, 0.2], dtype=np.float32)
+        self.labels = np.array([0, 0, 1, 1, 0, 1, 1, 0], dtype=np.float64)
+        self.thresholds = [0., 0.2, 0.35, 0.5, 0.75, 1.]
+
+    def test_confusion_counts(self):
+        tp, tn, fp, fn = confusion_counts(self.predictions, self.labels, self.thresholds)
+        for j, threshold in enumerate(self.thresholds):
+            # as the per-prediction loop of output_prec_recall compares them
+            predicted_in = np.array([prediction >= threshold for prediction in self.predictions])
+            self.assertEqual(tp[j], np.sum(predicted_in & (self.labels == 1)))
+            self.assertEqual(tn[j], np.sum(~predicted_in & (self.labels == 0)))
+            self.assertEqual(fp[j], np.sum(predicted_in & (self.labels == 0)))
+            self.assertEqual(fn[j], np.sum(~predicted_in & (self.labels == 1)))
+
+    def test_float32_prediction_equal_to_threshold_is_in(self):
+        # np.float32(0.35) is slightly below the float64 0.35, but equal to the threshold in float32
+        tp, tn, fp, fn = confusion_counts(np.array([0.35, 0.9], dtype=np.float32), np.ones(2), [0.35])
+        self.assertEqual((tp[0], tn[0], fp[0], fn[0]), (2, 0, 0, 0))
+
+    def test_roc_auc(self):
+        (fpr, tpr, _, roc_auc), _ = roc_pr_curves(self.predictions, self.labels)
+        self.assertEqual((fpr[0], tpr[0]), (0., 0.))
+        self.assertEqual((fpr[-1], tpr[-1]), (1., 1.))
+        # fraction of (positive, negative) pairs ranked correctly, ties counting for half
+        positives = self.predictions[self.labels == 1]
+        negatives = self.predictions[self.labels == 0]
+        expected = np.mean((positives[:, None] > negatives) + 0.5 * (positives[:, None] == negatives))
+        self.assertAlmostEqual(roc_auc, expected)
+
+
+class TuningTestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        self.x = rng.normal(size=(200, 4))
+        self.y = (self.x[:, 0] + 0.5 * rng.normal(size=200) > 0).astype(np.float64)
+        self.xgb1 = XGBClassifier(learning_rate=0.3, n_estimators=30, max_depth=2, objective='reg:logistic', seed=27)
+        self.search = CVSearch(lambda: kfold_dmatrices(self.x, self.y, 3), 3, 30, early_stopping_rounds=3)
+
+    def test_cached_configurations_are_not_refitted(self):
+        self.search.grid_search(self.xgb1, {'max_depth': [1, 2, 3]})
+        self.assertEqual(len(self.search.cache), 3)
+        self.assertIn(self.xgb1.get_params()['max_depth'], [1, 2, 3])
+        self.assertLessEqual(self.xgb1.get_params()['n_estimators'], 30)
+        # the best candidate of the previous stage is in the cache
+        self.search.tune_n_estimators(self.xgb1)
+        self.search.grid_search(self.xgb1, {'max_depth': [1, 2, 3]})
+        self.assertEqual(len(self.search.cache), 3)
+
+    def test_successive_halving(self):
+        self.search.halving = True
+        self.assertEqual(self.search.halving_budgets(9), [3, 10, 30])
+        best, (score, rounds, _) = self.search.search({'objective': 'reg:logistic'}, {'max_depth': [1, 2, 3, 4]})
+        self.assertIn(best['max_depth'], [1, 2, 3, 4])
+        # only the surviving candidates are trained for the full number of rounds
+        full_budget = [key for key, results in self.search.cache.items() if 30 in results]
+        self.assertLess(len(full_budget), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
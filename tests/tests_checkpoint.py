@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+from BCQ import BCQ
+from BCQutils import ReplayBuffer
+from utils.checkpoint import CheckpointWriter, load_checkpoint
+from fakes import collect
+
+
+class CheckpointTestSuite(unittest.TestCase):
+    def test_checkpoint_round_trip(self):
+        policy = BCQ(3, 2, 1., torch.device('cpu'))
+        replay_buffer = collect(2)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'checkpoint')
+            self.assertIsNone(load_checkpoint(filename))
+            writer = CheckpointWriter(filename)
+            writer.save({'policy': policy.state_dict(), 'replay_buffer': replay_buffer.state_dict()})
+            # the checkpoint is a copy, that the training cannot change
+            policy.actor.l1.weight.data.add_(1.)
+            writer.wait()
+            checkpoint = load_checkpoint(filename)
+            self.assertFalse(os.path.exists(filename + '.tmp'))
+
+        restored = BCQ(3, 2, 1., torch.device('cpu'))
+        restored.load_state_dict(checkpoint['policy'])
+        np.testing.assert_allclose(restored.actor.l1.weight.data.numpy(), policy.actor.l1.weight.data.numpy() - 1.,
+                                   atol=1e-6)
+        restored_buffer = ReplayBuffer(3, 2, 'cpu', max_size=replay_buffer.max_size)
+        restored_buffer.load_state_dict(checkpoint['replay_buffer'])
+        np.testing.assert_array_equal(restored_buffer.state, replay_buffer.state)
+        self.assertEqual(restored_buffer.trajectory_end_index, replay_buffer.trajectory_end_index)
+        self.assertEqual(restored_buffer.ptr, replay_buffer.ptr)
+
+    def test_appended_rows_are_written_once(self):
+        source = collect(2)
+        state, action, next_state, reward, not_done = source.transitions()
+        replay_buffer = ReplayBuffer(3, 2, 'cpu', max_size=len(state))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'checkpoint')
+            writer = CheckpointWriter(filename)
+            saved, saved_episodes = 0, 0
+            for size in [20, 35, 50]:
+                for k in range(replay_buffer.size, size):
+                    replay_buffer.add(state[k], action[k], next_state[k], reward[k], 1. - not_done[k])
+                # the reset state of every episode started so far
+                replay_buffer.reset_state = source.reset_state[:replay_buffer.num_trajectories + 1]
+                writer.save({'replay_buffer': replay_buffer.state_dict(transitions=False)},
+                            new_rows=replay_buffer.transitions(saved) + [replay_buffer.reset_state_rows(saved_episodes)])
+                saved, saved_episodes = size, len(replay_buffer.reset_state)
+                if size == 35:
+                    # resumed from the checkpoint of 35 rows
+                    writer.wait()
+                    writer = CheckpointWriter(filename)
+                    self.assertEqual(len(writer.load()['rows'][0]), 35)
+            writer.wait()
+            self.assertEqual(len([name for name in os.listdir(tmp_dir) if '_rows_' in name]), 3)
+            checkpoint = load_checkpoint(filename)
+
+        self.assertNotIn('transitions', checkpoint['replay_buffer'])
+        self.assertNotIn('reset_state', checkpoint['replay_buffer'])
+        restored = ReplayBuffer(3, 2, 'cpu', max_size=len(state))
+        restored.load_state_dict(dict(checkpoint['replay_buffer'], transitions=checkpoint['rows'][:5],
+                                      reset_state=list(checkpoint['rows'][5])))
+        self.assertEqual(restored.size, 50)
+        for column, expected in zip(restored.transitions(), [state, action, next_state, reward, not_done]):
+            np.testing.assert_array_equal(column, expected)
+        np.testing.assert_array_equal(restored.reset_state, replay_buffer.reset_state)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import numpy as np
+import torch
+from BCQ import BCQ, EnsembleBCQ
+from DDPG import DDPG, EnsembleDDPG
+from utils.ensemble import StackedBuffers
+from fakes import FixedBatches, collect
+
+
+class EnsembleTestSuite(unittest.TestCase):
+    def test_ensemble_trains_every_seed_as_its_own_model(self):
+        replay_buffers = [collect(2), collect(1)]
+        policies = []
+        for seed in [0, 1]:
+            torch.manual_seed(seed)
+            policies.append(DDPG(3, 2, 1., torch.device('cpu')))
+        ensemble = EnsembleDDPG(policies)
+        np.random.seed(0)
+        for _ in range(3):
+            ensemble.train(StackedBuffers(replay_buffers), batch_size=8)
+
+        # the same updates, one seed at a time on the same batches
+        np.random.seed(0)
+        batches = [[replay_buffer.sample(8) for replay_buffer in replay_buffers] for _ in range(3)]
+        for k, policy in enumerate(policies):
+            member_batches = FixedBatches([batch[k] for batch in batches])
+            for _ in range(3):
+                policy.train(member_batches, batch_size=8)
+            trained = DDPG(3, 2, 1., torch.device('cpu'))
+            ensemble.unstack(k, trained)
+            for network in ['actor', 'critic']:
+                expected = getattr(policy, network).state_dict()
+                for name, tensor in getattr(trained, network).state_dict().items():
+                    # the batched matmuls only round differently
+                    np.testing.assert_allclose(tensor.numpy(), expected[name].numpy(), atol=1e-4)
+
+    def train_member(self, seeds):
+        # trains a BCQ ensemble of seeds, as train_BCQ_ensemble does, and returns the policy of its first member
+        replay_buffers = [collect(2 + k) for k in range(len(seeds))]
+        policies = []
+        for seed in seeds:
+            torch.manual_seed(seed)
+            policies.append(BCQ(3, 2, 1., torch.device('cpu')))
+        ensemble = EnsembleBCQ(policies, [torch.Generator().manual_seed(seed) for seed in seeds])
+        ensemble.train(StackedBuffers(replay_buffers, rngs=[np.random.RandomState(seed) for seed in seeds]),
+                       iterations=3, batch_size=8)
+        ensemble.unstack(0, policies[0])
+        return policies[0]
+
+    def test_member_trains_the_same_alone_and_in_a_larger_ensemble(self):
+        np.random.seed(0)
+        alone = self.train_member([0])
+        np.random.seed(1)
+        torch.manual_seed(1)
+        together = self.train_member([0, 1, 2])
+        for network in ['actor', 'critic', 'vae']:
+            expected = getattr(alone, network).state_dict()
+            for name, tensor in getattr(together, network).state_dict().items():
+                np.testing.assert_allclose(tensor.numpy(), expected[name].numpy(), atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
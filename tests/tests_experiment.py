@@ -0,0 +1,130 @@
+import copy
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import torch
+import xgboost as xgb
+import yaml
+import attack_trainer
+import run_pipeline
+from workers import attack
+from workers.attack import CLASSIFIER_FILE, PAIR_LAYOUT_FILE, TEST_PAIRS, TRAIN_EVAL_PAIRS, generate_attack_pairs, \
+    load_pairs, score_target_pairs
+from workers.experiment import run_classifier, run_experiments_v2, run_fused_experiment
+from fakes import write_buffers
+
+
+class AttackExperimentTestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.attack_path = self.tmp_dir.name
+        self.pair_path = f"{self.attack_path}/pairs"
+        os.makedirs(self.pair_path)
+        self.args = attack_trainer.get_parser().parse_args([
+            '--env', 'Fake-v0', '--num_models', '2', '--shadow_seeds', '1', '2', '--target_seeds', '11', '12',
+            '--env_seeds', '0', '1', '--max_traj_len', '6', '--bcq_max_timesteps', '5', '--attack_thresholds', '0.5',
+            '--attack_size', '5', '--xgb_n_rounds', '20', '--early_stopping_rounds', '3'])
+        write_buffers(self.attack_path, self.args)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def run_step(self, step, args=None, pair_path=None):
+        # seeded as attack_trainer.py seeds every run
+        args = args or self.args
+        np.random.seed(args.shadow_seeds[0])
+        step(self.attack_path, self.attack_path, pair_path or self.pair_path, 2, 2, torch.device('cpu'), args)
+
+    def test_saved_classifier_scores_the_target_pairs(self):
+        self.run_step(run_experiments_v2)
+        self.run_step(run_classifier)
+        scores_path = f"{self.attack_path}/scores"
+        os.makedirs(scores_path)
+        predictions, labels = score_target_pairs(self.attack_path, self.pair_path, scores_path, 2, 2,
+                                                 torch.device('cpu'), self.args)
+
+        # the first attack_size test pairs of every label, scored by the saved classifier
+        pairs = load_pairs(self.pair_path, TEST_PAIRS)
+        test_x = np.vstack([pairs['test_positive_x'][:5], pairs['test_negative_x'][:5]])
+        classifier = xgb.Booster(model_file=f"{self.pair_path}/{CLASSIFIER_FILE}")
+        np.testing.assert_array_equal(predictions, classifier.predict(xgb.DMatrix(test_x)))
+        np.testing.assert_array_equal(labels, [1] * 5 + [0] * 5)
+        saved = np.load(f"{scores_path}/target_scores.npz")
+        np.testing.assert_array_equal(saved['predictions'], predictions)
+        np.testing.assert_array_equal(saved['labels'], labels)
+
+    def test_pair_workers_are_deterministic(self):
+        # semi-correlated pairs shuffle the "in" trajectories, so they depend on the random state of every job
+        args = copy.copy(self.args)
+        args.correlation = 's'
+        runs = []
+        for pair_workers in [2, 2, 1]:
+            args.pair_workers = pair_workers
+            np.random.seed(pair_workers)
+            runs.append(generate_attack_pairs(self.attack_path, self.attack_path, 2, 2, torch.device('cpu'), args))
+        for run in runs[1:]:
+            self.assertEqual(list(run), TRAIN_EVAL_PAIRS + TEST_PAIRS)
+            for name, pairs in run.items():
+                np.testing.assert_array_equal(pairs, runs[0][name])
+
+    def test_fused_run_matches_the_separate_steps(self):
+        self.run_step(run_experiments_v2)
+        self.run_step(run_classifier)
+        for flag in ['save_pairs', 'stream_pairs']:
+            args = copy.copy(self.args)
+            setattr(args, flag, True)
+            fused_path = f"{self.attack_path}/{flag}"
+            os.makedirs(fused_path)
+            self.run_step(run_fused_experiment, args, fused_path)
+
+            for name, pairs in load_pairs(fused_path, TRAIN_EVAL_PAIRS + TEST_PAIRS).items():
+                np.testing.assert_array_equal(pairs, np.load(f"{self.pair_path}/{name}.npy"))
+            for filename in [CLASSIFIER_FILE, PAIR_LAYOUT_FILE]:
+                with open(f"{fused_path}/{filename}") as fused, open(f"{self.pair_path}/{filename}") as separate:
+                    self.assertEqual(fused.read(), separate.read())
+            curves = np.load(f"{fused_path}/roc_pr_curves.npz")
+            expected = np.load(f"{self.pair_path}/roc_pr_curves.npz")
+            for name in expected.files:
+                np.testing.assert_array_equal(curves[name], expected[name])
+
+    def test_failed_streaming_leaves_no_pair_files(self):
+        args = copy.copy(self.args)
+        args.stream_pairs = True
+        create_pairs = attack.create_pairs
+        calls = []
+
+        def failing_create_pairs(*pair_args, **kwargs):
+            # the first job streams its pairs, the second one fails
+            calls.append(None)
+            if len(calls) > 1:
+                raise RuntimeError("job failed")
+            return create_pairs(*pair_args, **kwargs)
+
+        with mock.patch.object(attack, 'create_pairs', failing_create_pairs):
+            with self.assertRaises(RuntimeError):
+                self.run_step(run_experiments_v2, args)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([filename for filename in os.listdir(self.pair_path) if '.npy' in filename], [])
+
+
+class PipelineStagesTestSuite(unittest.TestCase):
+    def stage_args(self, **attack_trainer_flags):
+        with open(os.path.join(os.path.dirname(run_pipeline.__file__), 'pipeline_config.yaml')) as f:
+            config = yaml.safe_load(f)
+        config['attack_trainer'].update(attack_trainer_flags)
+        return {stage.name: stage.args for stage in run_pipeline.build_stages(config)}
+
+    def test_classifier_arguments_only_change_the_classifier_key(self):
+        expected = self.stage_args()
+        for flags in [{'attack_thresholds': [0.4]}, {'xgb_n_rounds': 50}]:
+            changed = [name for name, args in self.stage_args(**flags).items() if args != expected[name]]
+            # the pairs stay current (or are restored from the cache), only the classifier is retrained
+            self.assertEqual(changed, ['train_classifier/Hopper-v3/1000'])
+        changed = [name for name, args in self.stage_args(attack_size=500).items() if args != expected[name]]
+        self.assertEqual(changed, ['create_pairs/Hopper-v3/1000', 'train_classifier/Hopper-v3/1000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
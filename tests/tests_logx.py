@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+from utils.logx import StreamingStatistics
+from utils.mpi_tools import merge_statistics, mpi_statistics_scalar
+
+
+class StreamingStatisticsTestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        # batches of different sizes, as stored by the training loops
+        self.batches = [rng.normal(3., 2., size=size) for size in [1, 7, 0, 100, 1000, 3]]
+        self.values = np.concatenate(self.batches)
+
+    def test_statistics_match_numpy(self):
+        stats = StreamingStatistics()
+        for batch in self.batches:
+            stats.update(batch)
+        self.assertEqual(stats.count, len(self.values))
+        self.assertAlmostEqual(stats.mean, self.values.mean())
+        self.assertAlmostEqual(np.sqrt(stats.m2 / stats.count), self.values.std())
+        self.assertEqual((stats.min, stats.max), (self.values.min(), self.values.max()))
+        # the same statistics as the stored values
+        mean, std, min_, max_ = mpi_statistics_scalar(stats, with_min_and_max=True)
+        expected = mpi_statistics_scalar(self.values, with_min_and_max=True)
+        np.testing.assert_allclose([mean, std, min_, max_], expected, rtol=1e-5)
+
+    def test_reservoir_is_bounded(self):
+        stats = StreamingStatistics(reservoir_size=50)
+        stats.update(self.values[:20])
+        np.testing.assert_array_equal(stats.samples, self.values[:20])
+        for batch in self.batches:
+            stats.update(batch)
+        self.assertEqual(stats.samples.shape, (50,))
+        self.assertTrue(np.isin(stats.samples, self.values).all())
+
+    def test_merged_statistics(self):
+        parts = [self.values[:300], self.values[300:], self.values[:0]]
+        count, mean, m2 = merge_statistics([len(part) for part in parts],
+                                           [part.mean() if len(part) else 0. for part in parts],
+                                           [((part - part.mean())**2).sum() if len(part) else 0. for part in parts])
+        self.assertEqual(count, len(self.values))
+        self.assertAlmostEqual(mean, self.values.mean())
+        self.assertAlmostEqual(m2, ((self.values - self.values.mean())**2).sum(), places=6)
+        self.assertEqual(merge_statistics([0], [0.], [0.]), (0., 0., 0.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import unittest
+from utils.cache import StageCache
+from utils.scheduler import Stage, run_stages
+
+
+class SchedulerTestSuite(unittest.TestCase):
+    def touch(self, filename):
+        return [sys.executable, '-c', f"open({filename!r}, 'w').close()"]
+
+    def test_stages_run_in_dependency_order_and_skip_existing_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            def stage(name, depends_on=()):
+                return Stage(name, self.touch(f"{tmp_dir}/{name}"), [f"{tmp_dir}/{name}"], depends_on)
+
+            # b and c only run after a, and d after both
+            stages = run_stages([stage('d', ['b', 'c']), stage('b', ['a']), stage('c', ['a']), stage('a')], cpus=2,
+                                poll_interval=0.01)
+            self.assertEqual([stage.status for stage in stages], ['done'] * 4)
+            self.assertTrue(all(os.path.getmtime(f"{tmp_dir}/d") >= os.path.getmtime(f"{tmp_dir}/{name}")
+                                for name in 'abc'))
+
+            stages = run_stages([stage('a'), stage('b', ['a'])], cpus=2, poll_interval=0.01)
+            self.assertEqual([stage.status for stage in stages], ['skipped'] * 2)
+            # a stage runs again when a stage it depends on ran
+            os.remove(f"{tmp_dir}/a")
+            stages = run_stages([stage('a'), stage('b', ['a'])], cpus=2, poll_interval=0.01)
+            self.assertEqual([stage.status for stage in stages], ['done'] * 2)
+
+            stages = run_stages([Stage('e', [sys.executable, '-c', 'exit(1)'], [f"{tmp_dir}/e"]), stage('f', ['e'])],
+                                cpus=2, poll_interval=0.01)
+            self.assertEqual([stage.status for stage in stages], ['failed', 'blocked'])
+            self.assertFalse(os.path.exists(f"{tmp_dir}/f"))
+
+            with self.assertRaises(ValueError):
+                run_stages([stage('g', ['h']), stage('h', ['g'])], cpus=2, poll_interval=0.01)
+
+    def test_interrupted_stages_are_not_complete(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the stage writes its output, then fails before the end
+            write_then_fail = f"open({tmp_dir + '/a'!r}, 'w').close(); exit(int(open({tmp_dir + '/fail'!r}).read()))"
+
+            def statuses(fail):
+                with open(f"{tmp_dir}/fail", 'w') as f:
+                    f.write(str(fail))
+                stages = [Stage('a', [sys.executable, '-c', write_then_fail], [f"{tmp_dir}/a"],
+                                marker=f"{tmp_dir}/markers/a.complete")]
+                return [stage.status for stage in run_stages(stages, cpus=1, poll_interval=0.01)]
+
+            self.assertEqual(statuses(1), ['failed'])
+            self.assertTrue(os.path.exists(f"{tmp_dir}/a"))
+            self.assertEqual(statuses(0), ['done'])
+            self.assertEqual(statuses(0), ['skipped'])
+            # a rerun deletes the marker until it completes
+            os.remove(f"{tmp_dir}/a")
+            self.assertEqual(statuses(1), ['failed'])
+            self.assertEqual(statuses(1), ['failed'])
+
+    def test_cached_stages_are_keyed_on_args_and_inputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = StageCache(f"{tmp_dir}/cache", max_bytes=10)
+
+            def stages(size):
+                write = f"open({tmp_dir + '/pairs'!r}, 'w').write('x' * {size})"
+                return [Stage('pairs', [sys.executable, '-c', write], [f"{tmp_dir}/pairs"], args={'size': size},
+                              store=True),
+                        Stage('classifier', self.touch(f"{tmp_dir}/classifier"), [f"{tmp_dir}/classifier"], ['pairs'])]
+
+            def statuses(size):
+                return [stage.status for stage in run_stages(stages(size), cpus=1, poll_interval=0.01, cache=cache)]
+
+            self.assertEqual(statuses(4), ['done', 'done'])
+            self.assertEqual(statuses(4), ['skipped', 'skipped'])
+            # the outputs exist, but for other args
+            self.assertEqual(statuses(5), ['done', 'done'])
+            # the pairs of the first args are restored, the classifier reruns on them
+            self.assertEqual(statuses(4), ['restored', 'done'])
+            with open(f"{tmp_dir}/pairs") as f:
+                self.assertEqual(f.read(), 'xxxx')
+            # the least recently used pairs are evicted to fit in max_bytes
+            self.assertEqual(statuses(6), ['done', 'done'])
+            self.assertEqual(len(os.listdir(f"{tmp_dir}/cache/objects")), 2)
+            self.assertEqual(statuses(5), ['done', 'done'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+from BCQutils import ReplayBuffer
+from fakes import collect
+
+
+class ReplayBufferTestSuite(unittest.TestCase):
+    def test_device_copy_and_prefetch_sample_the_same_batches(self):
+        replay_buffer = collect(2)
+        np.random.seed(0)
+        expected = [replay_buffer.sample(8) for _ in range(5)]
+        replay_buffer.to_device()
+        replay_buffer.prefetch = 2
+        np.random.seed(0)
+        for batch, expected_batch in zip(replay_buffer.sample_batches(5, 8), expected):
+            for tensor, expected_tensor in zip(batch, expected_batch):
+                self.assertTrue(torch.equal(tensor, expected_tensor))
+        # exactly the 5 batches were sampled
+        after = np.random.randint(1000)
+        np.random.seed(0)
+        for _ in range(5):
+            np.random.randint(0, replay_buffer.size, size=8)
+        self.assertEqual(np.random.randint(1000), after)
+
+    def test_sampling_an_empty_lazy_buffer_raises(self):
+        replay_buffer = ReplayBuffer(3, 2, 'cpu', max_size=10, lazy=True)
+        with self.assertRaisesRegex(ValueError, 'empty replay buffer'):
+            replay_buffer.sample(4)
+        replay_buffer.add(np.zeros(3), np.zeros(2), np.zeros(3), 0., False)
+        self.assertEqual(replay_buffer.sample(4)[0].shape, (4, 3))
+
+    def test_load_keeps_the_reset_states(self):
+        replay_buffer = collect(2)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            replay_buffer.save(os.path.join(tmp_dir, 'buffer'))
+            loaded = ReplayBuffer(3, 2, 'cpu', max_size=replay_buffer.max_size)
+            loaded.load(os.path.join(tmp_dir, 'buffer'))
+        self.assertGreater(len(replay_buffer.reset_state), 1)
+        np.testing.assert_array_equal(loaded.reset_state, replay_buffer.reset_state)
+        np.testing.assert_array_equal(loaded.initial_state, replay_buffer.initial_state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import numpy as np
+import torch
+from BCQ import BCQ
+from utils.rollout import policy_rollouts, run_episodes
+from fakes import FakeEnv, FakePolicy, collect
+
+
+class RolloutTestSuite(unittest.TestCase):
+    def test_trajectory_bookkeeping(self):
+        replay_buffer = collect(3)
+        self.assertEqual(replay_buffer.size, 50)
+        # the initial states are those of a sequential rollout of an environment seeded with env_seed
+        env = FakeEnv()
+        env.seed(0)
+        expected = [env.reset() for _ in replay_buffer.initial_state]
+        np.testing.assert_array_equal(replay_buffer.initial_state, expected)
+        # every trajectory starts from its initial state, and the last transition ends the last trajectory
+        self.assertEqual(replay_buffer.trajectory_end_index[-1], 49)
+        self.assertEqual(len(replay_buffer.initial_state), replay_buffer.num_trajectories)
+        starts = [0] + [end + 1 for end in replay_buffer.trajectory_end_index[:-1]]
+        np.testing.assert_array_equal(replay_buffer.state[starts], expected)
+        ends = np.where(replay_buffer.not_done[:, 0] == 0)[0]
+        np.testing.assert_array_equal(ends, replay_buffer.trajectory_end_index)
+
+    def test_reproducible_for_any_number_of_envs(self):
+        reference = collect(1)
+        for num_envs in [1, 4]:
+            replay_buffer = collect(num_envs)
+            for name in ['state', 'action', 'next_state', 'reward', 'not_done', 'initial_state',
+                         'trajectory_end_index']:
+                np.testing.assert_array_equal(getattr(replay_buffer, name), getattr(reference, name))
+
+    def test_policy_rollouts_from_reset_states(self):
+        replay_buffer = collect(3)
+        reset_states = np.array(replay_buffer.reset_state)
+        initial_states = np.array(replay_buffer.initial_state)
+        episodes = [policy_rollouts(FakeEnv, 0, FakePolicy, 1, 1., reset_states, initial_states, workers)
+                    for workers in [1, 2]]
+        self.assertEqual(len(episodes[0]), len(initial_states))
+        for episode, other, initial_state in zip(episodes[0], episodes[1], initial_states):
+            np.testing.assert_array_equal(episode[0][0], initial_state)
+            self.assertEqual(episode[4][-1], 1.)
+            for column, other_column in zip(episode, other):
+                np.testing.assert_array_equal(column, other_column)
+        with self.assertRaises(ValueError):
+            policy_rollouts(FakeEnv, 0, FakePolicy, 1, 1., reset_states[::-1], initial_states, 1)
+
+    def test_lockstep_episodes(self):
+        reset_states = collect(3).reset_state[:5]
+        envs = [FakeEnv() for _ in reset_states]
+        for env in envs:
+            env.seed(0)
+        generators = lambda: [torch.Generator().manual_seed(k) for k in range(len(reset_states))]
+        episodes = run_episodes(envs, FakePolicy(), reset_states, generators=generators())
+        for k, episode in enumerate(episodes):
+            alone = run_episodes(envs[:1], FakePolicy(), reset_states[k:k + 1], generators=generators()[k:k + 1])[0]
+            for column, alone_column in zip(episode, alone):
+                np.testing.assert_array_equal(column, alone_column)
+
+    def test_batched_bcq_actions(self):
+        policy = BCQ(3, 2, 1., torch.device('cpu'))
+        states = np.random.RandomState(0).normal(size=(4, 3))
+        actions = policy.select_actions(states, [torch.Generator().manual_seed(k) for k in range(4)])
+        self.assertEqual(actions.shape, (4, 2))
+        for k, state in enumerate(states):
+            torch.manual_seed(k)
+            np.testing.assert_array_equal(actions[k], policy.select_action(state))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import functools
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from BCQ import BCQ
+from runner_v2 import bcq_state_dicts, eval_policy, init_eval_worker, make_bcq, worker_eval_policy
+from utils.rollout import get_reset_state
+from fakes import FakeEnv, FakePolicy
+
+
+class RecordingPolicy(FakePolicy):
+    """FakePolicy keeping the initial states of the episodes it is evaluated on"""
+
+    def __init__(self):
+        self.initial_states = []
+        self.steps = 0
+
+    def select_actions(self, states, generators=None):
+        if self.steps == 0:
+            self.initial_states.extend(states)
+        self.steps += 1
+        return super().select_actions(states, generators)
+
+
+class EvalPolicyTestSuite(unittest.TestCase):
+    def test_consecutive_evaluations_start_from_consecutive_resets(self):
+        eval_env = FakeEnv()
+        eval_env.seed(100)
+        copies = [FakeEnv() for _ in range(10)]
+        for env in copies:
+            env.seed(0)
+        initial_states = []
+        for _ in range(2):
+            policy = RecordingPolicy()
+            eval_policy(policy, None, 0, 0, eval_env, max_episode_step=10, envs=copies)
+            initial_states.extend(policy.initial_states)
+
+        reference = FakeEnv()
+        reference.seed(100)
+        expected = [reference.reset() for _ in range(20)]
+        np.testing.assert_array_equal(initial_states, expected)
+        self.assertEqual(len(np.unique(initial_states, axis=0)), 20)
+
+    def test_background_evaluations_match_the_in_process_ones(self):
+        weights = []
+        for k in range(3):
+            torch.manual_seed(k)
+            weights.append(bcq_state_dicts(BCQ(3, 2, 1., torch.device('cpu'))))
+        eval_seeds = [[10 * k + episode for episode in range(10)] for k in range(3)]
+        generators = lambda seeds: [torch.Generator().manual_seed(seed) for seed in seeds]
+
+        eval_env = FakeEnv()
+        eval_env.seed(100)
+        copies = [FakeEnv() for _ in range(10)]
+        for env in copies:
+            env.seed(0)
+        expected = []
+        for state_dicts, seeds in zip(weights, eval_seeds):
+            avg_reward = eval_policy(make_bcq(3, 2, 1., 0.05, state_dicts), None, 0, 0, eval_env, max_episode_step=10,
+                                     generators=generators(seeds), envs=copies)
+            expected.append((avg_reward, get_reset_state(eval_env)))
+
+        eval_env = FakeEnv()
+        eval_env.seed(100)
+        with ProcessPoolExecutor(max_workers=1, initializer=init_eval_worker, initargs=(
+                FakeEnv, 0, functools.partial(make_bcq, 3, 2, 1., 0.05, weights[0]), get_reset_state(eval_env))) \
+                as evaluator:
+            results = [evaluator.submit(worker_eval_policy, state_dicts, None, 0, 0, 10, seeds).result()
+                       for state_dicts, seeds in zip(weights, eval_seeds)]
+        for (avg_reward, reset_state), (expected_reward, expected_reset_state) in zip(results, expected):
+            self.assertEqual(avg_reward, expected_reward)
+            np.testing.assert_array_equal(reset_state, expected_reset_state)
+
+
+if __name__ == '__main__':
+    unittest.main()
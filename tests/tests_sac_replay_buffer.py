@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+import torch
+from ddpg import ddpg
+from sac import sac
+
+
+class SacReplayBufferTestSuite(unittest.TestCase):
+    def fill(self, module, size=40, steps=30):
+        rng = np.random.RandomState(0)
+        replay_buffer = module.ReplayBuffer(3, 2, size)
+        for _ in range(steps):
+            replay_buffer.store(rng.normal(size=3), rng.normal(size=2), rng.normal(), rng.normal(size=3),
+                                rng.rand() < 0.1)
+        return replay_buffer
+
+    def test_sample_batches_are_sequential_sample_batch_calls(self):
+        for module in [sac, ddpg]:
+            replay_buffer = self.fill(module)
+            np.random.seed(0)
+            expected = [replay_buffer.sample_batch(8) for _ in range(5)]
+            after = np.random.randint(1000)
+            np.random.seed(0)
+            batches = list(replay_buffer.sample_batches(8, 5))
+            # the random state moved on as much as with the sample_batch calls
+            self.assertEqual(np.random.randint(1000), after)
+            self.assertEqual(len(batches), 5)
+            for batch, expected_batch in zip(batches, expected):
+                self.assertEqual(batch.keys(), expected_batch.keys())
+                for k, tensor in batch.items():
+                    self.assertEqual(tensor.dtype, torch.float32)
+                    self.assertTrue(torch.equal(tensor, expected_batch[k]))
+
+    def test_tensors_share_the_buffer_memory(self):
+        for module in [sac, ddpg]:
+            # the buffer wraps around, so stored rows overwrite old ones
+            replay_buffer = self.fill(module, size=10)
+            for k, buf in [('obs', replay_buffer.obs_buf), ('obs2', replay_buffer.obs2_buf),
+                           ('act', replay_buffer.act_buf), ('rew', replay_buffer.rew_buf),
+                           ('done', replay_buffer.done_buf)]:
+                np.testing.assert_array_equal(replay_buffer.tensors[k].numpy(), buf)
+                self.assertEqual(replay_buffer.tensors[k].data_ptr(), buf.ctypes.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import gym
+import numpy as np
+from utils.rollout import get_reset_state, restore_reset_state
+from utils.synthetic_env import SYNTHETIC_ENV, register_synthetic_env
+
+
+class SyntheticEnvTestSuite(unittest.TestCase):
+    def rollout(self, env, actions):
+        state, done, states = env.reset(), False, []
+        for action in actions:
+            states.append(state)
+            state, _, done, _ = env.step(action)
+            if done:
+                break
+        return np.array(states)
+
+    def test_episodes_are_reproducible_from_their_reset_state(self):
+        register_synthetic_env('SyntheticControlTest-v0', state_dim=5, action_dim=2, max_episode_steps=50)
+        env = gym.make('SyntheticControlTest-v0')
+        self.assertEqual(env.observation_space.shape, (5,))
+        self.assertEqual(env.action_space.shape, (2,))
+        env.seed(0)
+        actions = np.random.RandomState(0).uniform(-1, 1, size=(50, 2))
+        self.rollout(env, actions)
+        reset_state = get_reset_state(env)
+        episode = self.rollout(env, actions)
+        self.assertLessEqual(len(episode), 50)
+
+        other_env = gym.make('SyntheticControlTest-v0')
+        restore_reset_state(other_env, reset_state)
+        np.testing.assert_array_equal(self.rollout(other_env, actions), episode)
+
+    def test_default_environment_is_registered(self):
+        env = gym.make(SYNTHETIC_ENV)
+        self.assertEqual(env.observation_space.shape, (11,))
+        self.assertEqual(env._max_episode_steps, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from trainer import EPOCH_LENGTH, throughput_report, train_shadow_models
+from utils.synthetic_env import SYNTHETIC_ENV
+from utils.trajectory_recorder import load_trajectories
+
+
+class ShadowModelsTestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        # the shadow models are written under ./output
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def trajectories(self, seed):
+        path = f"output/{SYNTHETIC_ENV}/sac/TimeSteps_{EPOCH_LENGTH}/seed_{seed}/maxEpLen_50"
+        return [np.array(column) for name in ['trajectories', 'trajectories_test']
+                for column in load_trajectories(f"{path}/{name}")]
+
+    def test_outputs_do_not_depend_on_the_number_of_workers(self):
+        outputs = []
+        for workers in [1, 2]:
+            runs = train_shadow_models('sac', SYNTHETIC_ENV, [0, 1], EPOCH_LENGTH, 50, workers)
+            self.assertEqual([run['seed'] for run in runs], [0, 1])
+            self.assertEqual(runs[0]['train_steps'], EPOCH_LENGTH)
+            outputs.append([self.trajectories(seed) for seed in [0, 1]])
+        for columns, other_columns in zip(*outputs):
+            for column, other_column in zip(columns, other_columns):
+                np.testing.assert_array_equal(column, other_column)
+        self.assertEqual(len(throughput_report(runs).split('\n')), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from utils.helpers import format_trajectory
+from utils.trajectory_recorder import TrajectoryRecorder, load_trajectories
+
+
+class TrajectoryTestSuite(unittest.TestCase):
+    def test_recorded_columns(self):
+        rng = np.random.RandomState(0)
+        steps = [(rng.normal(size=3), rng.normal(size=2), rng.normal(), k % 4 == 0) for k in range(10)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for chunk_size in [None, 3]:
+                recorder = TrajectoryRecorder(os.path.join(tmp_dir, f'{chunk_size}/trajectories'), 3, 2, len(steps),
+                                              chunk_size=chunk_size)
+                for step in steps:
+                    recorder.record(*step)
+                recorder.close()
+            legacy = os.path.join(tmp_dir, 'legacy')
+            np.save(legacy + '.npy', np.asarray(steps, dtype=object))
+            columns = [load_trajectories(os.path.join(tmp_dir, f'{chunk_size}/trajectories'))
+                       for chunk_size in [None, 3]] + [load_trajectories(legacy)]
+
+        for obs, act, rew, done in columns:
+            self.assertEqual(obs.dtype, np.float32)
+            np.testing.assert_array_equal(obs, np.float32([step[0] for step in steps]))
+            np.testing.assert_array_equal(act, np.float32([step[1] for step in steps]))
+            np.testing.assert_array_equal(rew[:, 0], np.float32([step[2] for step in steps]))
+            np.testing.assert_array_equal(done[:, 0], [step[3] for step in steps])
+        # done at steps 0, 4 and 8: an empty trajectory and two of 3 steps, padded to 5 steps of 3 + 2 + 1 values
+        # with the obs of their done step (the step after the last done step is dropped)
+        formatted = format_trajectory(5, columns[0], seed=0).reshape(2, 5, 6)
+        expected = np.zeros((3, 5, 6), dtype=np.float32)
+        expected[:, :, :3] = columns[0][0][[0, 4, 8]][:, None]
+        for k, start in [(1, 1), (2, 5)]:
+            expected[k, :3] = np.concatenate([column[start:start + 3] for column in columns[0][:3]], axis=1)
+        self.assertTrue(all(any((trajectory == other).all() for other in expected) for trajectory in formatted))
+
+    def test_empty_trajectories(self):
+        columns = (np.zeros((0, 3), np.float32), np.zeros((0, 2), np.float32), np.zeros((0, 1), np.float32),
+                   np.zeros((0, 1), bool))
+        self.assertEqual(format_trajectory(5, columns, seed=0).shape, (0, 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
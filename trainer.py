@@ -1,17 +1,31 @@
 import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import torch
 import gym
 import argparse
-import numpy as np
 from sac.sac import sac
 from ddpg.ddpg import ddpg
+from utils import synthetic_env  # registers SyntheticControl-v0 (no MuJoCo needed) with gym
+from utils.trajectory_recorder import TrajectoryRecorder
+
+# environment steps of every sac/ddpg epoch: the shadow models are trained for the whole epochs in timesteps
+EPOCH_LENGTH = 2000
 
 
 def output_model(model, environment, seed, timesteps, max_ep_length):
     path = './output/' + environment + '/' + model + '/TimeSteps_' + str(timesteps) + '/seed_' + str(seed) + '/maxEpLen_' + str(max_ep_length) + '/trajectories'
-    epoch_length = 2000
+    epoch_length = EPOCH_LENGTH
     epochs = int(timesteps / epoch_length)
-    env_fn = lambda: gym.make(environment)
+
+    def env_fn():
+        # seeded (with the random actions of the first steps), so the training only depends on seed
+        env = gym.make(environment)
+        env.seed(seed)
+        env.action_space.seed(seed)
+        return env
+
     logger_kwargs = dict(output_dir='output/' + environment + '/' + model + '/TimeSteps_' + str(timesteps) + '/seed_' + str(seed) + '/maxEpLen_' + str(max_ep_length),
                          exp_name = environment + '_shadow_' + str(seed))
     if model == 'sac':
@@ -27,42 +41,85 @@ def output_model(model, environment, seed, timesteps, max_ep_length):
         exit(-1)
 
 
-def generate_test_pkl(environment, model, seed, timesteps, max_ep_length):
-    path = 'output/' + environment + '/' + args.m + '/TimeSteps_' + str(timesteps) + '/seed_' + str(seed) + '/maxEpLen_' + str(max_ep_length)
+def generate_test_pkl(environment, model, seed, timesteps, max_ep_length, model_name):
+    path = 'output/' + environment + '/' + model_name + '/TimeSteps_' + str(timesteps) + '/seed_' + str(seed) + '/maxEpLen_' + str(max_ep_length)
     env = gym.make(environment)
     env.seed(seed)
+    # the actions are sampled from the policy
+    torch.manual_seed(seed)
     obs, reward, d = env.reset(), 0, False
-    trajectories = []
-    append = trajectories.append
+    trajectories = TrajectoryRecorder(path + '/trajectories_test', env.observation_space.shape[0],
+                                      env.action_space.shape[0], timesteps)
     for i in range(0, timesteps):
         action = model.act(torch.as_tensor(obs, dtype=torch.float32))
-        append((obs, action, reward, d))
+        trajectories.record(obs, action, reward, d)
         obs2, reward, d, _ = env.step(action)
         obs = obs2
 
         if d:  # reset env if done
             obs = env.reset()
-    np.save(path + '/trajectories_test.npy', np.asarray(trajectories))
+    trajectories.close()
 
 
 def train_shadow_model(model, environment, seed, timesteps, max_ep_length):
+    """
+    Trains the shadow model of seed and records its test trajectories. Returns the number of steps and the wall time
+    of both
+    """
     #I have to add BCQ here
     #BCQ reads from the batch folder stored here in buffer folder
-    if not os.path.exists('output'):
-        os.mkdir('output')
+    os.makedirs('output', exist_ok=True)
+    start = time.time()
     output_model(model, environment, seed, timesteps, max_ep_length)
+    train_time = time.time() - start
     trained_model = torch.load('output/' + environment + '/' + model + '/TimeSteps_' + str(timesteps) + '/seed_' + str(seed) + '/maxEpLen_' + str(max_ep_length) + '/pyt_save/model.pt')
-    generate_test_pkl(environment, trained_model, seed, timesteps, max_ep_length)
+    start = time.time()
+    generate_test_pkl(environment, trained_model, seed, timesteps, max_ep_length, model)
+    return {'seed': seed, 'train_steps': int(timesteps / EPOCH_LENGTH) * EPOCH_LENGTH, 'train_time': train_time,
+            'test_steps': timesteps, 'test_time': time.time() - start}
+
+
+def init_shadow_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def train_shadow_models(model, environment, seeds, timesteps, max_ep_length, workers=1):
+    """
+    Runs train_shadow_model for every seed, in workers processes sharing the CPUs when workers > 1. Every seed is
+    seeded on its own, so its outputs do not depend on the number of workers. Returns the runs of the seeds, in order.
+    """
+    if workers <= 1:
+        return [train_shadow_model(model, environment, seed, timesteps, max_ep_length) for seed in seeds]
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    # spawned rather than forked, so that no worker inherits the MPI state of the parent
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'), initializer=init_shadow_worker,
+                             initargs=(num_threads,)) as executor:
+        futures = [executor.submit(train_shadow_model, model, environment, seed, timesteps, max_ep_length)
+                   for seed in seeds]
+        return [future.result() for future in futures]
+
+
+def throughput_report(runs):
+    lines = ['seed    train time (s)    steps/s    test time (s)    steps/s']
+    for run in runs:
+        lines.append('%-7d %14.1f %10.1f %16.1f %10.1f' % (
+            run['seed'], run['train_time'], run['train_steps'] / run['train_time'], run['test_time'],
+            run['test_steps'] / run['test_time']))
+    return '\n'.join(lines)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-e', help="the environment you are in", default="HalfCheetah-v2")
-    parser.add_argument('-m', help="the DRL model you wish to use", default="sac")
+    parser.add_argument('-m', help="the DRL model you wish to use", default="sac", choices=['sac', 'ddpg'])
     parser.add_argument('--timesteps', type=int)
     parser.add_argument('--seeds', nargs='+')
-    parser.add_argument('--max_ep_length', default = 1000)
+    parser.add_argument('--max_ep_length', default = 1000, type=int)
+    parser.add_argument('--workers', default=1, type=int, help="number of seeds trained in parallel processes")
     args = parser.parse_args()
 
-    for seed in args.seeds:
-        train_shadow_model(args.m, args.e, int(seed), args.timesteps, args.max_ep_length)
+    start = time.time()
+    runs = train_shadow_models(args.m, args.e, [int(seed) for seed in args.seeds], args.timesteps, args.max_ep_length,
+                               args.workers)
+    print(throughput_report(runs))
+    print('Trained %d seeds in %.1fs' % (len(runs), time.time() - start))
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# bytes read at a time when hashing a file
+DIGEST_CHUNK = 1 << 20
+
+
+def file_signature(path):
+    """(size, modification time) of a file, None if it does not exist"""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def args_digest(args):
+    """Hash of a {name: value} dict of arguments, independent of their order"""
+    return hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def read_json(filename, default):
+    if not os.path.exists(filename):
+        return default
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def write_json(filename, data):
+    """Writes data to filename through a temporary file, so an interrupted write leaves the previous version"""
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(filename + '.tmp', filename)
+
+
+class StageCache(object):
+    """
+    Content-addressed cache of the pipeline stages (see utils.scheduler), under cache_dir.
+
+    The key of a stage hashes its name, the arguments that affect its outputs (stage.args) and the content of its
+    input files, so it changes whenever anything the stage computes from changes. After a stage runs, its key is
+    recorded with the size and modification time of its outputs; the stage is then current, and skipped, as long as
+    its key and outputs are unchanged. The outputs of the stages with stage.store set (e.g. the pair sets) are also
+    copied under objects/<key>, and copied back when the stage needs a key it ran with before, instead of rerunning.
+    The least recently used objects are evicted once they take more than max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        for folder in ['stages', 'objects']:
+            if not os.path.exists(f"{cache_dir}/{folder}"):
+                os.makedirs(f"{cache_dir}/{folder}")
+        # path -> [size, modification time, sha256] of the files hashed so far
+        self.digests = read_json(f"{cache_dir}/digests.json", {})
+
+    def file_digest(self, path):
+        """Hash of the content of a file (None if it does not exist), recomputed only when the file changed"""
+        signature = file_signature(path)
+        if signature is None:
+            return None
+        if path in self.digests and self.digests[path][:2] == signature:
+            return self.digests[path][2]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DIGEST_CHUNK), b''):
+                sha256.update(chunk)
+        self.digests[path] = signature + [sha256.hexdigest()]
+        write_json(f"{self.cache_dir}/digests.json", self.digests)
+        return sha256.hexdigest()
+
+    def key(self, stage):
+        return args_digest({'stage': stage.name, 'args': stage.args,
+                            'inputs': {path: self.file_digest(path) for path in stage.inputs}})
+
+    def record_file(self, stage):
+        return f"{self.cache_dir}/stages/{stage.name.replace('/', '_')}.json"
+
+    def is_current(self, stage, key):
+        """True if the outputs of stage are those of its last run, with key"""
+        record = read_json(self.record_file(stage), None)
+        return record is not None and record['key'] == key and all(
+            file_signature(output) == record['outputs'].get(output) for output in stage.outputs)
+
+    def record(self, stage, key):
+        """Records that the outputs of stage are those of key"""
+        write_json(self.record_file(stage), {
+            'key': key, 'outputs': {output: file_signature(output) for output in stage.outputs}})
+
+    def store(self, stage, key):
+        """Copies the outputs of stage under objects/<key>, then evicts the least recently used objects"""
+        object_dir = f"{self.cache_dir}/objects/{key}"
+        if not os.path.exists(object_dir):
+            os.makedirs(object_dir)
+        for k, output in enumerate(stage.outputs):
+            shutil.copy2(output, f"{object_dir}/{k}_{os.path.basename(output)}")
+        write_json(f"{object_dir}/manifest.json", {'stage': stage.name, 'outputs': stage.outputs,
+                                                   'last_used': time.time()})
+        self.evict()
+
+    def restore(self, stage, key):
+        """Copies the stored outputs of stage for key back in place. Returns False if they are not stored"""
+        object_dir = f"{self.cache_dir}/objects/{key}"
+        manifest = read_json(f"{object_dir}/manifest.json", None)
+        if manifest is None or manifest['outputs'] != stage.outputs:
+            return False
+        for k, output in enumerate(stage.outputs):
+            if not os.path.exists(os.path.dirname(output)):
+                os.makedirs(os.path.dirname(output))
+            shutil.copy2(f"{object_dir}/{k}_{os.path.basename(output)}", output)
+        self.touch(key)
+        self.record(stage, key)
+        return True
+
+    def touch(self, key):
+        """Marks the stored object of key (if any) as just used, so it is evicted last"""
+        manifest = read_json(f"{self.cache_dir}/objects/{key}/manifest.json", None)
+        if manifest is not None:
+            manifest['last_used'] = time.time()
+            write_json(f"{self.cache_dir}/objects/{key}/manifest.json", manifest)
+
+    def evict(self):
+        """Deletes the least recently used objects until their outputs take at most max_bytes"""
+        objects = []
+        for key in os.listdir(f"{self.cache_dir}/objects"):
+            object_dir = f"{self.cache_dir}/objects/{key}"
+            manifest = read_json(f"{object_dir}/manifest.json", {'last_used': 0})
+            size = sum(os.path.getsize(f"{object_dir}/{name}") for name in os.listdir(object_dir)
+                       if name != 'manifest.json')
+            objects.append((manifest['last_used'], size, object_dir))
+        total = sum(size for _, size, _ in objects)
+        for _, size, object_dir in sorted(objects):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(object_dir)
+            total -= size
+            logger.info(f"evicted {object_dir} ({size / 2 ** 20:.1f} MB) from the stage cache")
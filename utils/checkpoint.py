@@ -0,0 +1,115 @@
+import copy
+import os
+import pickle
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Copy of obj (e.g. a dict of state dicts) with every tensor copied to the cpu, that the training cannot change"""
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    """States of the numpy and torch global random generators"""
+    return {'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def write_checkpoint(filename, checkpoint):
+    """Writes checkpoint to a temporary file renamed to filename, so that filename always holds a whole checkpoint"""
+    with open(f"{filename}.tmp", 'wb') as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{filename}.tmp", filename)
+
+
+def rows_file(filename, k):
+    return f"{filename}_rows_{k}"
+
+
+def load_checkpoint(filename):
+    """
+    The checkpoint saved in filename, or None if there is none. The rows saved with it (see CheckpointWriter.save) are
+    concatenated, column by column, into checkpoint['rows'].
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        checkpoint = pickle.load(f)
+    if 'num_chunks' in checkpoint:
+        chunks = []
+        for k in range(checkpoint['num_chunks']):
+            with open(rows_file(filename, k), 'rb') as f:
+                chunks.append(pickle.load(f))
+        checkpoint['rows'] = [np.concatenate(columns) for columns in zip(*chunks)]
+    return checkpoint
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints to filename in a background thread. The checkpoint is copied (see snapshot) before save
+    returns, so the training can go on while it is written.
+
+    Data that is only appended to (e.g. the transitions of a replay buffer that never wraps) can be saved as the rows
+    added since the previous checkpoint: every save writes them to a file of their own, so they are copied and written
+    once instead of at every checkpoint.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread = None
+        self.error = None
+        # files of rows written so far
+        self.num_chunks = 0
+
+    def _write(self, checkpoint, new_rows):
+        try:
+            if new_rows is not None:
+                # the rows are written before the checkpoint referring to them
+                write_checkpoint(rows_file(self.filename, checkpoint['num_chunks'] - 1), new_rows)
+            write_checkpoint(self.filename, checkpoint)
+        except Exception as e:
+            self.error = e
+
+    def load(self):
+        """load_checkpoint of filename, after which save goes on appending rows to the ones of the checkpoint"""
+        checkpoint = load_checkpoint(self.filename)
+        self.num_chunks = checkpoint.get('num_chunks', 0) if checkpoint is not None else 0
+        return checkpoint
+
+    def save(self, checkpoint, new_rows=None):
+        """Saves checkpoint, with the (list of arrays of) rows added since the previous save if given"""
+        checkpoint = snapshot(checkpoint)
+        if new_rows is not None:
+            new_rows = snapshot(new_rows)
+            self.num_chunks += 1
+            checkpoint['num_chunks'] = self.num_chunks
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(checkpoint, new_rows))
+        self.thread.start()
+
+    def wait(self):
+        """Waits for the checkpoint being written, raising the error of the last write if it failed"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
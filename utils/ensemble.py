@@ -0,0 +1,82 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from BCQutils import sample_batches
+
+
+class EnsembleLinear(nn.Module):
+    """
+    The linear layers of the members of an ensemble (one per seed), applied with one batched matmul to a
+    (ensemble_size, batch, in_features) input. Member k starts from the weights of linears[k].
+    """
+
+    def __init__(self, linears):
+        super(EnsembleLinear, self).__init__()
+        self.weight = nn.Parameter(torch.stack([linear.weight.data.t() for linear in linears]))
+        self.bias = nn.Parameter(torch.stack([linear.bias.data for linear in linears]).unsqueeze(1))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x, self.weight)
+
+    def member_state_dict(self, k):
+        """State dict of the nn.Linear layer of member k"""
+        return {'weight': self.weight.data[k].t(), 'bias': self.bias.data[k, 0]}
+
+
+def stack_modules(modules):
+    """
+    Ensemble of modules (one per seed, all of the same class): a copy of modules[0] whose nn.Linear layers are
+    replaced by EnsembleLinear layers, so that its forward runs every member on its own slice of the leading dim.
+    The forward of the modules must only use the last dim as the feature dim (see BCQ.Actor).
+    """
+    ensemble = copy.deepcopy(modules[0])
+    for name, layer in modules[0].named_children():
+        if isinstance(layer, nn.Linear):
+            setattr(ensemble, name, EnsembleLinear([getattr(module, name) for module in modules]))
+    return ensemble
+
+
+def unstack_module(ensemble, module, k):
+    """Copies the weights of member k of ensemble (see stack_modules) into module"""
+    for name, layer in ensemble.named_children():
+        if isinstance(layer, EnsembleLinear):
+            getattr(module, name).load_state_dict(layer.member_state_dict(k))
+
+
+def member_mean(x):
+    """Mean of x, or with a leading ensemble dim, sum over the members of the mean of their slice of x"""
+    return x.mean() if x.dim() == 2 else x.mean(dim=(-2, -1)).sum()
+
+
+def member_mse_loss(input, target):
+    """F.mse_loss, summed over the members with a leading ensemble dim (so every member gets its own gradient)"""
+    return F.mse_loss(input, target) if input.dim() == 2 else member_mean((input - target) ** 2)
+
+
+def member_randn(shape, generators):
+    """Standard normal noise of a (ensemble_size, ...) shape, the slice of member k drawn from generators[k]"""
+    return torch.stack([torch.randn(tuple(shape[1:]), generator=generator) for generator in generators])
+
+
+class StackedBuffers(object):
+    """
+    Replay buffers of the members of an ensemble, sampled together into (ensemble_size, batch, dim) batches. With
+    rngs (one np.random.RandomState per member), the minibatch of every member is drawn from its own rng, so it does
+    not depend on the other members.
+    """
+
+    def __init__(self, replay_buffers, prefetch=0, rngs=None):
+        self.replay_buffers = replay_buffers
+        self.prefetch = prefetch
+        self.rngs = rngs or [None] * len(replay_buffers)
+
+    def sample(self, batch_size):
+        return tuple(torch.stack(tensors) for tensors in
+                     zip(*[replay_buffer.sample(batch_size, rng)
+                           for replay_buffer, rng in zip(self.replay_buffers, self.rngs)]))
+
+    def sample_batches(self, num_batches, batch_size):
+        return sample_batches(self.sample, num_batches, batch_size, self.prefetch)
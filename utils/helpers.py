@@ -9,45 +9,40 @@ import numpy as np
 import logging
 logger = logging.getLogger(__name__)
 
-def format_trajectory(trajectory_length, traj_plk):
-    counter = 0
-    curr_traj = []
-    num_trajectories_to_return = int(len(traj_plk) / trajectory_length)
-    complete_trajectory_list = []
-    append_list = complete_trajectory_list.append
-
-    for (obs, action, reward, done) in traj_plk:
-        # pad trajectory and reset counter
-        if done and counter < trajectory_length:
-            append_list(
-                flatten_trajectory(pad_trajectory(curr_traj, obs, counter, trajectory_length, action.shape[0])))
-            counter = 0
-            curr_traj = []
-        elif counter == (trajectory_length - 1):
-            curr_traj.append(flatten_tuple(obs, action, reward))
-            append_list(flatten_trajectory(curr_traj))
-            counter = 0
-            curr_traj = []
-        else:
-            curr_traj.append(flatten_tuple(obs, action, reward))
-            counter += 1
-    return np.asarray(sample(complete_trajectory_list, num_trajectories_to_return))
-
-
-def flatten_trajectory(curr_traj):
-    return np.concatenate(curr_traj)
-
-
-def pad_trajectory(curr_traj, obs, counter, trajectory_length, act_dim):
-    append = curr_traj.append
-    while counter < trajectory_length:
-        append(flatten_tuple(obs, np.zeros(act_dim), 0))
-        counter += 1
-    return curr_traj
-
-
-def flatten_tuple(obs, action, reward):
-    return np.concatenate([obs, action, [reward]])
+def format_trajectory(trajectory_length, trajectories, seed=None):
+    """
+    Splits the (obs, act, rew, done) columns of utils.trajectory_recorder.load_trajectories into flattened
+    obs|act|rew trajectories of trajectory_length steps, in a random (seeded) order.
+
+    The steps between two done steps are cut into trajectories of trajectory_length steps; the remaining steps end
+    at the done step and are padded with its obs (and no action and reward). The steps after the last done step that
+    do not fill a trajectory are dropped. Returns len(obs) // trajectory_length of the trajectories.
+    """
+    obs, act, rew, done = trajectories
+    num_steps, obs_dim = obs.shape
+    rows = np.concatenate([obs, act, rew], axis=1)
+    done_index = np.flatnonzero(done[:, 0])
+
+    # runs of steps between the done steps; all but the last run end at a done step
+    starts = np.concatenate([[0], done_index + 1])
+    lengths = np.concatenate([done_index, [num_steps]]) - starts
+    terminated = np.arange(len(starts)) < len(done_index)
+    run_trajectories = lengths // trajectory_length + terminated
+    first_trajectory = np.cumsum(run_trajectories) - run_trajectories
+
+    steps = np.flatnonzero(done[:, 0] == 0)
+    run = np.searchsorted(done_index, steps)
+    position = steps - starts[run]
+    trajectory = first_trajectory[run] + position // trajectory_length
+    kept = trajectory < first_trajectory[run] + run_trajectories[run]
+
+    formatted = np.zeros((run_trajectories.sum(), trajectory_length, rows.shape[1]), dtype=np.float32)
+    formatted[first_trajectory[terminated] + run_trajectories[terminated] - 1, :, :obs_dim] = \
+        obs[done_index][:, None, :]
+    formatted[trajectory[kept], position[kept] % trajectory_length] = rows[steps[kept]]
+
+    order = np.random.RandomState(seed).permutation(len(formatted))[:num_steps // trajectory_length]
+    return formatted.reshape(len(formatted), trajectory_length * rows.shape[1])[order]
 
 
 def is_same_set(num_traj_per_model, x_i, y_i):
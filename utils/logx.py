@@ -13,7 +13,7 @@ import numpy as np
 import torch
 import os.path as osp, time, atexit, os
 import warnings
-from utils.mpi_tools import proc_id, mpi_statistics_scalar
+from utils.mpi_tools import proc_id, mpi_statistics_scalar, merge_statistics
 from utils.serialization_utils import convert_json
 
 color2num = dict(
@@ -300,6 +300,52 @@ class Logger:
         self.log_current_row.clear()
         self.first_row=False
 
+class StreamingStatistics:
+    """
+    Running count, mean, M2 (sum of squared deviations from the mean), min
+    and max of a stream of values (merged a batch at a time, see
+    ``utils.mpi_tools.merge_statistics``), and optionally a uniform sample
+    of the values (reservoir sampling). Takes constant memory however many
+    values it is fed.
+    """
+
+    def __init__(self, reservoir_size=0, seed=0):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.reservoir_size = reservoir_size
+        self.reservoir = np.zeros(reservoir_size)
+        # own random state, so sampling does not change the training randomness
+        self.rng = np.random.RandomState(seed)
+
+    def update(self, values):
+        """Adds a scalar or an array of values to the statistics."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n = len(values)
+        if n == 0:
+            return
+        batch_mean = values.mean()
+        total = self.count + n
+        _, self.mean, self.m2 = merge_statistics(
+            [self.count, n], [self.mean, batch_mean], [self.m2, ((values - batch_mean)**2).sum()])
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self.reservoir_size > 0:
+            # the t-th value seen replaces a uniformly chosen sample with probability reservoir_size / (t + 1)
+            t = np.arange(self.count, total)
+            slots = np.where(t < self.reservoir_size, t, self.rng.randint(0, t + 1))
+            kept = slots < self.reservoir_size
+            self.reservoir[slots[kept]] = values[kept]
+        self.count = total
+
+    @property
+    def samples(self):
+        """The reservoir: a uniform sample of (at most reservoir_size of) the values."""
+        return self.reservoir[:min(self.count, self.reservoir_size)]
+
+
 class EpochLogger(Logger):
     """
     A variant of Logger tailored for tracking average values over epochs.
@@ -323,10 +369,18 @@ class EpochLogger(Logger):
         epoch_logger.log_tabular(NameOfQuantity, **options)
 
     to record the desired values.
+
+    With ``streaming=True``, ``store`` only keeps a
+    :class:`StreamingStatistics` of every quantity (and at most
+    ``reservoir_size`` samples of it), instead of every value stored since
+    the last ``log_tabular``, so the memory of the logger does not grow with
+    the length of training.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, streaming=False, reservoir_size=0, **kwargs):
         super().__init__(*args, **kwargs)
+        self.streaming = streaming
+        self.reservoir_size = reservoir_size
         self.epoch_dict = dict()
 
     def store(self, **kwargs):
@@ -338,8 +392,18 @@ class EpochLogger(Logger):
         """
         for k,v in kwargs.items():
             if not(k in self.epoch_dict.keys()):
-                self.epoch_dict[k] = []
-            self.epoch_dict[k].append(v)
+                self.epoch_dict[k] = StreamingStatistics(self.reservoir_size) if self.streaming else []
+            if self.streaming:
+                self.epoch_dict[k].update(v)
+            else:
+                self.epoch_dict[k].append(v)
+
+    def epoch_values(self, key):
+        """The values stored for key since it was last logged (or their StreamingStatistics)."""
+        v = self.epoch_dict[key]
+        if self.streaming:
+            return v
+        return np.concatenate(v) if isinstance(v[0], np.ndarray) and len(v[0].shape)>0 else v
 
     def log_tabular(self, key, val=None, with_min_and_max=False, average_only=False):
         """
@@ -363,21 +427,17 @@ class EpochLogger(Logger):
         if val is not None:
             super().log_tabular(key,val)
         else:
-            v = self.epoch_dict[key]
-            vals = np.concatenate(v) if isinstance(v[0], np.ndarray) and len(v[0].shape)>0 else v
-            stats = mpi_statistics_scalar(vals, with_min_and_max=with_min_and_max)
+            stats = mpi_statistics_scalar(self.epoch_values(key), with_min_and_max=with_min_and_max)
             super().log_tabular(key if average_only else 'Average' + key, stats[0])
             if not(average_only):
                 super().log_tabular('Std'+key, stats[1])
             if with_min_and_max:
                 super().log_tabular('Max'+key, stats[3])
                 super().log_tabular('Min'+key, stats[2])
-        self.epoch_dict[key] = []
+        self.epoch_dict[key] = StreamingStatistics(self.reservoir_size) if self.streaming else []
 
     def get_stats(self, key):
         """
         Lets an algorithm ask the logger for mean/std/min/max of a diagnostic.
         """
-        v = self.epoch_dict[key]
-        vals = np.concatenate(v) if isinstance(v[0], np.ndarray) and len(v[0].shape)>0 else v
-        return mpi_statistics_scalar(vals)
\ No newline at end of file
+        return mpi_statistics_scalar(self.epoch_values(key))
\ No newline at end of file
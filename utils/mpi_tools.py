@@ -66,6 +66,19 @@ def mpi_sum(x):
 def mpi_avg(x):
     """Average a scalar or vector over MPI processes."""
     return mpi_sum(x) / num_procs()
+
+def merge_statistics(counts, means, m2s):
+    """
+    Count, mean and M2 (sum of squared deviations from the mean) of the
+    union of sets of values, from those of every set (Chan et al.).
+    """
+    counts, means, m2s = (np.asarray(x, dtype=np.float64) for x in (counts, means, m2s))
+    count = counts.sum()
+    if count == 0:
+        return 0., 0., 0.
+    mean = np.sum(counts * means) / count
+    m2 = np.sum(m2s + counts * (means - mean)**2)
+    return count, mean, m2
     
 def mpi_statistics_scalar(x, with_min_and_max=False):
     """
@@ -73,11 +86,24 @@ def mpi_statistics_scalar(x, with_min_and_max=False):
 
     Args:
         x: An array containing samples of the scalar to produce statistics
-            for.
+            for, or the ``utils.logx.StreamingStatistics`` of the samples.
 
         with_min_and_max (bool): If true, return min and max of x in 
             addition to mean and std.
     """
+    if hasattr(x, 'm2'):
+        # gathers the running statistics of every process (in float64, as
+        # mpi_sum would round the counts to float32) and merges them
+        stats = np.zeros((3, num_procs()))
+        stats[:, proc_id()] = [x.count, x.mean, x.m2]
+        all_stats = np.zeros_like(stats)
+        allreduce(stats, all_stats, op=MPI.SUM)
+        global_n, mean, m2 = merge_statistics(*all_stats)
+        std = np.sqrt(m2 / global_n)
+        if with_min_and_max:
+            return mean, std, mpi_op(x.min, op=MPI.MIN), mpi_op(x.max, op=MPI.MAX)
+        return mean, std
+
     x = np.array(x, dtype=np.float32)
     global_sum, global_n = mpi_sum([np.sum(x), len(x)])
     mean = global_sum / global_n
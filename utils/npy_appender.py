@@ -0,0 +1,60 @@
+import struct
+
+import numpy as np
+
+# Size of the .npy header written by NpyAppender. It is fixed, so that the header can be rewritten with the final
+# number of rows once all the rows have been appended.
+HEADER_LEN = 128
+MAGIC = b'\x93NUMPY\x01\x00'
+
+
+class NpyAppender(object):
+    """
+    Writes a 2D array to a .npy file one chunk of rows at a time, without holding the array in memory.
+
+    The dtype and the row width are taken from the first appended chunk. The header is rewritten with the final
+    shape on close, after which the file is a regular .npy file (e.g. it can be memory-mapped with np.load).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.num_rows = 0
+        self.row_width = None
+        self.dtype = None
+        self._write_header()
+
+    def _write_header(self):
+        dtype = self.dtype if self.dtype is not None else np.dtype(np.float64)
+        shape = (self.num_rows, self.row_width) if self.row_width is not None else (0,)
+        header = str({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+        header_len = HEADER_LEN - len(MAGIC) - 2
+        if len(header) + 1 > header_len:
+            raise ValueError(f"Shape {shape} does not fit in the .npy header of {self.filename}")
+        self.file.seek(0)
+        self.file.write(MAGIC + struct.pack('<H', header_len) + header.ljust(header_len - 1).encode('latin1') + b'\n')
+
+    def append(self, rows):
+        rows = np.atleast_2d(rows)
+        if self.dtype is None:
+            self.dtype = rows.dtype
+            self.row_width = rows.shape[1]
+        elif rows.shape[1] != self.row_width:
+            raise ValueError(f"Cannot append rows of width {rows.shape[1]} to {self.filename} "
+                             f"(row width {self.row_width})")
+        self.file.seek(0, 2)
+        np.ascontiguousarray(rows, dtype=self.dtype).tofile(self.file)
+        self.num_rows += rows.shape[0]
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._write_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
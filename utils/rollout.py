@@ -0,0 +1,266 @@
+import logging
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# number of target episodes a rollout worker steps in lockstep (see run_episodes)
+EPISODES_PER_BATCH = 16
+
+# environments and policy of a target rollout worker process, built once by init_rollout_worker
+_worker_envs = None
+_worker_policy = None
+
+
+def spawn_seeds(seed, keys):
+    """One 32 bit seed per key (a tuple of ints), derived from seed"""
+    entropy = np.random.SeedSequence(seed).entropy
+    return [int(np.random.SeedSequence(entropy, spawn_key=key).generate_state(1)[0]) for key in keys]
+
+
+def get_reset_state(env):
+    """
+    Random state the next env.reset() draws the initial state from, as a row of floats (the MT19937 key, position
+    and cached gaussian of the environment RandomState), so that it can be saved with the buffer
+    """
+    _, key, pos, has_gauss, cached_gaussian = env.unwrapped.np_random.get_state()
+    return np.concatenate([key, [pos, has_gauss, cached_gaussian]]).astype(np.float64)
+
+
+def restore_reset_state(env, reset_state):
+    """Sets the random state of env to reset_state (see get_reset_state), so env.reset() starts the same episode"""
+    env.unwrapped.np_random.set_state(('MT19937', reset_state[:-3].astype(np.uint32), int(reset_state[-3]),
+                                       int(reset_state[-2]), float(reset_state[-1])))
+
+
+def env_worker(conn, make_env, env_seed):
+    """
+    Runs the ('reset', episode), ('step', action) and ('close', None) commands received on conn on an environment
+    copy seeded with env_seed.
+
+    A reset for episode k first skips the resets of the episodes run by the other copies, so episode k starts from
+    the k-th reset of a single environment seeded with env_seed, i.e. from the same initial state as in a sequential
+    rollout. This relies on the environment random state only being used by reset (as for the MuJoCo environments).
+    """
+    env = make_env()
+    env.seed(env_seed)
+    num_resets = 0
+    try:
+        while True:
+            command, data = conn.recv()
+            if command == 'reset':
+                while num_resets <= data:
+                    reset_state = get_reset_state(env)
+                    state = env.reset()
+                    num_resets += 1
+                conn.send((reset_state, state))
+            elif command == 'step':
+                next_state, reward, done, _ = env.step(data)
+                conn.send((next_state, reward, done))
+            else:
+                break
+    finally:
+        env.close()
+        conn.close()
+
+
+class SubprocEnvs(object):
+    """num_envs copies of the environment built by make_env, each stepped in its own process"""
+
+    def __init__(self, make_env, env_seed, num_envs):
+        self.conns = []
+        self.processes = []
+        for _ in range(num_envs):
+            conn, worker_conn = mp.Pipe()
+            process = mp.Process(target=env_worker, args=(worker_conn, make_env, env_seed), daemon=True)
+            process.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    def reset(self, episodes):
+        """
+        Resets the environment copy of every slot of episodes ({slot: episode number}) to its episode.
+        Returns the (reset state, initial state) of every slot.
+        """
+        for slot, episode in episodes.items():
+            self.conns[slot].send(('reset', episode))
+        return {slot: self.conns[slot].recv() for slot in episodes}
+
+    def step(self, actions):
+        """Steps every environment copy with its action. Returns a (next_state, reward, done) tuple per copy"""
+        for conn, action in zip(self.conns, actions):
+            conn.send(('step', action))
+        return [conn.recv() for conn in self.conns]
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+            conn.close()
+        for process in self.processes:
+            process.join()
+
+
+class Episode(object):
+    """Transitions of an episode in progress, with the exploration noise generator of the episode"""
+
+    def __init__(self, index, reset, seed_sequence):
+        self.index = index
+        self.reset_state, self.initial_state = reset
+        self.state = self.initial_state
+        self.rng = np.random.RandomState(
+            np.random.SeedSequence(seed_sequence.entropy, spawn_key=(index,)).generate_state(4))
+        self.transitions = []
+        self.reward = 0
+
+    def add(self, action, next_state, reward, done):
+        self.transitions.append((self.state, action, next_state, reward, float(done)))
+        self.state = next_state
+        self.reward += reward
+
+
+def store_episode(replay_buffer, episode, max_timesteps):
+    """
+    Adds the transitions of episode to replay_buffer, up to max_timesteps transitions in the buffer. As in a sequential
+    rollout, the last transition of the buffer ends a trajectory even if the episode goes on.
+    """
+    replay_buffer.initial_state.append(episode.initial_state)
+    replay_buffer.reset_state.append(episode.reset_state)
+    transitions = episode.transitions[:max_timesteps - replay_buffer.size]
+    state, action, next_state, reward, done = (np.array(column) for column in zip(*transitions))
+    if replay_buffer.size + len(transitions) == max_timesteps:
+        done[-1] = 1.
+    replay_buffer.add_batch(state, action, next_state, reward, done)
+
+
+def collect_buffer(policy, replay_buffer, make_env, env_seed, seed, num_envs, max_timesteps, max_action,
+                   rand_action_p, gaussian_std):
+    """
+    Fills replay_buffer with max_timesteps transitions of the (noisy) behavioral policy, stepping num_envs copies of the
+    environment in worker processes and selecting the actions of all the copies with one policy forward pass.
+
+    The episodes are numbered in the order they start, and stored in the buffer whole and in that order, so that
+    initial_state and trajectory_end_index are laid out as in a sequential rollout (every episode starts from the
+    initial state of the sequential rollout, see env_worker). The exploration noise of an episode is drawn from its
+    own generator (seeded with seed and the episode number), so the buffer does not depend on num_envs.
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    action_dim = replay_buffer.action_dim
+    envs = SubprocEnvs(make_env, env_seed, num_envs)
+    try:
+        resets = envs.reset({slot: slot for slot in range(num_envs)})
+        episodes = [Episode(slot, resets[slot], seed_sequence) for slot in range(num_envs)]
+        next_episode = num_envs
+        # finished episodes waiting for the episodes started before them
+        finished = {}
+        next_stored = 0
+
+        while replay_buffer.size < max_timesteps:
+            policy_actions = policy.select_actions(np.array([episode.state for episode in episodes]))
+            actions = []
+            for episode, policy_action in zip(episodes, policy_actions):
+                # Select action with noise
+                if episode.rng.uniform(0, 1) < rand_action_p:
+                    action = episode.rng.uniform(-max_action, max_action, size=action_dim)
+                else:
+                    action = (
+                            policy_action + episode.rng.normal(0, max_action * gaussian_std, size=action_dim)
+                    ).clip(-max_action, max_action)
+                actions.append(action)
+
+            resets = {}
+            for slot, (episode, action, (next_state, reward, done)) in enumerate(
+                    zip(episodes, actions, envs.step(actions))):
+                episode.add(action, next_state, reward, done)
+                if done:
+                    finished[episode.index] = episode
+                    resets[slot] = next_episode
+                    next_episode += 1
+
+            for slot, reset in envs.reset(resets).items():
+                episodes[slot] = Episode(resets[slot], reset, seed_sequence)
+
+            while next_stored in finished and replay_buffer.size < max_timesteps:
+                episode = finished.pop(next_stored)
+                store_episode(replay_buffer, episode, max_timesteps)
+                next_stored += 1
+                logger.info(f"Total T: {replay_buffer.size} Episode Num: {next_stored} "
+                            f"Episode T: {len(episode.transitions)} Reward: {episode.reward:.3f}")
+    finally:
+        envs.close()
+
+
+def init_rollout_worker(make_env, env_seed, make_policy, num_threads):
+    global _worker_envs, _worker_policy
+    torch.set_num_threads(num_threads)
+    _worker_envs = [make_env() for _ in range(EPISODES_PER_BATCH)]
+    for env in _worker_envs:
+        env.seed(env_seed)
+    _worker_policy = make_policy()
+
+
+def run_episodes(envs, policy, reset_states, max_action=None, initial_states=None, generators=None):
+    """
+    Runs one episode of policy from every reset state (see get_reset_state), the k-th one on envs[k]. The episodes
+    are stepped in lockstep, with one policy.select_actions call per step for all the episodes still running.
+
+    When given, checks that the episodes start from initial_states, draws the policy randomness of every episode from
+    its own generator (see BCQ.select_actions) and clips the actions to max_action.
+    Returns the (states, actions, next states, rewards, dones) of every episode.
+    """
+    states = []
+    for env, reset_state in zip(envs, reset_states):
+        restore_reset_state(env, reset_state)
+        states.append(env.reset())
+    if initial_states is not None and not all(
+            np.array_equal(state, initial_state.ravel()) for state, initial_state in zip(states, initial_states)):
+        raise ValueError('The initial state is not the same as that in the training data')
+
+    transitions = [[] for _ in states]
+    running = list(range(len(states)))
+    while running:
+        batch = np.array([states[k] for k in running])
+        if generators is None:
+            actions = policy.select_actions(batch)
+        else:
+            actions = policy.select_actions(batch, [generators[k] for k in running])
+        if max_action is not None:
+            actions = actions.clip(-max_action, max_action)
+        still_running = []
+        for k, action in zip(running, actions):
+            next_state, reward, done, _ = envs[k].step(action)
+            transitions[k].append((states[k], action, next_state, reward, float(done)))
+            states[k] = next_state
+            if not done:
+                still_running.append(k)
+        running = still_running
+    return [tuple(np.array(column) for column in zip(*episode)) for episode in transitions]
+
+
+def worker_run_episodes(max_action, reset_states, initial_states, torch_seeds):
+    """run_episodes of the given episodes, with the environments and policy of the worker process"""
+    generators = [torch.Generator().manual_seed(torch_seed) for torch_seed in torch_seeds]
+    return run_episodes(_worker_envs, _worker_policy, reset_states, max_action, initial_states, generators)
+
+
+def policy_rollouts(make_env, env_seed, make_policy, seed, max_action, reset_states, initial_states, workers):
+    """
+    Runs one episode of the policy built by make_policy from every saved (reset state, initial state), in batches of
+    EPISODES_PER_BATCH consecutive episodes stepped in lockstep and split across workers processes. The policy
+    randomness of every episode is seeded with seed and the episode number, so the episodes do not depend on the
+    number of workers.
+    Returns the (states, actions, next states, rewards, dones) of every episode, in order.
+    """
+    torch_seeds = spawn_seeds(seed, [(index,) for index in range(len(initial_states))])
+    batches = [np.arange(start, min(start + EPISODES_PER_BATCH, len(initial_states)))
+               for start in range(0, len(initial_states), EPISODES_PER_BATCH)]
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_rollout_worker,
+                             initargs=(make_env, env_seed, make_policy, num_threads)) as executor:
+        futures = [executor.submit(worker_run_episodes, max_action, reset_states[batch], initial_states[batch],
+                                   [torch_seeds[index] for index in batch]) for batch in batches]
+        return [episode for future in futures for episode in future.result()]
@@ -0,0 +1,178 @@
+import logging
+import os
+import subprocess
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    A command of the experiment pipeline, run once the stages it depends on (by name) are complete.
+
+    Without a cache, a stage whose outputs all exist is complete without running, unless one of the stages it depends
+    on ran. With a cache (see utils.cache.StageCache), it is complete without running only if its outputs are those of
+    a run with the same args (the arguments affecting its outputs) and inputs (by default, the outputs of the stages
+    it depends on), and the outputs of a stage with store set are kept in the cache to be restored later.
+
+    A marker is a file the scheduler writes once the command succeeded (and deletes when it starts it), for the stages
+    whose outputs exist before they are complete. Without a cache, such a stage is complete only if its marker exists.
+    """
+
+    def __init__(self, name, command, outputs, depends_on=(), cpus=1, args=None, inputs=None, store=False,
+                 marker=None):
+        self.name = name
+        self.command = command
+        self.outputs = outputs
+        self.depends_on = list(depends_on)
+        self.cpus = cpus
+        self.args = args
+        self.inputs = inputs
+        self.store = store
+        self.marker = marker
+        # 'done', 'skipped', 'restored' (from the cache), 'dry run', 'failed' or 'blocked' (a stage it depends on
+        # failed) once scheduled
+        self.status = None
+        self.wall_time = None
+
+    @property
+    def kind(self):
+        """Name of the stage up to the first '/' (e.g. train_behavioral for train_behavioral/Hopper-v3/...)"""
+        return self.name.split('/')[0]
+
+    def outputs_exist(self):
+        return all(os.path.exists(output) for output in self.outputs + ([self.marker] if self.marker else []))
+
+    def mark_complete(self, complete):
+        """Writes (or deletes) the marker of the stage, if it has one"""
+        if self.marker is None:
+            return
+        if complete:
+            if not os.path.exists(os.path.dirname(self.marker)):
+                os.makedirs(os.path.dirname(self.marker))
+            open(self.marker, 'w').close()
+        elif os.path.exists(self.marker):
+            os.remove(self.marker)
+
+
+def start_stage(stage, log_dir):
+    """Starts the command of stage, with its output in log_dir/<stage name>.log and its threads bounded by its cpus"""
+    env = dict(os.environ, OMP_NUM_THREADS=str(stage.cpus), MKL_NUM_THREADS=str(stage.cpus))
+    if log_dir is None:
+        return subprocess.Popen(stage.command, env=env), None
+    log_file = f"{log_dir}/{stage.name.replace('/', '_')}.log"
+    with open(log_file, 'w') as log:
+        return subprocess.Popen(stage.command, stdout=log, stderr=subprocess.STDOUT, env=env), log_file
+
+
+# statuses of the stages whose outputs are ready
+COMPLETE = ['done', 'skipped', 'restored', 'dry run']
+
+
+def is_complete(stage, dependencies, cache, key):
+    """True if the outputs of stage are up to date, so it does not need to run"""
+    if cache is None:
+        return stage.outputs_exist() and all(dependency.status == 'skipped' for dependency in dependencies)
+    return cache.is_current(stage, key)
+
+
+def run_stages(stages, cpus, log_dir=None, dry_run=False, poll_interval=1., cache=None):
+    """
+    Runs the commands of stages in dependency order, each in its own process. Independent stages run concurrently
+    while their cpus add up to at most cpus (a stage needing more than cpus runs alone). Stages are started in the
+    order they are given among those ready. A failed stage blocks the stages depending on it, the others still run.
+    With dry_run, the stages that would run are only logged. With a cache (see Stage), the keys of the stages that
+    run are recorded, and the outputs of the stages with store set are stored.
+    Returns the stages, with their status and wall time set.
+    """
+    names = set()
+    for stage in stages:
+        if stage.name in names:
+            raise ValueError(f"duplicate stage {stage.name}")
+        names.add(stage.name)
+    for stage in stages:
+        for name in stage.depends_on:
+            if name not in names:
+                raise ValueError(f"stage {stage.name} depends on the unknown stage {name}")
+
+    by_name = {stage.name: stage for stage in stages}
+    pending = list(stages)
+    # stage name -> (stage, process, start time, log file, cache key)
+    running = {}
+    used_cpus = 0
+    while pending or running:
+        for name, (stage, process, start, log_file, key) in list(running.items()):
+            if process.poll() is None:
+                continue
+            stage.wall_time = time.time() - start
+            stage.status = 'done' if process.returncode == 0 else 'failed'
+            used_cpus -= stage.cpus
+            del running[name]
+            if stage.status == 'failed':
+                logger.error(f"{name} failed (exit code {process.returncode}) after {stage.wall_time:.1f}s"
+                             + (f", see {log_file}" if log_file else ""))
+            else:
+                logger.info(f"{name} done in {stage.wall_time:.1f}s")
+                stage.mark_complete(True)
+                if cache is not None and stage.store:
+                    cache.store(stage, key)
+                if cache is not None:
+                    cache.record(stage, key)
+
+        # skipped stages complete at once, so stages may become ready within a pass
+        progress = True
+        while progress:
+            progress = False
+            for stage in list(pending):
+                dependencies = [by_name[name] for name in stage.depends_on]
+                if any(dependency.status in ['failed', 'blocked'] for dependency in dependencies):
+                    stage.status = 'blocked'
+                    logger.warning(f"{stage.name} blocked by a failed stage")
+                elif not all(dependency.status in COMPLETE for dependency in dependencies):
+                    continue
+                else:
+                    if stage.inputs is None:
+                        stage.inputs = [output for dependency in dependencies for output in dependency.outputs]
+                    key = cache.key(stage) if cache is not None else None
+                    if is_complete(stage, dependencies, cache, key):
+                        stage.status = 'skipped'
+                        if cache is not None:
+                            cache.touch(key)
+                        logger.info(f"{stage.name} skipped, its outputs are up to date")
+                    elif cache is not None and stage.store and not dry_run and cache.restore(stage, key):
+                        stage.status = 'restored'
+                        stage.mark_complete(True)
+                        logger.info(f"{stage.name} restored from the cache")
+                    elif dry_run:
+                        stage.status = 'dry run'
+                        logger.info(f"{stage.name} would run: {' '.join(stage.command)}")
+                    elif not running or used_cpus + stage.cpus <= cpus:
+                        stage.mark_complete(False)
+                        process, log_file = start_stage(stage, log_dir)
+                        running[stage.name] = (stage, process, time.time(), log_file, key)
+                        used_cpus += stage.cpus
+                        logger.info(f"{stage.name} started ({stage.cpus} cpus, {used_cpus}/{cpus} in use)")
+                    else:
+                        continue
+                pending.remove(stage)
+                progress = True
+
+        if pending and not running:
+            raise ValueError(f"dependency cycle between the stages {[stage.name for stage in pending]}")
+        if running:
+            time.sleep(poll_interval)
+    return stages
+
+
+def timing_report(stages):
+    """Status and wall time of every stage, and the total wall time of every kind of stage"""
+    lines = [f"{'stage':<60} {'status':<8} {'wall time (s)':>14}"]
+    totals = {}
+    for stage in stages:
+        wall_time = f"{stage.wall_time:.1f}" if stage.wall_time is not None else "-"
+        lines.append(f"{stage.name:<60} {stage.status or '-':<8} {wall_time:>14}")
+        totals[stage.kind] = totals.get(stage.kind, 0.) + (stage.wall_time or 0.)
+    lines.append("")
+    for kind, total in totals.items():
+        lines.append(f"{'total ' + kind:<60} {'':<8} {total:>14.1f}")
+    return "\n".join(lines)
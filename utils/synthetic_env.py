@@ -0,0 +1,55 @@
+import gym
+import numpy as np
+from gym import spaces
+from gym.utils import seeding
+
+# id of the synthetic environment registered with gym (see register_synthetic_env)
+SYNTHETIC_ENV = 'SyntheticControl-v0'
+
+
+class SyntheticControlEnv(gym.Env):
+    """
+    Continuous control task in pure NumPy, to run (and benchmark) the pipeline without MuJoCo.
+
+    The state is a point of R^state_dim following s' = tanh(A s + B a) for fixed (seed independent) random matrices A
+    and B, with the reward -|s|^2 - 0.1 |a|^2 of staying near the origin. The episode ends early once the state
+    saturates in some dimension, so trajectories have different lengths, as in the MuJoCo tasks. As for MuJoCo,
+    only reset draws from the environment random state: an episode is determined by the seed and the actions.
+    """
+
+    def __init__(self, state_dim=11, action_dim=3):
+        self.observation_space = spaces.Box(-1., 1., shape=(state_dim,), dtype=np.float32)
+        self.action_space = spaces.Box(-1., 1., shape=(action_dim,), dtype=np.float32)
+        dynamics = np.random.RandomState(0)
+        # slightly expanding rotation, so the state drifts away from the origin unless it is controlled
+        self.transition = 1.1 * np.linalg.qr(dynamics.normal(size=(state_dim, state_dim)))[0]
+        self.control = dynamics.normal(scale=0.5 / np.sqrt(action_dim), size=(action_dim, state_dim))
+        self.state = None
+        self.seed()
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def reset(self):
+        self.state = self.np_random.uniform(-0.5, 0.5, size=self.observation_space.shape)
+        return self.state.copy()
+
+    def step(self, action):
+        action = np.clip(action, self.action_space.low, self.action_space.high)
+        self.state = np.tanh(self.state @ self.transition + action @ self.control)
+        reward = -float(self.state @ self.state) - 0.1 * float(action @ action)
+        done = bool(np.abs(self.state).max() > 0.95)
+        return self.state.copy(), reward, done, {}
+
+
+def register_synthetic_env(env_id=SYNTHETIC_ENV, state_dim=11, action_dim=3, max_episode_steps=1000):
+    """Registers SyntheticControlEnv with gym as env_id (replacing a previous registration of env_id)"""
+    gym.envs.registry.env_specs.pop(env_id, None)
+    gym.envs.registration.register(id=env_id, entry_point='utils.synthetic_env:SyntheticControlEnv',
+                                   max_episode_steps=max_episode_steps,
+                                   kwargs={'state_dim': state_dim, 'action_dim': action_dim})
+
+
+# Hopper-v3 sized by default
+register_synthetic_env()
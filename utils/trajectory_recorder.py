@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+
+from utils.npy_appender import NpyAppender
+
+# columns of a recorded trajectory file, each saved as a 2D float32 .npy file (rew and done have a single column)
+TRAJECTORY_COLUMNS = ['obs', 'act', 'rew', 'done']
+
+
+def trajectory_file(path, column):
+    return f"{path}_{column}.npy"
+
+
+class TrajectoryRecorder(object):
+    """
+    Records the (obs, act, rew, done) of every environment step in preallocated float32 columns, saved to
+    {path}_{column}.npy (see load_trajectories).
+
+    The columns hold chunk_size steps (all max_steps steps by default); whenever they are full they are appended to
+    the .npy files, so with a chunk_size the memory of the recorder does not grow with the length of training.
+    """
+
+    def __init__(self, path, obs_dim, act_dim, max_steps, chunk_size=None):
+        capacity = max_steps if chunk_size is None else min(chunk_size, max_steps)
+        self.columns = {'obs': np.zeros((capacity, obs_dim), dtype=np.float32),
+                        'act': np.zeros((capacity, act_dim), dtype=np.float32),
+                        'rew': np.zeros((capacity, 1), dtype=np.float32),
+                        'done': np.zeros((capacity, 1), dtype=np.float32)}
+        self.ptr = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.writers = {column: NpyAppender(trajectory_file(path, column)) for column in TRAJECTORY_COLUMNS}
+
+    def record(self, obs, act, rew, done):
+        if self.ptr == len(self.columns['obs']):
+            self.flush()
+        self.columns['obs'][self.ptr] = obs
+        self.columns['act'][self.ptr] = act
+        self.columns['rew'][self.ptr] = rew
+        self.columns['done'][self.ptr] = done
+        self.ptr += 1
+
+    def flush(self):
+        """Appends the steps recorded since the last flush to the .npy files"""
+        for column in TRAJECTORY_COLUMNS:
+            self.writers[column].append(self.columns[column][:self.ptr])
+        self.ptr = 0
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+
+def load_trajectories(path, mmap=True):
+    """
+    (obs, act, rew, done) columns of the trajectories recorded to path (see TrajectoryRecorder), memory-mapped unless
+    mmap is False. Trajectories saved as a single array of (obs, act, rew, done) tuples at {path}.npy, as before the
+    recorder existed, are converted to columns.
+    """
+    if not os.path.exists(trajectory_file(path, 'obs')) and os.path.exists(f"{path}.npy"):
+        steps = np.load(f"{path}.npy", allow_pickle=True)
+        return tuple(np.array([step[k] for step in steps], dtype=np.float32).reshape(len(steps), -1)
+                     for k in range(len(TRAJECTORY_COLUMNS)))
+    return tuple(np.load(trajectory_file(path, column), mmap_mode='r' if mmap else None)
+                 for column in TRAJECTORY_COLUMNS)
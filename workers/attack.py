@@ -1,6 +1,8 @@
 import gc
+import json
 import math
 import os
+import shutil
 import uuid
 from random import randint, SystemRandom
 import BCQutils
@@ -9,6 +11,8 @@ import pathlib
 import logging
 import pandas as pd
 import copy
+import functools
+from concurrent.futures import ProcessPoolExecutor
 logger = logging.getLogger(__name__)
 
 import numpy as np
@@ -17,12 +21,13 @@ from xgboost.sklearn import XGBClassifier
 # from sklearn import cross_validation, metrics   #Additional scklearn functions
 from sklearn.model_selection import cross_validate
 from sklearn import metrics
-from sklearn.model_selection import GridSearchCV   #Performing grid search
 from scipy.stats.mstats import gmean
 
 from pandas import DataFrame
 from utils.configs import CORRELATED, DECORRELATED, SEMI_CORRELATED, CORRELATION_MAP
 from utils.helpers import cleanup, print_experiment, generate_pairs, get_models
+from utils.npy_appender import NpyAppender
+from workers.tuning import CVSearch, kfold_dmatrices, xgb_booster_params
 
 import matplotlib.pylab as plt
 #matplotlib inline
@@ -33,6 +38,20 @@ rcParams['figure.figsize'] = 12, 4
 RAND_SELEC_FUNC_REPLACE_FALSE = lambda data, num: np.random.choice(data, num, replace=False)
 RAND_SELEC_FUNC_REPLACE_TRUE = lambda data, num: np.random.choice(data, num, replace=True)
 
+# number of pairs gathered at once when filling a pair matrix; bounds the temporary memory used by the gathers
+PAIRS_CHUNK_SIZE = 1024
+# number of rows fed to XGBoost at once when training the attack classifier from external memory
+XGB_ITER_CHUNK_SIZE = 1 << 16
+
+# names of the pair matrices (and of their .npy files under pair_path_results)
+TRAIN_EVAL_PAIRS = ['train_positive_x', 'train_positive_y', 'train_negative_x', 'train_negative_y',
+                    'eval_positive_x', 'eval_positive_y', 'eval_negative_x', 'eval_negative_y']
+TEST_PAIRS = ['test_positive_x', 'test_positive_y', 'test_negative_x', 'test_negative_y']
+# files saved next to the pairs: their layout, and the attack classifier trained on them with its metadata
+PAIR_LAYOUT_FILE = 'pair_layout.json'
+CLASSIFIER_FILE = 'attack_classifier.json'
+CLASSIFIER_METADATA_FILE = 'attack_classifier_metadata.json'
+
 
 def get_random_seqs(seq_source, seq_size, eval_size):
     # To randomly select train, test, and eval items, we need to cache train and test first,
@@ -150,21 +169,17 @@ def get_seeds_test_pairs(label, seeds):
 
 
 def get_buffer_properties(buffer_name, attack_path, state_dim, action_dim, device, args, seed, env_seed):
-    """Loads buffers and returns some buffer properties"""
+    """Loads the buffer index (not the transitions) and returns some buffer properties"""
     logger.info("Retreiving buffer properties...")
-    replay_buffer_train = BCQutils.ReplayBuffer(state_dim, action_dim, device)
-    replay_buffer_train.load(f"{attack_path}/{env_seed}/{seed}/{args.max_traj_len}/buffers/{buffer_name}")
-
-    num_trajectories = replay_buffer_train.num_trajectories
-    start_states = replay_buffer_train.initial_state
-    trajectories_end_index = replay_buffer_train.trajectory_end_index
+    num_trajectories, start_states, trajectories_end_index = BCQutils.load_buffer_index(
+        f"{attack_path}/{env_seed}/{seed}/{args.max_traj_len}/buffers/{buffer_name}")
 
     return num_trajectories, start_states, trajectories_end_index
 
 
 def create_pairs(
     attack_path, state_dim, action_dim, device, args, label, train_seed, test_seed,
-    do_train=True, train_padding_len=0, test_padding_len=0, padding_len=0):
+    do_train=True, train_padding_len=0, test_padding_len=0, padding_len=0, pair_writers=None):
 
     if not do_train:
         env_seed = args.env_seeds[-1]
@@ -201,17 +216,20 @@ def create_pairs(
         num_trajectories = train_size = int(min(train_num_trajectories, test_num_trajectories))
         # eval_train_size = 0
 
+    # The action buffers are memory-mapped: only the rows gathered into pairs are read
     test_seq_buffer = np.load(
-        f"{attack_path}/{env_seed}/{test_seed}/{args.max_traj_len}/buffers/{buffer_name_test}_action.npy")
+        f"{attack_path}/{env_seed}/{test_seed}/{args.max_traj_len}/buffers/{buffer_name_test}_action.npy",
+        mmap_mode='r')
     train_seq_buffer = np.load(
-        f"{attack_path}/{env_seed}/{train_seed}/{args.max_traj_len}/buffers/{buffer_name_train}_action.npy")
+        f"{attack_path}/{env_seed}/{train_seed}/{args.max_traj_len}/buffers/{buffer_name_train}_action.npy",
+        mmap_mode='r')
 
     final_train_dataset, final_eval_dataset = generate_correlated_decorrelated_pairs(
         test_seq_buffer, train_seq_buffer, test_trajectories_end_index, train_trajectories_end_index, train_size,
         num_trajectories, train_start_states, label, do_train, correlation=args.correlation,
         test_padding_len=test_padding_len, train_padding_len=train_padding_len,
         padding_len=padding_len, fixed_padding_size=args.padding_size,
-        pairing_mode=args.pairing_mode, truncate_traj=args.truncate_traj)
+        pairing_mode=args.pairing_mode, truncate_traj=args.truncate_traj, pair_writers=pair_writers)
 
     return final_train_dataset, final_eval_dataset
 
@@ -311,130 +329,136 @@ def generate_correlated_pairs(
     return (final_train_dataset, final_train_dataset_label), (final_eval_dataset, final_eval_dataset_label)
 
 
+def get_trajectory_bounds(trajectories_end_index, num_trajectories):
+    """
+    From the list of trajectory end indexes, returns the first and the last buffer row of the first
+    num_trajectories trajectories
+    """
+    end_index = np.asarray(trajectories_end_index, dtype=np.int64).ravel()[:num_trajectories]
+    start_index = np.zeros_like(end_index)
+    start_index[1:] = end_index[:-1] + 1
+    return start_index, end_index
+
+
+def get_padded_traj_indices(start_index, end_index, padd_len, fixed_padding_size, truncate_traj=False):
+    """
+    Vectorized counterpart of pad_traj. Instead of copying the trajectories, returns for every trajectory the
+    buffer rows that make up its padded (or truncated) version, i.e. the last row is repeated as padding.
+    """
+    seq_len = int(fixed_padding_size) if truncate_traj else int(padd_len)
+    traj_len = end_index - start_index + 1
+    if not truncate_traj and np.any(traj_len > seq_len):
+        raise ValueError("Failed to padd the trajectory: trajectory is longer than the padding length")
+    return start_index[:, None] + np.minimum(np.arange(seq_len), traj_len[:, None] - 1)
+
+
+def build_pairs(train_seq_buffer, test_seq_buffer, train_bounds, test_bounds, label, in_padding_len,
+                out_padding_len, fixed_padding_size=25, pairing_mode='horizontal', truncate_traj=False,
+                decorrelated=False, shuffle=False, chunk_size=PAIRS_CHUNK_SIZE, writers=None):
+    """
+    Pairs the "in" (train) trajectories with the "out" (test) trajectories delimited by train_bounds and
+    test_bounds. The pair matrix is preallocated and filled chunk by chunk with batched gathers.
+    Random draws happen in the same order as when the pairs were built one by one, so the output is
+    identical for a given numpy seed.
+    If writers, a (pairs, labels) tuple of NpyAppender, is given, each chunk is appended to them instead and
+    (None, None) is returned.
+    """
+    num_pairs = len(train_bounds[0])
+    if num_pairs == 0:
+        return None, None
+
+    action_dim = train_seq_buffer.shape[1]
+    in_seq_len = in_padding_len if decorrelated else (fixed_padding_size if truncate_traj else in_padding_len)
+    out_seq_len = fixed_padding_size if truncate_traj else out_padding_len
+    if pairing_mode == 'vertical' and in_seq_len != out_seq_len:
+        raise ValueError("Vertical pairing requires the in and out sequences to have the same length")
+
+    width = (in_seq_len + out_seq_len) * action_dim
+    dtype = np.result_type(train_seq_buffer, test_seq_buffer)
+    label_dtype = np.asarray(label).dtype
+    if writers is None:
+        pairs = np.empty((num_pairs, width), dtype=dtype)
+    in_width = in_seq_len * action_dim
+    for first in range(0, num_pairs, chunk_size):
+        last = min(first + chunk_size, num_pairs)
+        chunk = pairs[first:last] if writers is None else np.empty((last - first, width), dtype=dtype)
+        if decorrelated:
+            in_index = np.random.choice(train_seq_buffer.shape[0], (last - first, in_seq_len), replace=True)
+        else:
+            in_index = get_padded_traj_indices(train_bounds[0][first:last], train_bounds[1][first:last],
+                                               in_padding_len, fixed_padding_size, truncate_traj)
+        if shuffle:
+            for row in in_index:
+                row[:] = row[np.random.permutation(in_seq_len)]
+        out_index = get_padded_traj_indices(test_bounds[0][first:last], test_bounds[1][first:last],
+                                            out_padding_len, fixed_padding_size, truncate_traj)
+
+        if pairing_mode == 'horizontal':
+            chunk[:, :in_width] = train_seq_buffer[in_index].reshape(last - first, -1)
+            chunk[:, in_width:] = test_seq_buffer[out_index].reshape(last - first, -1)
+        else:
+            block = chunk.reshape(last - first, in_seq_len, 2 * action_dim)
+            block[:, :, :action_dim] = train_seq_buffer[in_index]
+            block[:, :, action_dim:] = test_seq_buffer[out_index]
+
+        if writers is not None:
+            writers[0].append(chunk)
+            writers[1].append(np.full((last - first, 1), label, dtype=label_dtype))
+
+    if writers is not None:
+        return None, None
+    labels = np.full((num_pairs, 1), label, dtype=label_dtype)
+    # A single pair is kept flat, as it used to be before being stacked with the next ones
+    if num_pairs == 1:
+        return pairs[0], labels[0]
+    return pairs, labels
+
+
 def generate_correlated_decorrelated_pairs(
         test_seq_buffer, train_seq_buffer, test_trajectories_end_index, train_trajectories_end_index, train_size,
         num_trajectories, train_start_states, label, do_train, correlation=CORRELATED, test_padding_len=None,
         train_padding_len=None, padding_len=None, fixed_padding_size=25,
-        pairing_mode='horizontal', truncate_traj=False):
+        pairing_mode='horizontal', truncate_traj=False, pair_writers=None):
     """
     Randomly selects start states, action train/test_seq_buffer, and label
     A trajectory length is set using args.max_traj_len. This value should be the length of the entire
     trajectory.
+    pair_writers is an optional (train, eval) tuple of (pairs, labels) NpyAppender the pairs are streamed to.
     """
-    final_train_dataset = None
-    final_train_dataset_label = None
-    final_eval_dataset = None
-    final_eval_dataset_label = None
-
     if do_train:
         logger.info(f"generating {CORRELATION_MAP.get(correlation)} pairs... ")
     else:
         logger.info("generating CORRELATED pairs for prediction... ")
 
-    for j in range(num_trajectories):
-
-        if do_train and j >= train_size:
-            if pairing_mode == 'horizontal':
-                if correlation == 'DECORRELATED':
-                    eval_in_seq = train_seq_buffer[np.random.choice(
-                        train_seq_buffer.shape[0], train_padding_len, replace=True), :]
-                else:
-                    eval_in_seq = pad_traj(
-                        train_seq_buffer[train_trajectories_end_index[j - 1] + 1:
-                                         train_trajectories_end_index[j] + 1, :],
-                        train_padding_len, fixed_padding_size, truncate_traj)
-                eval_out_seq = pad_traj(
-                    test_seq_buffer[test_trajectories_end_index[j-1] + 1: test_trajectories_end_index[j] + 1, :],
-                    test_padding_len, fixed_padding_size, truncate_traj)
-            elif pairing_mode == 'vertical':
-                if correlation == 'DECORRELATED':
-                    eval_in_seq = train_seq_buffer[np.random.choice(
-                        train_seq_buffer.shape[0], padding_len, replace=True), :]
-                else:
-                    eval_in_seq = pad_traj(
-                        train_seq_buffer[train_trajectories_end_index[j - 1] + 1:
-                                         train_trajectories_end_index[j] + 1, :], padding_len,
-                        fixed_padding_size, truncate_traj)
-                eval_out_seq = pad_traj(
-                    test_seq_buffer[test_trajectories_end_index[j-1] + 1: test_trajectories_end_index[j] + 1, :],
-                    padding_len, fixed_padding_size, truncate_traj)
-            else:
-                raise NotImplementedError
-            if CORRELATION_MAP.get(correlation) == 'SEMI_CORRELATED':
-                np.random.shuffle(eval_in_seq)
-            if pairing_mode == 'horizontal':
-                complete_traj_eval_seq = np.concatenate((eval_in_seq, eval_out_seq))
-                complete_traj_eval_seq = np.ravel(complete_traj_eval_seq)
-            else:
-                complete_traj_eval_seq = np.concatenate((eval_in_seq, eval_out_seq), axis=1)
-                complete_traj_eval_seq = np.ravel(complete_traj_eval_seq)
-
-            final_eval_dataset_label = np.array([label]) if not isinstance(
-                final_eval_dataset_label, np.ndarray) else np.vstack((final_eval_dataset_label, np.array([label])))
-            final_eval_dataset = complete_traj_eval_seq if not isinstance(
-                final_eval_dataset, np.ndarray) else np.vstack((final_eval_dataset, complete_traj_eval_seq))
-
-        else:
-            if pairing_mode == 'horizontal':
-                if j == 0 and CORRELATION_MAP.get(correlation) == 'DECORRELATED' and do_train:
-                    in_seq = train_seq_buffer[np.random.choice(
-                        train_seq_buffer.shape[0], train_padding_len, replace=True), :]
-                    out_seq = pad_traj(test_seq_buffer[0: test_trajectories_end_index[0] + 1, :], test_padding_len,
-                                       fixed_padding_size, truncate_traj)
-                elif j == 0:
-                    in_seq = pad_traj(train_seq_buffer[0: train_trajectories_end_index[0] + 1, :], train_padding_len,
-                                      fixed_padding_size, truncate_traj)
-                    out_seq = pad_traj(test_seq_buffer[0: test_trajectories_end_index[0] + 1, :], test_padding_len,
-                                       fixed_padding_size, truncate_traj)
-                else:
-                    if CORRELATION_MAP.get(correlation) == 'DECORRELATED' and do_train:
-                        in_seq = train_seq_buffer[np.random.choice(
-                            train_seq_buffer.shape[0], train_padding_len, replace=True), :]
-                    else:
-                        in_seq = pad_traj(
-                            train_seq_buffer[train_trajectories_end_index[j - 1] + 1:
-                                             train_trajectories_end_index[j] + 1, :], train_padding_len,
-                            fixed_padding_size, truncate_traj)
-                    out_seq = pad_traj(
-                        test_seq_buffer[test_trajectories_end_index[j-1] + 1: test_trajectories_end_index[j] + 1, :],
-                        test_padding_len, fixed_padding_size, truncate_traj)
-            elif pairing_mode == 'vertical':
-                if j == 0 and CORRELATION_MAP.get(correlation) == 'DECORRELATED' and do_train:
-                    in_seq = train_seq_buffer[np.random.choice(
-                        train_seq_buffer.shape[0], padding_len, replace=True), :]
-                    out_seq = pad_traj(test_seq_buffer[0: test_trajectories_end_index[0] + 1, :], padding_len,
-                                       fixed_padding_size, truncate_traj)
-                elif j == 0:
-                    in_seq = pad_traj(train_seq_buffer[0: train_trajectories_end_index[0] + 1, :],
-                                      padding_len, fixed_padding_size, truncate_traj)
-                    out_seq = pad_traj(test_seq_buffer[0: test_trajectories_end_index[0] + 1, :],
-                                       padding_len, fixed_padding_size, truncate_traj)
-                else:
-                    if CORRELATION_MAP.get(correlation) == 'DECORRELATED' and do_train:
-                        in_seq = train_seq_buffer[np.random.choice(
-                            train_seq_buffer.shape[0], padding_len, replace=True), :]
-                    else:
-                        in_seq = pad_traj(
-                            train_seq_buffer[train_trajectories_end_index[j-1] + 1: train_trajectories_end_index[j] + 1, :],
-                            padding_len, fixed_padding_size, truncate_traj)
-                    out_seq = pad_traj(
-                        test_seq_buffer[test_trajectories_end_index[j-1] + 1: test_trajectories_end_index[j] + 1, :],
-                        padding_len, fixed_padding_size, truncate_traj)
-            else:
-                raise ValueError('No padding length defined!')
-            if CORRELATION_MAP.get(correlation) == 'SEMI_CORRELATED' and do_train:
-                np.random.shuffle(in_seq)
-            if pairing_mode == 'horizontal':
-                complete_traj_seq = np.concatenate((in_seq, out_seq))
-                complete_traj_seq = np.ravel(complete_traj_seq)
-            else:
-                complete_traj_seq = np.concatenate((in_seq, out_seq), axis=1)
-                complete_traj_seq = np.ravel(complete_traj_seq)
-
-            final_train_dataset_label = np.array([label]) if not isinstance(
-                final_train_dataset_label, np.ndarray) else np.vstack((final_train_dataset_label, np.array([label])))
-            final_train_dataset = complete_traj_seq if not isinstance(
-                final_train_dataset, np.ndarray) else np.vstack((final_train_dataset, complete_traj_seq))
+    if pairing_mode == 'horizontal':
+        in_padding_len, out_padding_len = train_padding_len, test_padding_len
+    elif pairing_mode == 'vertical':
+        in_padding_len = out_padding_len = padding_len
+    else:
+        raise ValueError('No padding length defined!')
+
+    num_trajectories = int(num_trajectories)
+    num_train_pairs = min(train_size, num_trajectories) if do_train else num_trajectories
+    train_start_index, train_end_index = get_trajectory_bounds(train_trajectories_end_index, num_trajectories)
+    test_start_index, test_end_index = get_trajectory_bounds(test_trajectories_end_index, num_trajectories)
+    train_rows = slice(0, num_train_pairs)
+    eval_rows = slice(num_train_pairs, num_trajectories)
+
+    final_train_dataset, final_train_dataset_label = build_pairs(
+        train_seq_buffer, test_seq_buffer, (train_start_index[train_rows], train_end_index[train_rows]),
+        (test_start_index[train_rows], test_end_index[train_rows]), label, in_padding_len, out_padding_len,
+        fixed_padding_size, pairing_mode, truncate_traj,
+        decorrelated=CORRELATION_MAP.get(correlation) == DECORRELATED and do_train,
+        shuffle=CORRELATION_MAP.get(correlation) == SEMI_CORRELATED and do_train,
+        writers=pair_writers[0] if pair_writers else None)
+    # Note: the eval pairs compare the raw correlation argument (not its CORRELATION_MAP entry) to DECORRELATED
+    final_eval_dataset, final_eval_dataset_label = build_pairs(
+        train_seq_buffer, test_seq_buffer, (train_start_index[eval_rows], train_end_index[eval_rows]),
+        (test_start_index[eval_rows], test_end_index[eval_rows]), label, in_padding_len, out_padding_len,
+        fixed_padding_size, pairing_mode, truncate_traj,
+        decorrelated=correlation == DECORRELATED,
+        shuffle=CORRELATION_MAP.get(correlation) == SEMI_CORRELATED,
+        writers=pair_writers[1] if pair_writers else None)
 
     if do_train:
         logger.info(f"generating {CORRELATION_MAP.get(correlation)} pairs... Done!")
@@ -465,12 +489,9 @@ def rsme(errors):
 
 
 def calc_errors(classifier_predictions, labels_test, threshold, num_predictions):
-    errors = []
-    for i in range(num_predictions):
-        e_i = (labels_test[i] - classifier_predictions[i]) / (labels_test[i] - threshold)
-        errors.append(e_i)
-
-    return errors
+    labels_test = np.asarray(labels_test, dtype=np.float64).ravel()[:num_predictions]
+    classifier_predictions = np.asarray(classifier_predictions, dtype=np.float64).ravel()[:num_predictions]
+    return (labels_test - classifier_predictions) / (labels_test - threshold)
 
 
 def baseline_accuracy(labels_test, num_predictions):
@@ -496,115 +517,107 @@ def baseline_accuracy(labels_test, num_predictions):
     return output_prec_recall(true_positives, true_negatives, false_negatives, false_positives, num_predictions)
 
 
-def accuracy_report_2(classifier_predictions, labels_test, threshold, num_predictions, results):
-    # false_positives = 0
-    # false_negatives = 0
-    # true_positives = 0
-    # true_negatives = 0
-    # for i in range(num_predictions):
-    #     if classifier_predictions[i] >= threshold[i] and labels_test[i] == 1:
-    #         true_positives += 1
-    #     elif classifier_predictions[i] < threshold[i] and labels_test[i] == 0:
-    #         true_negatives += 1
-    #
-    #     # false negative (classifier is saying out but labels say in)
-    #     elif classifier_predictions[i] < threshold[i] and labels_test[i] == 1:
-    #         false_negatives += 1
-    #
-    #     # false positive (classifier is saying in but labels say out)
-    #     elif classifier_predictions[i] >= threshold[i] and labels_test[i] == 0:
-    #         false_positives += 1
-    # logger.info(f"Threshold = {threshold[i]}: true_positive = {true_positives}, true_negative = {true_negatives}, "
-    #             f"false_positive = {false_positives}, false_negative={false_negatives}")
-    accuracy = np.zeros(len(threshold))
-    precision = np.zeros(len(threshold))
-    recall = np.zeros(len(threshold))
-    RMSE_e_i = np.zeros(len(threshold))
-    mcc = np.zeros(len(threshold))
-    f1 = np.zeros(len(threshold))
+def confusion_counts(classifier_predictions, labels_test, threshold):
+    """
+    Counts the true/false positives/negatives for every threshold, a prediction >= threshold meaning "in".
+    The predictions are sorted once; the counts for each threshold are then read from cumulative sums.
+    """
+    classifier_predictions = np.asarray(classifier_predictions).ravel()
+    if not np.issubdtype(classifier_predictions.dtype, np.floating):
+        classifier_predictions = classifier_predictions.astype(np.float64)
+    # the thresholds are compared in the predictions' precision (e.g. float32 for xgboost), as prediction >= threshold
+    # does for a single prediction
+    threshold = np.asarray(threshold).astype(classifier_predictions.dtype)
+    labels_test = np.asarray(labels_test).ravel()
+    # NaN predictions are neither above nor below any threshold
+    valid = ~np.isnan(classifier_predictions)
+    order = np.argsort(classifier_predictions[valid], kind='mergesort')
+    sorted_predictions = classifier_predictions[valid][order]
+    sorted_labels = labels_test[valid][order]
+    positives_below = np.concatenate(([0], np.cumsum(sorted_labels == 1)))
+    negatives_below = np.concatenate(([0], np.cumsum(sorted_labels == 0)))
+
+    num_below = np.searchsorted(sorted_predictions, threshold, side='left')
+    false_negatives = positives_below[num_below]
+    true_negatives = negatives_below[num_below]
+    true_positives = positives_below[-1] - false_negatives
+    false_positives = negatives_below[-1] - true_negatives
+    return true_positives, true_negatives, false_positives, false_negatives
+
+
+def threshold_metrics(classifier_predictions, labels_test, threshold, num_predictions):
+    """
+    Sweeps the thresholds over the first num_predictions predictions and returns, for each of them, the
+    confusion counts, the output_prec_recall metrics and the gmean error.
+    """
+    classifier_predictions = np.asarray(classifier_predictions).ravel()[:num_predictions]
+    labels_test = np.asarray(labels_test).ravel()[:num_predictions]
+    true_positives, true_negatives, false_positives, false_negatives = confusion_counts(
+        classifier_predictions, labels_test, threshold)
+
+    sweep = {'true_positives': true_positives, 'true_negatives': true_negatives,
+             'false_positives': false_positives, 'false_negatives': false_negatives}
+    for key in ['accuracy', 'precision', 'recall', 'mcc', 'f1', 'rmse']:
+        sweep[key] = np.zeros(len(threshold))
     for j in range(len(threshold)):
-        false_positives = 0
-        false_negatives = 0
-        true_positives = 0
-        true_negatives = 0
-        for i in range(num_predictions):
-            if classifier_predictions[i] >= threshold[j] and labels_test[i] == 1:
-                true_positives += 1
-            elif classifier_predictions[i] < threshold[j] and labels_test[i] == 0:
-                true_negatives += 1
+        sweep['accuracy'][j], sweep['precision'][j], sweep['recall'][j], sweep['mcc'][j], sweep['f1'][j] = \
+            output_prec_recall(int(true_positives[j]), int(true_negatives[j]), int(false_negatives[j]),
+                               int(false_positives[j]), num_predictions)
+        sweep['rmse'][j] = rsme(calc_errors(classifier_predictions, labels_test, threshold[j], num_predictions))
+    return sweep
+
+
+def roc_pr_curves(classifier_predictions, labels_test):
+    """
+    Computes the full ROC and precision/recall curves, using every distinct prediction as a threshold, along
+    with the area under the ROC curve and the average precision (area under the precision/recall curve).
+    """
+    classifier_predictions = np.asarray(classifier_predictions, dtype=np.float64).ravel()
+    # decreasing thresholds, so that the curves start from the (0, 0) corner
+    thresholds = np.unique(classifier_predictions[~np.isnan(classifier_predictions)])[::-1]
+    true_positives, true_negatives, false_positives, false_negatives = confusion_counts(
+        classifier_predictions, labels_test, thresholds)
+    num_positives = true_positives[-1] + false_negatives[-1] if len(thresholds) else 0
+    num_negatives = false_positives[-1] + true_negatives[-1] if len(thresholds) else 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fpr = np.concatenate(([0.], false_positives / num_negatives))
+        tpr = np.concatenate(([0.], true_positives / num_positives))
+        precision = true_positives / (true_positives + false_positives)
+        recall = true_positives / num_positives
+    roc_auc = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+    average_precision = np.sum(np.diff(np.concatenate(([0.], recall))) * precision)
+    return (fpr, tpr, thresholds, roc_auc), (precision, recall, thresholds, average_precision)
 
-            # false negative (classifier is saying out but labels say in)
-            elif classifier_predictions[i] < threshold[j] and labels_test[i] == 1:
-                false_negatives += 1
 
-            # false positive (classifier is saying in but labels say out)
-            elif classifier_predictions[i] >= threshold[j] and labels_test[i] == 0:
-                false_positives += 1
+def accuracy_report_2(classifier_predictions, labels_test, threshold, num_predictions, results):
+    sweep = threshold_metrics(classifier_predictions, labels_test, threshold, num_predictions)
+    for j in range(len(threshold)):
         logger.info(
-            f"Threshold = {threshold[j]}: true_positive = {true_positives}, true_negative = {true_negatives}, "
-            f"false_positive = {false_positives}, false_negative={false_negatives}")
+            f"Threshold = {threshold[j]}: true_positive = {sweep['true_positives'][j]}, "
+            f"true_negative = {sweep['true_negatives'][j]}, false_positive = {sweep['false_positives'][j]}, "
+            f"false_negative={sweep['false_negatives'][j]}")
+
+        results = f"{results}\nThreshold = {threshold[j]}: true_positive = {sweep['true_positives'][j]}, " \
+                  f"true_negative = {sweep['true_negatives'][j]}, false_positive = {sweep['false_positives'][j]}, " \
+                  f"false_negative={sweep['false_negatives'][j]}, MCC = {sweep['mcc'][j]}, F1 = {sweep['f1'][j]}, " \
+                  f"accuracy = {sweep['accuracy'][j]}"
 
-        accuracy[j], precision[j], recall[j], mcc[j], f1[j] = output_prec_recall(true_positives, true_negatives,
-                                                                                 false_negatives, false_positives,
-                                                                                 num_predictions)
-        RMSE_e_i[j] = rsme(calc_errors(classifier_predictions, labels_test, threshold[j], num_predictions))
+    (_, _, _, roc_auc), (_, _, _, average_precision) = roc_pr_curves(
+        np.asarray(classifier_predictions).ravel()[:num_predictions], np.asarray(labels_test).ravel()[:num_predictions])
+    logger.info(f"ROC AUC = {roc_auc}, PR AUC (average precision) = {average_precision}")
+    results = f"{results}\nROC AUC = {roc_auc}, PR AUC (average precision) = {average_precision}"
+    return sweep['accuracy'], sweep['precision'], sweep['recall'], sweep['rmse'], results
 
-        results = f"{results}\nThreshold = {threshold[j]}: true_positive = {true_positives}, " \
-                  f"true_negative = {true_negatives}, false_positive = {false_positives}, " \
-                  f"false_negative={false_negatives}, MCC = {mcc[j]}, F1 = {f1[j]}, accuracy = {accuracy[j]}"
-    return accuracy, precision, recall, RMSE_e_i, results
 
 def accuracy_report(classifier_predictions, labels_test, threshold, num_predictions):
-    # false_positives = 0
-    # false_negatives = 0
-    # true_positives = 0
-    # true_negatives = 0
-    accuracy = np.zeros(len(threshold))
-    precision = np.zeros(len(threshold))
-    recall = np.zeros(len(threshold))
-    RMSE_e_i = np.zeros(len(threshold))
+    sweep = threshold_metrics(classifier_predictions, labels_test, threshold, num_predictions)
     for j in range(len(threshold)):
-        false_positives = 0
-        false_negatives = 0
-        true_positives = 0
-        true_negatives = 0
-        for i in range(num_predictions):
-            if classifier_predictions[i] >= threshold[j] and labels_test[i] == 1:
-                true_positives += 1
-            elif classifier_predictions[i] < threshold[j] and labels_test[i] == 0:
-                true_negatives += 1
-
-            # false negative (classifier is saying out but labels say in)
-            elif classifier_predictions[i] < threshold[j] and labels_test[i] == 1:
-                false_negatives += 1
-
-            # false positive (classifier is saying in but labels say out)
-            elif classifier_predictions[i] >= threshold[j] and labels_test[i] == 0:
-                false_positives += 1
         logger.info(
-            f"Threshold = {threshold[j]}: true_positive = {true_positives}, true_negative = {true_negatives}, "
-            f"false_positive = {false_positives}, false_negative={false_negatives}")
-        accuracy[j], precision[j], recall[j], mcc[j] = output_prec_recall(
-            true_positives, true_negatives, false_negatives, false_positives, num_predictions)
-        RMSE_e_i[j] = rsme(calc_errors(classifier_predictions, labels_test, threshold[j], num_predictions))
-    # for i in range(num_predictions):
-    #     if classifier_predictions[i] >= threshold and labels_test[i] == 1:
-    #         true_positives += 1
-    #     elif classifier_predictions[i] < threshold and labels_test[i] == 0:
-    #         true_negatives += 1
-    #
-    #     # false negative (classifier is saying out but labels say in)
-    #     elif classifier_predictions[i] < threshold and labels_test[i] == 1:
-    #         false_negatives += 1
-    #
-    #     # false positive (classifier is saying in but labels say out)
-    #     elif classifier_predictions[i] >= threshold and labels_test[i] == 0:
-    #         false_positives += 1
-    # logger.info(
-    #     f"true_positive={true_positives}, true_negative={true_negatives}, false_positive={false_positives}"
-    #     f", false_negative={false_negatives}")
-    # return output_prec_recall(true_positives, true_negatives, false_negatives, false_positives, num_predictions)
-    return accuracy, precision, recall, RMSE_e_i
+            f"Threshold = {threshold[j]}: true_positive = {sweep['true_positives'][j]}, "
+            f"true_negative = {sweep['true_negatives'][j]}, false_positive = {sweep['false_positives'][j]}, "
+            f"false_negative={sweep['false_negatives'][j]}")
+    return sweep['accuracy'], sweep['precision'], sweep['recall'], sweep['rmse']
 
 
 def output_prec_recall(tp, tn, fn, fp, total):
@@ -697,6 +710,8 @@ def train_classifier(xgb1, xgb_train, xgb_eval, early_stopping_rounds=10, num_ro
              'seed': 27,
              'eval_metric': 'mae',
              'n_jobs': -1}
+    if xgb1.get_params().get('tree_method'):
+        param['tree_method'] = xgb1.get_params()['tree_method']
 
     watch_list = [(xgb_train, 'train'), (xgb_eval, 'eval')]
     evals_result = {}
@@ -745,17 +760,181 @@ def log_eval(period=1, show_stdv=True):
     return callback
 
 
-def train_attack_model_v4(file_path_results, pair_path_results, args):
+def tune_xgb(xgb1, args, tune_n_estimators, grid_search):
+    """
+    Tunes the hyper parameters of xgb1 in stages: n_estimators, (max_depth, min_child_weight), gamma,
+    n_estimators again, (subsample, colsample_bytree) and reg_alpha. Stages whose vectors are empty are skipped.
+    tune_n_estimators(xgb1) sets n_estimators with early stopping and grid_search(xgb1, param_grid) sets the best
+    parameters of param_grid.
+    """
+    def search(param_grid):
+        grid_search(xgb1, {name: values for name, values in param_grid.items() if values})
+
+    tune_n_estimators(xgb1)
+    if args.max_depth_vector or args.min_child_weight_vector:
+        search({'max_depth': args.max_depth_vector, 'min_child_weight': args.min_child_weight_vector})
+    if args.gamma_vector:
+        search({'gamma': args.gamma_vector})
+
+    if (args.max_depth_vector or args.min_child_weight_vector or args.gamma_vector) and \
+            (args.subsample_vector or args.colsample_bytree_vector or args.reg_alpha_vector):
+        xgb1.set_params(n_estimators=args.xgb_n_rounds)
+        tune_n_estimators(xgb1)
+
+    if args.subsample_vector or args.colsample_bytree_vector:
+        search({'subsample': args.subsample_vector, 'colsample_bytree': args.colsample_bytree_vector})
+    if args.reg_alpha_vector:
+        search({'reg_alpha': args.reg_alpha_vector})
+
+    xgb1.set_params(n_estimators=args.xgb_n_rounds)
+
+
+def tune_xgb_cv(xgb1, args, make_folds, workers=0):
+    """
+    Runs tune_xgb with a CVSearch over the folds built by make_folds, spread over workers processes (see CVSearch).
+    """
+    search = CVSearch(make_folds, 5, args.xgb_n_rounds, early_stopping_rounds=args.early_stopping_rounds,
+                      workers=workers, halving=args.successive_halving)
+    try:
+        tune_xgb(xgb1, args, search.tune_n_estimators, search.grid_search)
+    finally:
+        search.close()
+
+
+def in_memory_dmatrices(xgb1, train_sources, eval_sources, args):
+    """
+    Stacks and shuffles the (x, y) lists of positive and negative train/eval pair matrices, tunes xgb1 on them
+    with 5-fold cross validation if args.cv_tune_xgb is set, and returns the classifier train/eval DMatrix.
+    """
+    attack_train_data_x = np.vstack(train_sources[0])
+    attack_train_data_y = np.vstack(train_sources[1])
+    attack_train_data_x1, attack_train_data_y1 = shuffle_xgboost_params(attack_train_data_x, attack_train_data_y)
+    attack_train_data_x, attack_train_data_y = shuffle_xgboost_params(attack_train_data_x1, attack_train_data_y1)
+
+    attack_eval_data_x = np.vstack(eval_sources[0])
+    attack_eval_data_y = np.vstack(eval_sources[1])
+    attack_eval_data_x1, attack_eval_data_y1 = shuffle_xgboost_params(attack_eval_data_x, attack_eval_data_y)
+    attack_eval_data_x, attack_eval_data_y = shuffle_xgboost_params(attack_eval_data_x1, attack_eval_data_y1)
+
+    if args.cv_tune_xgb:
+        attack_train_eval_x = np.vstack((attack_train_data_x, attack_eval_data_x))
+        attack_train_eval_y = np.ravel(np.vstack((attack_train_data_y, attack_eval_data_y)))
+        tune_xgb_cv(xgb1, args, functools.partial(kfold_dmatrices, attack_train_eval_x, attack_train_eval_y, 5),
+                    workers=args.tune_workers)
+
+    return xgb.DMatrix(attack_train_data_x, attack_train_data_y), xgb.DMatrix(attack_eval_data_x, attack_eval_data_y)
+
+
+def shuffled_index(num_rows):
+    """Row order given by two shuffle_xgboost_params calls, drawn from the same random numbers"""
+    first = np.random.permutation(num_rows)
+    return first[np.random.permutation(num_rows)]
+
 
-    logger.info("loading the train/eval pairs ...")
-    attack_train_data_pos_x = np.load(pair_path_results + '/train_positive_x.npy')
-    attack_train_data_pos_y = np.load(pair_path_results + '/train_positive_y.npy')
-    attack_train_data_neg_x = np.load(pair_path_results + '/train_negative_x.npy')
-    attack_train_data_neg_y = np.load(pair_path_results + '/train_negative_y.npy')
-    attack_eval_data_pos_x = np.load(pair_path_results + '/eval_positive_x.npy')
-    attack_eval_data_pos_y = np.load(pair_path_results + '/eval_positive_y.npy')
-    attack_eval_data_neg_x = np.load(pair_path_results + '/eval_negative_x.npy')
-    attack_eval_data_neg_y = np.load(pair_path_results + '/eval_negative_y.npy')
+def gather_rows(sources, index):
+    """Gathers the rows index of the sources stacked on top of each other, without stacking them"""
+    offsets = np.cumsum([0] + [rows.shape[0] for rows in sources])
+    source = np.searchsorted(offsets, index, side='right') - 1
+    gathered = np.empty((len(index),) + sources[0].shape[1:], dtype=np.result_type(*sources))
+    for k, rows in enumerate(sources):
+        mask = source == k
+        gathered[mask] = rows[index[mask] - offsets[k]]
+    return gathered
+
+
+class PairsIter(getattr(xgb, 'DataIter', object)):
+    """
+    Feeds XGBoost with the rows index of the stacked x_sources (labels from y_sources) one chunk at a time, so that
+    an external memory DMatrix can be built from the memory-mapped pair stores (requires xgboost >= 1.5).
+    """
+
+    def __init__(self, x_sources, y_sources, index, cache_prefix, chunk_size=XGB_ITER_CHUNK_SIZE):
+        super().__init__(cache_prefix=cache_prefix)
+        self.x_sources = x_sources
+        self.y_sources = y_sources
+        self.index = index
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    def next(self, input_data):
+        if self.position >= len(self.index):
+            return 0
+        chunk = self.index[self.position:self.position + self.chunk_size]
+        input_data(data=gather_rows(self.x_sources, chunk), label=np.ravel(gather_rows(self.y_sources, chunk)))
+        self.position += self.chunk_size
+        return 1
+
+    def reset(self):
+        self.position = 0
+
+
+def pairs_dmatrix(x_sources, y_sources, index, cache_prefix):
+    """External memory DMatrix of the rows index of the stacked pair matrices, cached under cache_prefix"""
+    return xgb.DMatrix(PairsIter(x_sources, y_sources, index, cache_prefix))
+
+
+def cv_fold_dmatrices(x_sources, y_sources, index, cv_folds, cache_prefix):
+    """(train, test) DMatrix of every fold of a K-fold split of index. They are built once and reused by every fit"""
+    folds = np.array_split(index, cv_folds)
+    return [(pairs_dmatrix(x_sources, y_sources, np.concatenate(folds[:k] + folds[k + 1:]),
+                           f"{cache_prefix}_{k}_train"),
+             pairs_dmatrix(x_sources, y_sources, folds[k], f"{cache_prefix}_{k}_test"))
+            for k in range(cv_folds)]
+
+
+def external_memory_dmatrices(xgb1, train_sources, eval_sources, args, cache_dir):
+    """
+    Same as in_memory_dmatrices, without stacking the pair matrices in memory: the rows are streamed in shuffled
+    order by PairsIter into external memory DMatrix cached under cache_dir, and all the CV tuning stages reuse the
+    same fold matrices. The folds are only built in this process, so the tuning fits are not spread over workers.
+    """
+    if not hasattr(xgb, 'DataIter'):
+        raise ValueError("Training the attack classifier from external memory requires xgboost >= 1.5")
+    os.makedirs(cache_dir, exist_ok=True)
+    train_index = shuffled_index(sum(rows.shape[0] for rows in train_sources[0]))
+    eval_index = shuffled_index(sum(rows.shape[0] for rows in eval_sources[0]))
+
+    if args.cv_tune_xgb:
+        logger.info("building the cross validation folds ...")
+        tune_xgb_cv(xgb1, args, functools.partial(
+            cv_fold_dmatrices, train_sources[0] + eval_sources[0], train_sources[1] + eval_sources[1],
+            np.concatenate((train_index, eval_index + len(train_index))), 5, f"{cache_dir}/cv"))
+
+    return (pairs_dmatrix(train_sources[0], train_sources[1], train_index, f"{cache_dir}/train"),
+            pairs_dmatrix(eval_sources[0], eval_sources[1], eval_index, f"{cache_dir}/eval"))
+
+
+def save_pairs(pair_path_results, pairs):
+    """Saves the pair matrices (see generate_attack_pairs) under pair_path_results"""
+    for name, data in pairs.items():
+        np.save(f"{pair_path_results}/{name}", data)
+    logger.info("saving pairs ... Done")
+
+
+def load_pairs(pair_path_results, names):
+    """Memory-maps the pair matrices saved by save_pairs (or streamed by generate_attack_pairs)"""
+    return {name: np.load(f"{pair_path_results}/{name}.npy", mmap_mode='r') for name in names}
+
+
+def train_attack_model_v4(file_path_results, pair_path_results, args, pairs=None):
+    """
+    Trains the attack classifier on the train/eval pairs and evaluates it on the test pairs.
+    The pairs are read from pair_path_results unless they are handed over in memory (see generate_attack_pairs).
+    """
+    if pairs is None:
+        logger.info("loading the train/eval pairs ...")
+        train_eval_pairs = load_pairs(pair_path_results, TRAIN_EVAL_PAIRS)
+    else:
+        train_eval_pairs = pairs
+    attack_train_data_pos_x = train_eval_pairs['train_positive_x']
+    attack_train_data_pos_y = train_eval_pairs['train_positive_y']
+    attack_train_data_neg_x = train_eval_pairs['train_negative_x']
+    attack_train_data_neg_y = train_eval_pairs['train_negative_y']
+    attack_eval_data_pos_x = train_eval_pairs['eval_positive_x']
+    attack_eval_data_pos_y = train_eval_pairs['eval_positive_y']
+    attack_eval_data_neg_x = train_eval_pairs['eval_negative_x']
+    attack_eval_data_neg_y = train_eval_pairs['eval_negative_y']
+    del train_eval_pairs
 
     num_rows, _ = attack_train_data_pos_x.shape
 
@@ -777,19 +956,6 @@ def train_attack_model_v4(file_path_results, pair_path_results, args):
     attack_eval_data_neg_y = attack_eval_data_neg_y[0:args.train_size - int(round(args.train_size * 0.8)), :] if \
         args.train_size * 0.8 < num_rows else attack_eval_data_neg_y
 
-    attack_train_data_x = np.vstack((attack_train_data_pos_x, attack_train_data_neg_x))
-    attack_train_data_y = np.vstack((attack_train_data_pos_y, attack_train_data_neg_y))
-    attack_train_data_x1, attack_train_data_y1 = shuffle_xgboost_params(attack_train_data_x, attack_train_data_y)
-    attack_train_data_x, attack_train_data_y = shuffle_xgboost_params(attack_train_data_x1, attack_train_data_y1)
-
-    attack_eval_data_x = np.vstack((attack_eval_data_pos_x, attack_eval_data_neg_x))
-    attack_eval_data_y = np.vstack((attack_eval_data_pos_y, attack_eval_data_neg_y))
-    attack_eval_data_x1, attack_eval_data_y1 = shuffle_xgboost_params(attack_eval_data_x, attack_eval_data_y)
-    attack_eval_data_x, attack_eval_data_y = shuffle_xgboost_params(attack_eval_data_x1, attack_eval_data_y1)
-
-    attack_train_eval_x = np.vstack((attack_train_data_x, attack_eval_data_x))
-    attack_train_eval_y = np.vstack((attack_train_data_y, attack_eval_data_y))
-    attack_train_eval_y = np.ravel(attack_train_eval_y)
     logger.info("loading the train/eval pairs ... Done")
     logger.info("Setting up the xgb properties ...")
     xgb1 = XGBClassifier(
@@ -805,109 +971,42 @@ def train_attack_model_v4(file_path_results, pair_path_results, args):
         nthread=4,
         scale_pos_weight=1,
         seed=27,
-        use_label_encoder=False
+        use_label_encoder=False,
+        tree_method='hist' if args.xgb_external_memory else None
     )
 
+    train_sources = ([attack_train_data_pos_x, attack_train_data_neg_x],
+                     [attack_train_data_pos_y, attack_train_data_neg_y])
+    eval_sources = ([attack_eval_data_pos_x, attack_eval_data_neg_x], [attack_eval_data_pos_y, attack_eval_data_neg_y])
+    num_training_samples = attack_train_data_pos_x.shape[0] + attack_train_data_neg_x.shape[0]
+    num_eval_samples = attack_eval_data_pos_x.shape[0] + attack_eval_data_neg_x.shape[0]
+    xgb_cache_dir = f"{pair_path_results}/xgb_cache"
     results = ""
-
-    if args.cv_tune_xgb:
-
-        modelfit(xgb1, attack_train_eval_x, attack_train_eval_y, early_stopping_rounds=args.early_stopping_rounds)
-
-        if args. max_depth_vector or args.min_child_weight_vector:
-
-            param_test1 = {
-                'max_depth': args.max_depth_vector,
-                'min_child_weight': args.min_child_weight_vector
-            }
-            gsearch1 = GridSearchCV(
-                estimator=xgb1, param_grid=param_test1, scoring='neg_mean_absolute_error', cv=5)
-
-            gsearch1.fit(attack_train_eval_x, attack_train_eval_y)
-            # logger.info(gsearch1.cv_results_)
-            logger.info(f"best parameter: {gsearch1.best_params_}")
-            logger.info(f"best score: {gsearch1.best_score_}")
-
-        # param_test2 = {
-        #     'max_depth': range(3, 20, 2),
-        #     'min_child_weight': range(2, 10, 2)
-        # }
-        # gsearch2 = GridSearchCV(
-        #     estimator=xgb1, param_grid=param_test2, scoring='neg_mean_absolute_error', n_jobs=4, cv=5)
-        # gsearch2.fit(attack_train_eval_x, attack_train_eval_y)
-        # logger.info(f"best parameter: {gsearch2.best_params_}")
-        # logger.info(f"best score: {gsearch2.best_score_}")
-
-        # modelfit(gsearch1.best_estimator_, attack_train_eval_x, attack_train_eval_y, t)
-        # xgb1.set_params(max_depth=gsearch1.best_params_['max_depth'] if gsearch1.best_score_ >= gsearch2.best_score_
-        # else gsearch2.best_params_['max_depth'], min_child_weight=gsearch1.best_params_['min_child_weight']
-        # if gsearch1.best_score_ >= gsearch2.best_score_ else gsearch2.best_params_['min_child_weight'])
-
-            xgb1.set_params(max_depth=gsearch1.best_params_['max_depth'],
-                            min_child_weight=gsearch1.best_params_['min_child_weight'])
-        if args.gamma_vector:
-
-            param_test3 = {
-                'gamma': args.gamma_vector
-            }
-
-            gsearch3 = GridSearchCV(
-                estimator=xgb1, param_grid = param_test3, scoring='neg_mean_absolute_error', cv=5)
-            gsearch3.fit(attack_train_eval_x, attack_train_eval_y)
-            logger.info(f"best parameter: {gsearch3.best_params_}")
-            logger.info(f"best score: {gsearch3.best_score_}")
-            xgb1.set_params(gamma=gsearch3.best_params_['gamma'])
-
-        if (args.max_depth_vector or args.min_child_weight_vector or args.gamma_vector) and \
-                (args.subsample_vector or args.colsample_bytree_vector or args.reg_alpha_vector):
-
-            xgb1.set_params(n_estimators=args.xgb_n_rounds)
-            modelfit(xgb1, attack_train_eval_x, attack_train_eval_y, early_stopping_rounds=args.early_stopping_rounds)
-
-        if args.subsample_vector or args.colsample_bytree_vector:
-            param_test4 = {
-                'subsample': args.subsample_vector,
-                'colsample_bytree': args.colsample_bytree_vector
-            }
-
-            gsearch4 = GridSearchCV(estimator=xgb1, param_grid=param_test4,
-                                    scoring='neg_mean_absolute_error', cv=5)
-            gsearch4.fit(attack_train_eval_x, attack_train_eval_y)
-            logger.info(f"best parameter: {gsearch4.best_params_}")
-            logger.info(f"best score: {gsearch4.best_score_}")
-
-            xgb1.set_params(subsample=gsearch4.best_params_['subsample'],
-                            colsample_bytree=gsearch4.best_params_['colsample_bytree'])
-        if args.reg_alpha_vector:
-            param_test5 = {
-                'reg_alpha': args.reg_alpha_vector
-            }
-            gsearch5 = GridSearchCV(estimator=xgb1, param_grid = param_test5,
-                                    scoring='neg_mean_absolute_error', cv=5)
-            gsearch5.fit(attack_train_eval_x, attack_train_eval_y)
-            logger.info(f"best parameter: {gsearch5.best_params_}")
-            logger.info(f"best score: {gsearch5.best_score_}")
-
-            xgb1.set_params(reg_alpha=gsearch5.best_params_['reg_alpha'])
-
-        xgb1.set_params(n_estimators=args.xgb_n_rounds)
-        # modelfit(xgb1, attack_train_eval_x, attack_train_eval_y)
-
-    classifier_train_data = xgb.DMatrix(attack_train_data_x, attack_train_data_y)
-    classifier_eval_data = xgb.DMatrix(attack_eval_data_x, attack_eval_data_y)
+    if args.xgb_external_memory:
+        classifier_train_data, classifier_eval_data = external_memory_dmatrices(
+            xgb1, train_sources, eval_sources, args, xgb_cache_dir)
+    else:
+        classifier_train_data, classifier_eval_data = in_memory_dmatrices(xgb1, train_sources, eval_sources, args)
 
     logger.info("classifier training ...")
     attack_classifier = train_classifier(xgb1, classifier_train_data, classifier_eval_data,
                                          early_stopping_rounds=args.early_stopping_rounds,
                                          num_round=args.xgb_n_rounds, eta=args.xg_eta)
+    del classifier_train_data, classifier_eval_data
+    if args.xgb_external_memory:
+        shutil.rmtree(xgb_cache_dir, ignore_errors=True)
 
     logger.info("training finished ...")
-    logger.info("loading the test pairs ...")
-
-    attack_test_data_pos_x = np.load(pair_path_results + '/test_positive_x.npy')
-    attack_test_data_pos_y = np.load(pair_path_results + '/test_positive_y.npy')
-    attack_test_data_neg_x = np.load(pair_path_results + '/test_negative_x.npy')
-    attack_test_data_neg_y = np.load(pair_path_results + '/test_negative_y.npy')
+    if pairs is None:
+        logger.info("loading the test pairs ...")
+        test_pairs = load_pairs(pair_path_results, TEST_PAIRS)
+    else:
+        test_pairs = pairs
+    attack_test_data_pos_x = test_pairs['test_positive_x']
+    attack_test_data_pos_y = test_pairs['test_positive_y']
+    attack_test_data_neg_x = test_pairs['test_negative_x']
+    attack_test_data_neg_y = test_pairs['test_negative_y']
+    del test_pairs
 
     num_rows, _ = attack_test_data_pos_x.shape
 
@@ -940,11 +1039,13 @@ def train_attack_model_v4(file_path_results, pair_path_results, args):
     num_predictions = attack_test_data_x.shape[0]
     _, _, _, _, results = accuracy_report_2(
         classifier_predictions, attack_test_data_y, args.attack_thresholds, num_predictions, results)
+    (fpr, tpr, roc_thresholds, _), (precision, recall, pr_thresholds, _) = roc_pr_curves(
+        classifier_predictions, attack_test_data_y)
+    np.savez(pair_path_results + '/roc_pr_curves', fpr=fpr, tpr=tpr, roc_thresholds=roc_thresholds,
+             precision=precision, recall=recall, pr_thresholds=pr_thresholds)
 
     logger.info(f"Final tuned parameters:\n {xgb1}")
-
-    num_training_samples = attack_train_data_x.shape[0]
-    num_eval_samples = attack_eval_data_x.shape[0]
+    save_attack_classifier(pair_path_results, attack_classifier, xgb1, attack_test_data_x.shape[1], args)
 
     print_experiment(args.env, args.shadow_seeds, args.target_seeds, args.attack_thresholds,
                      num_predictions, args.max_traj_len, args.num_models, num_training_samples, num_eval_samples)
@@ -952,6 +1053,100 @@ def train_attack_model_v4(file_path_results, pair_path_results, args):
     logger.info(results)
 
 
+def save_attack_classifier(pair_path_results, attack_classifier, xgb1, num_features, args):
+    """
+    Saves the attack classifier next to the pairs it was trained on, with its tuned parameters and the pair layout
+    (see get_pair_layout), so that new trajectory pairs can be scored without retraining (see score_target_pairs).
+    """
+    attack_classifier.save_model(f"{pair_path_results}/{CLASSIFIER_FILE}")
+    metadata = dict(params=xgb_booster_params(xgb1), num_round=args.xgb_n_rounds,
+                    best_iteration=getattr(attack_classifier, 'best_iteration', None), num_features=int(num_features),
+                    pair_layout=load_pair_layout(pair_path_results))
+    with open(f"{pair_path_results}/{CLASSIFIER_METADATA_FILE}", 'w') as f:
+        json.dump(metadata, f, indent=4)
+    logger.info(f"attack classifier saved to {pair_path_results}/{CLASSIFIER_FILE}")
+
+
+def load_attack_classifier(classifier_path):
+    """Loads the attack classifier and the metadata saved by save_attack_classifier"""
+    attack_classifier = xgb.Booster(model_file=f"{classifier_path}/{CLASSIFIER_FILE}")
+    with open(f"{classifier_path}/{CLASSIFIER_METADATA_FILE}") as f:
+        return attack_classifier, json.load(f)
+
+
+class ChunkCollector(object):
+    """
+    Writer-like sink for build_pairs (see NpyAppender) keeping the appended chunks (their first max_rows rows
+    overall, when given), optionally transformed
+    """
+
+    def __init__(self, transform=None, max_rows=None):
+        self.transform = transform
+        self.max_rows = max_rows
+        self.num_rows = 0
+        self.chunks = []
+
+    def append(self, rows):
+        rows = np.atleast_2d(rows)
+        if self.max_rows is not None:
+            rows = rows[:self.max_rows - self.num_rows]
+            if len(rows) == 0:
+                return
+        self.num_rows += len(rows)
+        self.chunks.append(rows if self.transform is None else self.transform(rows))
+
+    def collect(self):
+        return np.concatenate(self.chunks) if self.chunks else np.empty(0)
+
+
+def score_target_pairs(attack_path, classifier_path, pair_path_results, state_dim, action_dim, device, args):
+    """
+    Scores the pairs of the target models (args.target_seeds) with the attack classifier saved under classifier_path,
+    without retraining it. The pairs are built with the layout the classifier was trained on and streamed from the
+    buffers: every chunk of pairs is scored as soon as it is built. As in train_attack_model_v4, only the first
+    args.attack_size pairs of every label are scored. The metrics for args.attack_thresholds are logged and the
+    predictions are saved under pair_path_results. Returns the predictions and the labels of the pairs.
+    """
+    attack_classifier, metadata = load_attack_classifier(classifier_path)
+    layout = metadata['pair_layout']
+    if layout is None:
+        raise ValueError(f"The attack classifier in {classifier_path} was saved without the layout of its pairs")
+    if layout['action_dim'] != action_dim:
+        raise ValueError(f"The attack classifier in {classifier_path} was trained on pairs of "
+                         f"{layout['action_dim']}-dimensional actions, not {action_dim}-dimensional ones")
+    args = copy.copy(args)
+    args.pairing_mode = layout['pairing_mode']
+    args.truncate_traj = layout['truncate_traj']
+    args.padding_size = layout['padding_size']
+    padding = {name: layout[name] for name in ['test_padding_len', 'train_padding_len', 'padding_len']}
+
+    def predict(rows):
+        if rows.shape[1] != metadata['num_features']:
+            raise ValueError(f"Pairs of {rows.shape[1]} features cannot be scored by the attack classifier "
+                             f"({metadata['num_features']} features)")
+        return attack_classifier.predict(xgb.DMatrix(rows))
+
+    predictions, labels = [], []
+    logger.info("scoring the target pairs ...")
+    for label in [1, 0]:
+        train_seed, test_seed = get_seeds_pairs(label, args.target_seeds, test=True)
+        label_predictions = ChunkCollector(predict, max_rows=args.attack_size)
+        label_labels = ChunkCollector(max_rows=args.attack_size)
+        create_pairs(attack_path, state_dim, action_dim, device, args, label, train_seed, test_seed, do_train=False,
+                     pair_writers=((label_predictions, label_labels), None), **padding)
+        predictions.append(np.ravel(label_predictions.collect()))
+        labels.append(np.ravel(label_labels.collect()))
+    classifier_predictions = np.concatenate(predictions)
+    labels_test = np.concatenate(labels)
+    logger.info("scoring the target pairs ... Done")
+
+    _, _, _, _, results = accuracy_report_2(
+        classifier_predictions, labels_test, args.attack_thresholds, len(labels_test), "")
+    np.savez(pair_path_results + '/target_scores', predictions=classifier_predictions, labels=labels_test)
+    logger.info(results)
+    return classifier_predictions, labels_test
+
+
 def get_pairs_max_traj_len(attack_path, file_path_results, state_dim, action_dim, device, args):
     """
     Let's get the maximum length for both positive/negative test/train trajectories.
@@ -1007,115 +1202,202 @@ def shuffle_xgboost_params(attack_train_data_x, attack_train_data_y):
     return np.hsplit(merged_data, np.array([-1]))
 
 
-def train_attack_model_v3(attack_path, file_path_results, pair_path_results, state_dim, action_dim, device, args):
+def job_pair_names(label, do_train):
+    """Names of the (train, eval) pair stores that a (model, label) job writes to"""
+    name = 'positive' if label == 1 else 'negative'
+    if do_train:
+        return (f'train_{name}_x', f'train_{name}_y'), (f'eval_{name}_x', f'eval_{name}_y')
+    return (f'test_{name}_x', f'test_{name}_y'), None
 
+
+def select_pair_writers(writers, pair_names):
+    """Picks the writers of a job out of writers, laid out as create_pairs' pair_writers"""
+    return tuple(None if names is None else (writers[names[0]], writers[names[1]]) for names in pair_names)
+
+
+def append_npy(writer, filename, chunk_size=PAIRS_CHUNK_SIZE):
+    """Appends the rows of a .npy file to writer chunk by chunk, then removes the file"""
+    rows = np.load(filename, mmap_mode='r')
+    for first in range(0, rows.shape[0], chunk_size):
+        writer.append(rows[first:first + chunk_size])
+    del rows
+    os.remove(filename)
+
+
+def create_pairs_job(attack_path, state_dim, action_dim, device, args, label, train_seed, test_seed, do_train,
+                     seed, job_prefix=None, **padding):
+    """
+    Runs create_pairs for one (model, label) job in a worker process.
+    The numpy generator is seeded per job so that sampling does not depend on the worker that runs it.
+    With job_prefix, the pairs are streamed to "{job_prefix}{name}.npy" files instead of being returned.
+    """
+    np.random.seed(seed)
+    if job_prefix is None:
+        return create_pairs(attack_path, state_dim, action_dim, device, args, label, train_seed, test_seed,
+                            do_train=do_train, **padding)
+
+    pair_names = job_pair_names(label, do_train)
+    writers = {name: NpyAppender(f"{job_prefix}{name}.npy") for names in pair_names if names for name in names}
+    try:
+        create_pairs(attack_path, state_dim, action_dim, device, args, label, train_seed, test_seed,
+                     do_train=do_train, pair_writers=select_pair_writers(writers, pair_names), **padding)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def stack_pairs(shards):
+    """Stacks the pairs (or labels) created for several models with a single copy"""
+    shards = [shard for shard in shards if shard is not None]
+    if not shards:
+        return None
+    if len(shards) == 1:
+        return shards[0]
+    return np.concatenate([np.atleast_2d(shard) for shard in shards])
+
+
+def get_pairs_padding(attack_path, file_path_results, state_dim, action_dim, device, args):
+    """Padding lengths of the "in" and "out" trajectories of the pairs, as create_pairs keyword arguments"""
     # if CORRELATION_MAP.get(args.correlation) != DECORRELATED:
     # In correlated mode, we need to load existing trajectories, and find their maximum length
     # test_padding_len = train_padding_len = args.max_traj_len
     test_padding_len, train_padding_len = get_pairs_max_traj_len(
         attack_path, file_path_results, state_dim, action_dim, device, args)
     padding_len = max(test_padding_len, train_padding_len)
-    # Pairing train and test trajectories
     # Feeding max length trajectory to be uesd for padding purposes
-    attack_train_pos_data = None
-    attack_train_pos_label = None
-    attack_eval_pos_data = None
-    attack_eval_pos_label = None
-    attack_train_neg_data = None
-    attack_train_neg_label = None
-    attack_eval_neg_data = None
-    attack_eval_neg_label = None
-    for i in range(args.num_models):
-        # Positive pairs
-        train_seed, test_seed = get_seeds_pairs(1, args.shadow_seeds, index=i, test=False)
-        attack_train_positive_data, attack_eval_positive_data = create_pairs(
-            attack_path, state_dim, action_dim, device, args, 1,
-            train_seed, test_seed,
-            do_train=True,
-            test_padding_len=test_padding_len,
-            train_padding_len=train_padding_len,
-            padding_len=padding_len
-        )
-        train_pos_data, train_pos_label = attack_train_positive_data
-        eval_pos_data, eval_pos_label = attack_eval_positive_data
-        attack_train_pos_data = train_pos_data if not isinstance(
-                attack_train_pos_data, np.ndarray) else np.vstack((attack_train_pos_data, train_pos_data))
-        attack_train_pos_label = train_pos_label if not isinstance(
-            attack_train_pos_label, np.ndarray) else np.vstack((attack_train_pos_label, train_pos_label))
-        attack_eval_pos_data = eval_pos_data if not isinstance(
-                attack_eval_pos_data, np.ndarray) else np.vstack((attack_eval_pos_data, eval_pos_data))
-        attack_eval_pos_label = eval_pos_label if not isinstance(
-            attack_eval_pos_label, np.ndarray) else np.vstack((attack_eval_pos_label, eval_pos_label))
-        # Negative pairs
-        train_seed, test_seed = get_seeds_pairs(0, args.shadow_seeds, index=i, test=False)
-        attack_train_negative_data, attack_eval_negative_data = create_pairs(
-            attack_path, state_dim, action_dim, device, args, 0,
-            train_seed, test_seed,
-            do_train=True,
-            test_padding_len=test_padding_len,
-            train_padding_len=train_padding_len,
-            padding_len=padding_len
-        )
-        train_neg_data, train_neg_label = attack_train_negative_data
-        eval_neg_data, eval_neg_label = attack_eval_negative_data
-        attack_train_neg_data = train_neg_data if not isinstance(
-                attack_train_neg_data, np.ndarray) else np.vstack((attack_train_neg_data, train_neg_data))
-        attack_train_neg_label = train_neg_label if not isinstance(
-            attack_train_neg_label, np.ndarray) else np.vstack((attack_train_neg_label, train_neg_label))
-        attack_eval_neg_data = eval_neg_data if not isinstance(
-                attack_eval_neg_data, np.ndarray) else np.vstack((attack_eval_neg_data, eval_neg_data))
-        attack_eval_neg_label = eval_neg_label if not isinstance(
-            attack_eval_neg_label, np.ndarray) else np.vstack((attack_eval_neg_label, eval_neg_label))
-
-    # Instanciating xgboost DMatrix with positive/negative train data
-    # attack_train_pos_data, attack_train_pos_label = attack_train_positive_data
-    # attack_train_neg_data, attack_train_neg_label = attack_train_negative_data
-
-    np.save(pair_path_results + '/train_positive_x', attack_train_pos_data)
-    np.save(pair_path_results + '/train_positive_y', attack_train_pos_label)
-    np.save(pair_path_results + '/train_negative_x', attack_train_neg_data)
-    np.save(pair_path_results + '/train_negative_y', attack_train_neg_label)
-    logger.info("saving train data for classifier training ... Done")
-
-
-    # Instanciating xgboost DMatrix with positive/negative train data
-    # attack_eval_pos_data, attack_eval_pos_label = attack_eval_positive_data
-    # attack_eval_neg_data, attack_eval_neg_label = attack_eval_negative_data
-
-    np.save(pair_path_results + '/eval_positive_x', attack_eval_pos_data)
-    np.save(pair_path_results + '/eval_positive_y', attack_eval_pos_label)
-    np.save(pair_path_results + '/eval_negative_x', attack_eval_neg_data)
-    np.save(pair_path_results + '/eval_negative_y', attack_eval_neg_label)
-    logger.info("saving eval data for classifier training ... Done")
-
-    # Positive pairs
-    train_seed, test_seed = get_seeds_pairs(1, args.target_seeds, test=True)
-    attack_train_positive_data, _ = create_pairs(
-        attack_path, state_dim, action_dim, device, args, 1,
-        train_seed, test_seed,
-        do_train=False,
-        test_padding_len=test_padding_len,
-        train_padding_len=train_padding_len,
-        padding_len=padding_len
-    )
-    # Negative pairs
-    train_seed, test_seed = get_seeds_pairs(0, args.target_seeds, test=True)
-    attack_train_negative_data, _ = create_pairs(
-        attack_path, state_dim, action_dim, device, args, 0,
-        train_seed, test_seed,
-        do_train=False,
-        test_padding_len=test_padding_len,
-        train_padding_len=train_padding_len,
-        padding_len=padding_len
-    )
+    return dict(test_padding_len=test_padding_len, train_padding_len=train_padding_len, padding_len=padding_len)
+
+
+def get_pair_layout(args, action_dim, padding):
+    """Describes how the pairs are laid out, so that new trajectory pairs can be built the same way"""
+    return dict({name: int(length) for name, length in padding.items()}, action_dim=int(action_dim),
+                pairing_mode=args.pairing_mode, truncate_traj=bool(args.truncate_traj),
+                padding_size=int(args.padding_size), max_traj_len=int(args.max_traj_len), correlation=args.correlation)
+
 
-    final_train_dataset_pos, final_train_dataset_pos_label = attack_train_positive_data
-    final_train_dataset_neg, final_train_dataset_neg_label = attack_train_negative_data
+def save_pair_layout(pair_path_results, layout):
+    with open(f"{pair_path_results}/{PAIR_LAYOUT_FILE}", 'w') as f:
+        json.dump(layout, f, indent=4)
 
-    np.save(pair_path_results + '/test_positive_x', final_train_dataset_pos)
-    np.save(pair_path_results + '/test_positive_y', final_train_dataset_pos_label)
-    np.save(pair_path_results + '/test_negative_x', final_train_dataset_neg)
-    np.save(pair_path_results + '/test_negative_y', final_train_dataset_neg_label)
-    logger.info("saving test data for prediction ... Done")
 
+def load_pair_layout(pair_path_results):
+    """Pair layout saved by save_pair_layout, or None for pairs created before it was saved"""
+    if not os.path.exists(f"{pair_path_results}/{PAIR_LAYOUT_FILE}"):
+        return None
+    with open(f"{pair_path_results}/{PAIR_LAYOUT_FILE}") as f:
+        return json.load(f)
 
+
+def generate_attack_pairs(attack_path, file_path_results, state_dim, action_dim, device, args,
+                          pair_path_results=None, padding=None):
+    """
+    Creates the train/eval pairs of the shadow models and the test pairs of the target models.
+    Returns a dictionary of pair matrices keyed by TRAIN_EVAL_PAIRS and TEST_PAIRS names.
+    With args.pair_workers > 0, every (model, label) job runs in a process pool with its own seeded
+    numpy generator, so the pairs only depend on the shadow seeds, not on the number of workers.
+    With pair_path_results, the pairs are streamed chunk by chunk to .npy files under pair_path_results (as
+    save_pairs would write them) and the returned matrices are read-only memory-mapped views of these files.
+    padding (see get_pairs_padding) is computed from the buffers if not given.
+    """
+    if padding is None:
+        padding = get_pairs_padding(attack_path, file_path_results, state_dim, action_dim, device, args)
+
+    # Pairing train and test trajectories: positive then negative pairs for every shadow model, then the target
+    jobs = []
+    for i in range(args.num_models):
+        for label in [1, 0]:
+            train_seed, test_seed = get_seeds_pairs(label, args.shadow_seeds, index=i, test=False)
+            jobs.append((label, train_seed, test_seed, True))
+    for label in [1, 0]:
+        train_seed, test_seed = get_seeds_pairs(label, args.target_seeds, test=True)
+        jobs.append((label, train_seed, test_seed, False))
+
+    if pair_path_results is not None:
+        return stream_attack_pairs(attack_path, pair_path_results, state_dim, action_dim, device, args, jobs,
+                                   padding)
+
+    if args.pair_workers > 0:
+        logger.info(f"creating pairs with {args.pair_workers} workers ...")
+        seeds = np.random.SeedSequence(args.shadow_seeds[0]).generate_state(len(jobs))
+        with ProcessPoolExecutor(max_workers=args.pair_workers) as executor:
+            futures = [executor.submit(create_pairs_job, attack_path, state_dim, action_dim, device, args,
+                                       label, train_seed, test_seed, do_train, int(seed), **padding)
+                       for (label, train_seed, test_seed, do_train), seed in zip(jobs, seeds)]
+            shards = [future.result() for future in futures]
+    else:
+        shards = [create_pairs(attack_path, state_dim, action_dim, device, args, label, train_seed, test_seed,
+                               do_train=do_train, **padding)
+                  for label, train_seed, test_seed, do_train in jobs]
+
+    pairs = {}
+    for label, name in [(1, 'positive'), (0, 'negative')]:
+        model_shards = [shard for shard, job in zip(shards, jobs) if job[0] == label and job[3]]
+        pairs[f'train_{name}_x'] = stack_pairs([train[0] for train, _ in model_shards])
+        pairs[f'train_{name}_y'] = stack_pairs([train[1] for train, _ in model_shards])
+        pairs[f'eval_{name}_x'] = stack_pairs([evaluation[0] for _, evaluation in model_shards])
+        pairs[f'eval_{name}_y'] = stack_pairs([evaluation[1] for _, evaluation in model_shards])
+    for label, name in [(1, 'positive'), (0, 'negative')]:
+        (test_x, test_y), _ = [shard for shard, job in zip(shards, jobs) if job[0] == label and not job[3]][0]
+        pairs[f'test_{name}_x'] = test_x
+        pairs[f'test_{name}_y'] = test_y
+
+    # Same order as TRAIN_EVAL_PAIRS + TEST_PAIRS
+    return {name: pairs[name] for name in TRAIN_EVAL_PAIRS + TEST_PAIRS}
+
+
+def stream_attack_pairs(attack_path, pair_path_results, state_dim, action_dim, device, args, jobs, padding):
+    """
+    Streams the pairs of the (label, train_seed, test_seed, do_train) jobs of generate_attack_pairs to
+    "{pair_path_results}/{name}.npy" files, in job order, and returns memory-mapped views of them.
+    In a process pool, every job writes its own files, which are then appended to the final ones.
+    The pairs are streamed to ".part" files, moved to the final names only once every job succeeded, so that a
+    failed run does not leave valid but truncated pair files.
+    """
+    names = TRAIN_EVAL_PAIRS + TEST_PAIRS
+    writers = {name: NpyAppender(f"{pair_path_results}/{name}.npy.part") for name in names}
+    try:
+        if args.pair_workers > 0:
+            logger.info(f"streaming pairs with {args.pair_workers} workers ...")
+            seeds = np.random.SeedSequence(args.shadow_seeds[0]).generate_state(len(jobs))
+            with ProcessPoolExecutor(max_workers=args.pair_workers) as executor:
+                futures = [executor.submit(create_pairs_job, attack_path, state_dim, action_dim, device, args,
+                                           label, train_seed, test_seed, do_train, int(seed),
+                                           job_prefix=f"{pair_path_results}/job_{k}_", **padding)
+                           for k, ((label, train_seed, test_seed, do_train), seed) in enumerate(zip(jobs, seeds))]
+                for future in futures:
+                    future.result()
+            for k, (label, _, _, do_train) in enumerate(jobs):
+                for pair_names in job_pair_names(label, do_train):
+                    for name in pair_names or ():
+                        append_npy(writers[name], f"{pair_path_results}/job_{k}_{name}.npy")
+        else:
+            for label, train_seed, test_seed, do_train in jobs:
+                create_pairs(attack_path, state_dim, action_dim, device, args, label, train_seed, test_seed,
+                             do_train=do_train, pair_writers=select_pair_writers(
+                                 writers, job_pair_names(label, do_train)), **padding)
+    except BaseException:
+        for writer in writers.values():
+            writer.close()
+            os.remove(writer.filename)
+        for k in range(len(jobs)):
+            for name in names:
+                if os.path.exists(f"{pair_path_results}/job_{k}_{name}.npy"):
+                    os.remove(f"{pair_path_results}/job_{k}_{name}.npy")
+        raise
+    for name, writer in writers.items():
+        writer.close()
+        os.replace(writer.filename, f"{pair_path_results}/{name}.npy")
+    logger.info("streaming pairs ... Done")
+    return load_pairs(pair_path_results, names)
+
+
+def train_attack_model_v3(attack_path, file_path_results, pair_path_results, state_dim, action_dim, device, args):
+    padding = get_pairs_padding(attack_path, file_path_results, state_dim, action_dim, device, args)
+    save_pair_layout(pair_path_results, get_pair_layout(args, action_dim, padding))
+    if args.stream_pairs:
+        generate_attack_pairs(attack_path, file_path_results, state_dim, action_dim, device, args,
+                              pair_path_results=pair_path_results, padding=padding)
+    else:
+        pairs = generate_attack_pairs(attack_path, file_path_results, state_dim, action_dim, device, args,
+                                      padding=padding)
+        save_pairs(pair_path_results, pairs)
@@ -1,10 +1,13 @@
 import os
+import threading
 import numpy as np
 import pandas as pd
 from random import sample
 from utils.helpers import print_experiment, format_trajectory
+from utils.trajectory_recorder import load_trajectories
 from itertools import product
-from workers.attack import train_attack_model_v3, train_attack_model_v4
+from workers.attack import train_attack_model_v3, train_attack_model_v4, generate_attack_pairs, save_pairs
+from workers.attack import get_pairs_padding, get_pair_layout, save_pair_layout, score_target_pairs
 from workers.attack import train_classifier
 
 
@@ -66,6 +69,43 @@ def run_classifier(attack_path, file_path_results, pair_path_results, state_dim,
     # logger_overwrite(np.asarray(results), args.env, args.max_timesteps)
 
 
+def run_fused_experiment(attack_path, file_path_results, pair_path_results, state_dim, action_dim, device, args):
+    """
+    Creates the pairs and trains the attack classifier in one process, handing the pairs over in memory.
+    If args.save_pairs is set, the pairs are also saved to pair_path_results in the background.
+    If args.stream_pairs is set, the pairs are streamed to pair_path_results and trained on from memory-mapped views.
+    """
+    padding = get_pairs_padding(attack_path, file_path_results, state_dim, action_dim, device, args)
+    save_pair_layout(pair_path_results, get_pair_layout(args, action_dim, padding))
+    if args.stream_pairs:
+        pairs = generate_attack_pairs(attack_path, file_path_results, state_dim, action_dim, device, args,
+                                      pair_path_results=pair_path_results, padding=padding)
+    else:
+        pairs = generate_attack_pairs(attack_path, file_path_results, state_dim, action_dim, device, args,
+                                      padding=padding)
+
+    saver = None
+    if args.save_pairs and not args.stream_pairs:
+        saver = threading.Thread(target=save_pairs, args=(pair_path_results, pairs))
+        saver.start()
+
+    # Same numpy seed as a separate classifier run, so that the classifier is trained on the same shuffles
+    np.random.seed(args.shadow_seeds[0])
+    train_attack_model_v4(file_path_results, pair_path_results, args, pairs=pairs)
+
+    if saver is not None:
+        saver.join()
+
+
+def run_scoring(attack_path, file_path_results, pair_path_results, state_dim, action_dim, device, args):
+    """
+    Scores the target pairs with an attack classifier trained before: the one saved under args.classifier_path, or
+    under pair_path_results by default.
+    """
+    score_target_pairs(attack_path, args.classifier_path or pair_path_results, pair_path_results, state_dim,
+                       action_dim, device, args)
+
+
 def logger_inplace(timesteps, env, attack_size, threshold, baseline, false_negatives_b1,
                    false_positives_bl, rmse, accuracy,
                    false_negatives, false_positives):
@@ -100,7 +140,6 @@ def logger_overwrite(np_results, environment, timesteps):
 
 def save_models(seeds, environment, model, timesteps, max_ep_length):
     path = 'tmp/'
-    extension = '.npy'
 
     if not os.path.exists(path):
         os.mkdir(path)
@@ -108,13 +147,12 @@ def save_models(seeds, environment, model, timesteps, max_ep_length):
     for seed in seeds:
         np.save(path + environment + '_' + model + '_seed' + str(seed) + '_maxEpLen' + str(max_ep_length) + '_timeSteps' + str(timesteps) + '.npy',
                 format_trajectory(max_ep_length,
-                                  np.load('output/' + environment + '/' + model + '/TimeSteps_' + str(timesteps)
-                                          + '/seed_' + str(seed) + '/maxEpLen_' + str(max_ep_length) + '/trajectories' + extension,
-                                          allow_pickle=True)))
+                                  load_trajectories('output/' + environment + '/' + model + '/TimeSteps_' + str(timesteps)
+                                                    + '/seed_' + str(seed) + '/maxEpLen_' + str(max_ep_length) + '/trajectories'),
+                                  seed=seed))
 
     for seed in seeds:
         np.save(path + environment + '_' + model + '_seed' + str(seed) + '_maxEpLen' + str(max_ep_length) + '_timeSteps' + str(timesteps) + '_test' + '.npy',
-                format_trajectory(max_ep_length, np.load(
+                format_trajectory(max_ep_length, load_trajectories(
                     'output/' + environment + '/' + model + '/TimeSteps_' + str(timesteps) + '/seed_' + str(seed)
-                    + '/maxEpLen_' + str(max_ep_length) + '/trajectories_test' + extension,
-                    allow_pickle=True)))
+                    + '/maxEpLen_' + str(max_ep_length) + '/trajectories_test'), seed=seed))
@@ -0,0 +1,164 @@
+import math
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xgboost as xgb
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+logger = logging.getLogger(__name__)
+
+# fraction of the candidates kept (and factor applied to the boosting rounds) at every successive halving rung
+HALVING_FACTOR = 3
+
+# (train, test) DMatrix folds of a worker process, built once by init_cv_worker
+_worker_folds = None
+
+
+def kfold_dmatrices(x, y, cv_folds):
+    """(train, test) DMatrix of every fold of a stratified K-fold split of the rows of x (as GridSearchCV splits)"""
+    return [(xgb.DMatrix(x[train], y[train]), xgb.DMatrix(x[test], y[test]))
+            for train, test in StratifiedKFold(n_splits=cv_folds).split(x, y)]
+
+
+def xgb_booster_params(xgb1):
+    """Booster parameters of an XGBClassifier"""
+    params = xgb1.get_xgb_params()
+    params.pop('n_estimators', None)
+    params.pop('use_label_encoder', None)
+    return params
+
+
+def params_key(params):
+    """Hashable key of a parameter set"""
+    return tuple(sorted((name, str(value)) for name, value in params.items()))
+
+
+def cv_fit(params, num_boost_round, early_stopping_rounds, dtrain, dtest):
+    """
+    Trains on dtrain with early stopping on dtest. Returns the best test score, the number of rounds up to it and
+    whether early stopping ended the training before num_boost_round rounds.
+    """
+    evals_result = {}
+    xgb.train(params, dtrain, num_boost_round, evals=[(dtest, 'test')], early_stopping_rounds=early_stopping_rounds,
+              evals_result=evals_result, verbose_eval=False)
+    scores = evals_result['test'][params['eval_metric']]
+    best = int(np.argmin(scores))
+    return scores[best], best + 1, len(scores) < num_boost_round
+
+
+def init_cv_worker(make_folds):
+    global _worker_folds
+    _worker_folds = make_folds()
+
+
+def worker_cv_fit(params, num_boost_round, early_stopping_rounds, fold):
+    """cv_fit on a fold of the worker process"""
+    dtrain, dtest = _worker_folds[fold]
+    return cv_fit(params, num_boost_round, early_stopping_rounds, dtrain, dtest)
+
+
+class CVSearch(object):
+    """
+    Cross-validated hyper parameter search for the attack classifier.
+
+    Every (candidate, fold) fit trains with early stopping on the test fold, so each candidate also gets its own
+    number of boosting rounds. With workers > 0, the fits run in a process pool whose workers build the cv_folds
+    folds once (with make_folds) and reuse them for every fit. Results are cached by parameter set, so a
+    configuration that was already cross-validated (e.g. the best candidate of the previous stage) is not fitted
+    again. With halving, the candidates of a grid are first compared on fewer boosting rounds, and only the best
+    1 / HALVING_FACTOR of them are trained further (successive halving).
+    """
+
+    def __init__(self, make_folds, cv_folds, num_boost_round, early_stopping_rounds=10, metric='mae', workers=0,
+                 halving=False):
+        self.cv_folds = cv_folds
+        self.num_boost_round = num_boost_round
+        self.early_stopping_rounds = early_stopping_rounds
+        self.metric = metric
+        self.halving = halving
+        # params_key -> {num_boost_round: (score, rounds, stopped)}
+        self.cache = {}
+        if workers > 0:
+            self.folds = None
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_cv_worker,
+                                                initargs=(make_folds,))
+            self.fit_threads = max(1, (os.cpu_count() or 1) // workers)
+        else:
+            self.folds = make_folds()
+            self.executor = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.folds = None
+
+    def lookup(self, params, num_boost_round):
+        """
+        Cached result of params for num_boost_round rounds. A result computed with fewer rounds is reused when early
+        stopping ended every fold before that budget, since more rounds would not change the fits.
+        """
+        for budget, result in self.cache.get(params_key(params), {}).items():
+            if budget == num_boost_round or (result[2] and budget < num_boost_round):
+                return result
+        return None
+
+    def evaluate(self, candidates, num_boost_round):
+        """
+        Cross-validates the candidate parameter sets for at most num_boost_round rounds.
+        Returns a (mean best test score, mean number of rounds, stopped early in every fold) tuple per candidate.
+        """
+        pending = [params for params in candidates if self.lookup(params, num_boost_round) is None]
+        pending = list({params_key(params): params for params in pending}.values())
+        if pending:
+            fits = [(dict(params, eval_metric=self.metric), fold) for params in pending for fold in range(self.cv_folds)]
+            if self.executor is not None:
+                futures = [self.executor.submit(worker_cv_fit, dict(params, nthread=self.fit_threads,
+                                                                    n_jobs=self.fit_threads),
+                                                num_boost_round, self.early_stopping_rounds, fold)
+                           for params, fold in fits]
+                results = [future.result() for future in futures]
+            else:
+                results = [cv_fit(params, num_boost_round, self.early_stopping_rounds, *self.folds[fold])
+                           for params, fold in fits]
+            for k, params in enumerate(pending):
+                scores, rounds, stopped = zip(*results[k * self.cv_folds:(k + 1) * self.cv_folds])
+                self.cache.setdefault(params_key(params), {})[num_boost_round] = (
+                    float(np.mean(scores)), int(round(np.mean(rounds))), all(stopped))
+        return [self.lookup(params, num_boost_round) for params in candidates]
+
+    def halving_budgets(self, num_candidates):
+        """Boosting rounds of every successive halving rung"""
+        if not self.halving or num_candidates <= 1:
+            return [self.num_boost_round]
+        rungs = int(math.ceil(math.log(num_candidates, HALVING_FACTOR)))
+        return [max(1, self.num_boost_round // HALVING_FACTOR ** k) for k in range(rungs, -1, -1)]
+
+    def search(self, params, param_grid):
+        """Returns the best candidate of param_grid (on top of params) and its (score, rounds, stopped) result"""
+        candidates = list(ParameterGrid(param_grid))
+        for budget in self.halving_budgets(len(candidates)):
+            results = self.evaluate([dict(params, **candidate) for candidate in candidates], budget)
+            if budget < self.num_boost_round:
+                keep = sorted(np.argsort([score for score, _, _ in results], kind='stable')[
+                              :int(math.ceil(len(candidates) / HALVING_FACTOR))])
+                logger.info(f"successive halving: keeping {len(keep)} of {len(candidates)} candidates "
+                            f"after {budget} rounds")
+                candidates = [candidates[k] for k in keep]
+        best = int(np.argmin([score for score, _, _ in results]))
+        return candidates[best], results[best]
+
+    def tune_n_estimators(self, xgb1):
+        """Sets n_estimators of xgb1 to its mean number of rounds before early stopping"""
+        _, rounds, _ = self.evaluate([xgb_booster_params(xgb1)], self.num_boost_round)[0]
+        xgb1.set_params(n_estimators=rounds)
+        logger.info(f"Tuned n_estimators for learning_rate {xgb1.get_params()['learning_rate']} = {rounds}")
+
+    def grid_search(self, xgb1, param_grid):
+        """Sets the best parameters of param_grid (and the number of rounds they need) on xgb1"""
+        best_params, (score, rounds, _) = self.search(xgb_booster_params(xgb1), param_grid)
+        logger.info(f"best parameter: {best_params}")
+        logger.info(f"best score (cv {self.metric}): {score}")
+        xgb1.set_params(n_estimators=rounds, **best_params)